@@ -12,7 +12,7 @@ import scipy.stats
 import pandas as pd
 import seaborn as sns
 from pystats.pylmm.glmm import GLMM_AGQ
-from pystats.pylmm.lmm import GLMM, Binomial
+from pystats.pylmm.lmm import GLMM, GLMM_Laplace, Binomial
 from pystats.pylmm.glmm_mcmc import MixedMCMC
 from pystats.pylmm.test_data2 import generate_data
 from pystats.utilities.random_corr import vine_corr
@@ -38,6 +38,10 @@ df['y'] = rng.binomial(n=1, p=mu)
 model1 = GLMM(formula, df, fam=Binomial())
 model1.fit()
 
+model1b = GLMM(formula, df, fam=Binomial())
+model1b.fit(warm_start=False)
+assert(np.allclose(model1.params, model1b.params, rtol=1e-3))
+
 assert(np.allclose(model1.mod.params, np.array([0.00493292, 0.96468618,
                                                 -1.02800986, 1.99930704, 
                                                 1.])))
@@ -46,9 +50,13 @@ model2 = GLMM_AGQ(formula, df, family=Binomial())
 model2.fit(nagq=200)
 
 assert(np.allclose(model2.params,
-                   np.array([ 0.00587493,  1.08017546, -1.14671719,  2.56324546])))
+                   np.array([ 0.00652055,  1.08068753, -1.14637567,  2.6412118 ])))
 assert(model2.optimizer.success==True)
 
+model2b = GLMM_Laplace(formula, df, family=Binomial())
+model2b.fit()
+assert(np.allclose(model2b.ll, 2.0 * model2.loglike(model2b.params, nagq=1)))
+
 model3 = MixedMCMC(formula, df)
 model3.priors['id1'] = dict(V=np.ones((1, 1)), n=1)
 samples, az_data, summary, samples_a = model3.fit(n_samples=40_000, burnin=10_000, 
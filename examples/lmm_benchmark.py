@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 15:21:08 2026
+"""
+
+import pandas as pd
+from pystats.pylmm.benchmark import benchmark_grid, run_benchmarks
+
+pd.set_option('display.width', 1000)
+pd.set_option('display.max_rows', 250)
+pd.set_option('display.max_columns', 50)
+
+configs = benchmark_grid(n_obs=(1_000, 10_000, 100_000), n_groups=(10, 100, 1000),
+                         n_slopes=(0, 1, 2), n_factors=(1, 2),
+                         designs=('nested', 'crossed'))
+out = run_benchmarks(configs, path="lmm_benchmark.json", n_repeats=3)
+
+rows = []
+for res in out['results']:
+    row = dict((key, res[key]) for key in ['n_obs', 'n_groups', 'n_slopes', 
+                                           'n_factors', 'design', 'n_ranef'])
+    for key, val in res['times'].items():
+        row[f"{key}_time"] = min(val)
+        row[f"{key}_mem_mb"] = res['peak_memory'][key] / 2**20
+    rows.append(row)
+summary = pd.DataFrame(rows)
+print(summary)
@@ -47,15 +47,15 @@ thresh = np.pad(tau_star, ((1, 1)), mode='constant', constant_values=[-np.inf, n
 df['y'] = pd.cut(mu, thresh).codes.astype(float)
 
 plot_kws = dict(var_names=['$\\theta$'], coords={"$\\theta$_dim_0":[0]})
-sampling_kws = dict(damping=0.99, adaption_rate=1.025, n_adapt=6000, save_u=True)
+sampling_kws = dict(damping=0.99, adaption_rate=1.025, n_adapt=6000)
 
 model = MixedMCMC("y~1+x1+x2+(1+x2|id1)", df, response_dist='ordinal_probit', freeR=False)
 model.priors["R"] = dict(V=1, n=1)
-model.sample(n_samples=22_000, burnin=6_000, n_chains=8, sampling_kws=sampling_kws)
+model.sample(n_samples=22_000, burnin=6_000, n_chains=8, save_u=True,
+             sampling_kws=sampling_kws)
 print(model.summary)
 
-u_hat = np.concatenate([model.samples_a[i]['u'][:, np.newaxis] for i in  model.samples_a.keys()], axis=1)
-u_hat = np.mean(u_hat, axis=(0, 1))
+u_hat = np.mean(model.secondary_samples['u'], axis=(0, 1))
 linpred = model.X.dot(model.beta) + model.Z.dot(u_hat)
 np.vstack((np.pad(model.tau, (1, 0)), (tau_star-tau_star.min())/s)).T
 
@@ -0,0 +1,573 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 18:20:44 2026
+"""
+
+import patsy
+import numpy as np
+import scipy as sp
+import scipy.stats
+import scipy.linalg
+import scipy.optimize
+import scipy.sparse
+import pandas as pd
+from .smooth_setup import (parse_smooths, get_parametric_formula,
+                           get_smooth_terms, get_smooth_matrices,
+                           discretize_covariate, discrete_index)
+from ..pyglm.families import Gaussian
+from ..utilities.splines import (crspline_basis, bspline_basis, ccspline_basis,
+                                 absorb_constraints)
+from ..utilities.numerical_derivs import so_gc_cd
+
+# matches the constructor get_smooth uses for each kind of smooth
+BASIS_METHODS = {"cr":crspline_basis, "cc":bspline_basis, "bs":ccspline_basis}
+LOG_SP_BOUND = 25.0
+
+
+def data_chunks(data, chunk_size):
+    """
+    Parameters
+    ----------
+    data: dataframe or callable
+        Dataframe, or a function returning a new iterable of dataframes
+
+    chunk_size: int
+        Number of rows per chunk of a dataframe
+
+    Returns
+    -------
+    chunks: iterable of dataframes
+        Consecutive row blocks of the data
+
+    """
+    if callable(data):
+        return data()
+    return (data.iloc[i:i+chunk_size] for i in range(0, data.shape[0], chunk_size))
+
+
+class BAM:
+
+    def __init__(self, formula, data, family=None, chunk_size=50_000,
+                 setup_data=None, basis_path=None, discrete=False,
+                 n_bins=1000):
+        """
+        parameters
+        ----------
+
+        formula: str
+            Formula for model
+
+        data: dataframe or callable
+            Model data, or a function returning a new iterable of dataframe
+            chunks each time it is called, for example
+            lambda: pd.read_csv(path, chunksize=10**6)
+
+        family: Family, optional
+            Model family. Defaults to Gaussian.
+
+        chunk_size: int, optional
+            Number of rows of each block of the model matrix.  Defaults
+            to 50,000
+
+        setup_data: dataframe, optional
+            Data used to place knots and set the identifiability
+            constraints and initial smoothing parameters, which should
+            span the range of each smoothed variable.  Defaults to data,
+            or its first chunk when data is callable
+
+        basis_path: str, optional
+            File the model matrix and response are written to on the first
+            pass over the data, after which they are read back in blocks
+            through a memory map instead of being rebuilt
+
+        discrete: bool, optional
+            Whether to evaluate each smooth basis only at the discretized
+            values of its covariate, keeping integer index vectors into
+            them, so cross products are formed without the n by nx model
+            matrix.  Defaults to False
+
+        n_bins: int, optional
+            Largest number of distinct covariate values kept by a smooth
+            when discrete; covariates with more are rounded to the nearest
+            point of an evenly spaced grid of n_bins values over the range
+            of the setup data.  Defaults to 1000
+
+        """
+        if family is None:
+            family = Gaussian()
+        if setup_data is None:
+            setup_data = next(iter(data())) if callable(data) else data
+        smooth_info = parse_smooths(formula, setup_data)
+        formula = get_parametric_formula(formula)
+        y, Xp = patsy.dmatrices(formula, setup_data, return_type='dataframe', eval_env=1)
+        smooths, n_smooth_terms, n_total_params, varnames = get_smooth_terms(
+                                                                smooth_info, Xp)
+        X, S, ranks, ldS = get_smooth_matrices(Xp, smooths, n_smooth_terms,
+                                               n_total_params)
+        X = np.concatenate(X, axis=1)
+        self.design_info = [y.design_info, Xp.design_info]
+        self.S, self.ranks, self.ldS = S, ranks, ldS
+        self.f, self.smooths = family, smooths
+        self.ns, self.nx = n_smooth_terms, n_total_params
+        self.mp = self.nx - np.sum(self.ranks)
+        self.data, self.chunk_size, self.basis_path = data, chunk_size, basis_path
+        self.n_obs, self.discrete, self.n_bins = None, discrete, n_bins
+        self.n_parametric = Xp.shape[1]
+        theta = np.zeros(self.ns+1)
+        for i, (var, s) in enumerate(smooths.items()):
+            ix = smooths[var]['ix']
+            a = np.diag(self.S.blocks[i])
+            d = np.diag(X[:, ix].T.dot(X[:, ix]))
+            lam = (1.5 * (d / a)[a>0]).mean()
+            theta[i] = np.log(lam)
+            varnames += [f"log_smooth_{var}"]
+            # setup sized arrays are not needed once the bases are defined
+            for key in ['X', 'x0', 'xm']:
+                s.pop(key, None)
+            if discrete:
+                s['xd'] = discretize_covariate(setup_data[s['var']].values, n_bins)
+                s['Xd'] = self.smooth_basis(s, s['xd'])
+        theta[-1] = 1.0
+        varnames += ["log_scale"]
+        self.theta = theta
+        self.varnames = varnames
+        self.smooth_info = smooth_info
+
+    def model_matrix(self, data, response=True):
+        """
+        Parameters
+        ----------
+        data: dataframe
+            Block of data
+
+        response: bool, optional
+            Whether to also return the response.  Defaults to True
+
+        Returns
+        -------
+        X: array of shape (n, nx)
+            Model matrix of the block, using the knots and constraints
+            of the setup data
+
+        y: array of shape (n, )
+            Response, if requested
+
+        """
+        if response:
+            y, Xp = patsy.build_design_matrices(self.design_info, data)
+        else:
+            Xp, = patsy.build_design_matrices(self.design_info[1:], data)
+        X = [np.asarray(Xp)]
+        for key, s in self.smooths.items():
+            Xi = self.smooth_basis(s, data[s['var']].values)
+            if s['by_cat'] is not None:
+                Xi = Xi * (data[s['by_var']].values==s['by_cat']).reshape(-1, 1)
+            X.append(Xi)
+        X = np.concatenate(X, axis=1)
+        if response:
+            return X, np.asarray(y)[:, 0]
+        return X
+
+    @staticmethod
+    def smooth_basis(s, x):
+        Xi = BASIS_METHODS[s['kind']](x, s['knots'], **s['fkws'])
+        Xi, _ = absorb_constraints(s['q'], X=Xi)
+        return Xi
+
+    def discrete_matrices(self, data, response=True):
+        """
+        Parameters
+        ----------
+        data: dataframe
+            Block of data
+
+        response: bool, optional
+            Whether to also return the response.  Defaults to True
+
+        Returns
+        -------
+        Xp: array of shape (n, n_parametric)
+            Parametric columns of the model matrix
+
+        K: array of shape (n, ns)
+            Index of the discretized covariate value of each smooth
+
+        B: array of shape (n, ns)
+            Row multipliers of each smooth, the by variable indicator or one
+
+        y: array of shape (n, )
+            Response, if requested
+
+        """
+        if response:
+            y, Xp = patsy.build_design_matrices(self.design_info, data)
+        else:
+            Xp, = patsy.build_design_matrices(self.design_info[1:], data)
+        n = Xp.shape[0]
+        K, B = np.zeros((n, self.ns), dtype=np.int32), np.ones((n, self.ns))
+        for i, (key, s) in enumerate(self.smooths.items()):
+            K[:, i] = discrete_index(data[s['var']].values, s['xd'])
+            if s['by_cat'] is not None:
+                B[:, i] = data[s['by_var']].values==s['by_cat']
+        if response:
+            return np.asarray(Xp), K, B, np.asarray(y)[:, 0]
+        return np.asarray(Xp), K, B
+
+    def linear_predictor(self, chunk, beta):
+        """
+        Parameters
+        ----------
+        chunk: tuple
+            Block yielded by chunks
+
+        beta: array of shape (nx, )
+            Coefficients
+
+        Returns
+        -------
+        eta: array of shape (n, )
+            Linear predictor of the block, which for discretized blocks
+            looks up each smooth's basis times its coefficients at the
+            discretized covariate values
+
+        """
+        if not self.discrete:
+            return chunk[0].dot(beta)
+        Xp, K, B = chunk[:3]
+        eta = Xp.dot(beta[:self.n_parametric])
+        for i, s in enumerate(self.smooths.values()):
+            eta += B[:, i] * s['Xd'].dot(beta[s['ix']])[K[:, i]]
+        return eta
+
+    def _split_chunk(self, F, K):
+        if self.discrete:
+            p = self.n_parametric
+            return F[:, :p], K, F[:, p:-1], F[:, -1]
+        return F[:, :-1], F[:, -1]
+
+    def chunks(self):
+        """
+        Returns
+        -------
+        chunks: generator
+            Blocks (X, y) of the model matrix and response, or when
+            discrete blocks (Xp, K, B, y) from discrete_matrices, read
+            from basis_path once it has been written
+
+        Notes
+        -----
+        When discrete the integer indices are cached in basis_path + '.idx'
+
+        """
+        nf = self.n_parametric + self.ns + 1 if self.discrete else self.nx + 1
+        idx_path = None if self.basis_path is None else self.basis_path + ".idx"
+        if self.basis_path is not None and self.n_obs is not None:
+            F = np.memmap(self.basis_path, dtype=np.float64, mode='r',
+                          shape=(self.n_obs, nf))
+            if self.discrete:
+                K = np.memmap(idx_path, dtype=np.int32, mode='r',
+                              shape=(self.n_obs, self.ns))
+            for i in range(0, self.n_obs, self.chunk_size):
+                Ki = np.asarray(K[i:i+self.chunk_size]) if self.discrete else None
+                yield self._split_chunk(np.asarray(F[i:i+self.chunk_size]), Ki)
+            return
+        f = open(self.basis_path, 'wb') if self.basis_path is not None else None
+        g = open(idx_path, 'wb') if f is not None and self.discrete else None
+        n_obs = 0
+        try:
+            for data in data_chunks(self.data, self.chunk_size):
+                if self.discrete:
+                    Xp, K, B, y = self.discrete_matrices(data)
+                    chunk, F = (Xp, K, B, y), [Xp, B, y.reshape(-1, 1)]
+                else:
+                    X, y = self.model_matrix(data)
+                    chunk, F = (X, y), [X, y.reshape(-1, 1)]
+                if f is not None:
+                    np.concatenate(F, axis=1).tofile(f)
+                if g is not None:
+                    K.tofile(g)
+                n_obs += len(y)
+                yield chunk
+        finally:
+            for h in [f, g]:
+                if h is not None:
+                    h.close()
+        self.n_obs = n_obs
+
+    def get_wz(self, y, eta):
+        """
+        Parameters
+        ----------
+        y: array of shape (n, )
+            Response of a block
+
+        eta: array of shape (n, )
+            Linear predictor X*beta
+
+        Returns
+        -------
+        z: array of shape (n, )
+            Pseudo data / working variate
+            z = eta + (y - mu) dg(mu)
+
+        w: array of shape (n, )
+            Fisher regression weights, which unlike the Newton weights used
+            by GAM stay positive and give a Pearson type scale estimate
+
+        """
+        mu = self.f.inv_link(eta)
+        v0, g1 = self.f.var_func(mu=mu), self.f.dlink(mu)
+        z = eta + (y - mu) * g1
+        w = 1.0 / (g1**2 * v0)
+        return z, w
+
+    def accumulate(self, beta=None):
+        """
+        Parameters
+        ----------
+        beta: array of shape (nx, ), optional
+            Coefficients at which the working model is formed.  Defaults to
+            None, which starts from eta = g(y)
+
+        Returns
+        -------
+        XtWX: array of shape (nx, nx)
+            Weighted cross product of the model matrix
+
+        XtWz: array of shape (nx, )
+            Weighted cross product of the model matrix and working variate
+
+        ztWz: float
+            Weighted sum of squares of the working variate
+
+        dev: float
+            Deviance at beta
+
+        Notes
+        -----
+        A single pass over the blocks, so memory scales with nx^2 and the
+        block size rather than with the number of observations
+
+        When discrete, the weights of each block are first summed over the
+        discretized covariate values, by _discrete_cross_products
+
+        """
+        XtWX, XtWz = np.zeros((self.nx, self.nx)), np.zeros(self.nx)
+        ztWz, dev = 0.0, 0.0
+        for chunk in self.chunks():
+            y = chunk[-1]
+            eta = self.f.link(y) if beta is None else self.linear_predictor(chunk, beta)
+            z, w = self.get_wz(y, eta)
+            if self.discrete:
+                self._discrete_cross_products(chunk, w, z, XtWX, XtWz)
+            else:
+                X = chunk[0]
+                Xw = X * w.reshape(-1, 1)
+                XtWX += Xw.T.dot(X)
+                XtWz += Xw.T.dot(z)
+            ztWz += np.dot(w * z, z)
+            if beta is not None:
+                dev += self.f.deviance(y, mu=self.f.inv_link(eta)).sum()
+        return XtWX, XtWz, ztWz, dev
+
+    def _discrete_cross_products(self, chunk, w, z, XtWX, XtWz):
+        """
+        Adds a discretized block to XtWX and XtWz in place.  With Xd_j the
+        basis of smooth j at its m_j discretized values, k_j its indices
+        and b_j its row multipliers, the (j, k) block of XtWX is
+        Xd_j' C_jk Xd_k for the m_j by m_k matrix C_jk of weights w*b_j*b_k
+        summed over rows sharing the index pair (k_j, k_k), and the
+        parametric blocks use the m_j by n_parametric sums of w*b_j*Xp, so
+        no n by p smooth basis is ever formed.
+        """
+        Xp, K, B = chunk[:3]
+        n, p = Xp.shape
+        rows = np.arange(n)
+        Xpw = Xp * w.reshape(-1, 1)
+        XtWX[:p, :p] += Xpw.T.dot(Xp)
+        XtWz[:p] += Xpw.T.dot(z)
+        smooths = list(self.smooths.values())
+        for j, sj in enumerate(smooths):
+            ixj, Xdj, mj = sj['ix'], sj['Xd'], len(sj['xd'])
+            wj = w * B[:, j]
+            Cj = sp.sparse.csr_matrix((wj, (K[:, j], rows)), shape=(mj, n))
+            XtWX[ixj, :p] += Xdj.T.dot(Cj.dot(Xp))
+            XtWX[:p, ixj] = XtWX[ixj, :p].T
+            XtWz[ixj] += Xdj.T.dot(np.bincount(K[:, j], weights=wj * z, minlength=mj))
+            cjj = np.bincount(K[:, j], weights=wj * B[:, j], minlength=mj)
+            XtWX[ixj, ixj[:, None]] += (Xdj.T * cjj).dot(Xdj)
+            for k in range(j):
+                sk = smooths[k]
+                ixk, Xdk, mk = sk['ix'], sk['Xd'], len(sk['xd'])
+                Cjk = sp.sparse.csr_matrix((wj * B[:, k], (K[:, j], K[:, k])),
+                                           shape=(mj, mk))
+                XtWX[ixk[:, None], ixj] += Xdk.T.dot(Cjk.T.dot(Xdj))
+                XtWX[ixj[:, None], ixk] = XtWX[ixk[:, None], ixj].T
+
+    def get_penalty_mat(self, lam):
+        Sa = self.S.penalty_mat(lam)
+        return Sa
+
+    def _working_state(self, theta, XtWX, XtWz, ztWz):
+        lam, phi = np.exp(theta[:-1]), np.exp(theta[-1])
+        S = self.get_penalty_mat(lam)
+        c = sp.linalg.cho_factor(XtWX + S, lower=True)
+        beta = sp.linalg.cho_solve(c, XtWz)
+        Dp = ztWz - beta.dot(XtWz)
+        ldh = 2.0 * np.sum(np.log(np.diag(c[0])))
+        return lam, phi, c, beta, Dp, ldh
+
+    def reml(self, theta, XtWX, XtWz, ztWz):
+        """
+        Parameters
+        ----------
+        theta: array of shape (ns+1,)
+            Log smoothing parameters and log scale
+
+        XtWX, XtWz, ztWz: arrays
+            Working model cross products from accumulate
+
+        Returns
+        -------
+        L: float
+            REML criterion of the working linear model
+
+        """
+        lam, phi, c, beta, Dp, ldh = self._working_state(theta, XtWX, XtWz, ztWz)
+        lds = np.sum(np.array(self.ranks) * np.log(lam)) + np.sum(self.ldS)
+        nu = self.n_obs - self.mp
+        L = (Dp / phi + ldh - lds + nu * np.log(phi) + self.n_obs * np.log(2.0*np.pi)) / 2.0
+        return L
+
+    def gradient(self, theta, XtWX, XtWz, ztWz):
+        """
+        Parameters
+        ----------
+        theta: array of shape (ns+1,)
+            Log smoothing parameters and log scale
+
+        XtWX, XtWz, ztWz: arrays
+            Working model cross products from accumulate
+
+        Returns
+        -------
+        g: array of shape (ns+1, )
+            Derivative of the working REML criterion with respect to theta
+
+        """
+        lam, phi, c, beta, Dp, ldh = self._working_state(theta, XtWX, XtWz, ztWz)
+        A = sp.linalg.cho_solve(c, np.eye(self.nx))
+        g = np.zeros_like(theta)
+        for i in range(self.ns):
+            g[i] = lam[i] * (self.S.quad(i, beta) / phi + self.S.trace(i, A)) - self.ranks[i]
+        g[-1] = -Dp / phi + self.n_obs - self.mp
+        g /= 2.0
+        return g
+
+    def fit(self, n_iters=100, tol=1e-8, opt_kws={}, confint=95, verbose=False):
+        """
+        Parameters
+        ----------
+        n_iters: int, optional
+            Maximum number of passes over the data.  Defaults to 100
+
+        tol: float, optional
+            Tolerance for the relative change in deviance between passes.
+            Defaults to 1e-8
+
+        opt_kws: dict, optional
+            scipy.optimize.minimize keyword arguments.  By default the log
+            smoothing parameters are bounded by LOG_SP_BOUND, beyond which
+            the penalized cross product loses positive definiteness in
+            floating point before the fit changes
+
+        confint: int, float, optional
+            Confidence intervals for summary table
+
+        verbose: bool, optional
+            Whether to print the deviance after each pass
+
+        Notes
+        -----
+        Performance iteration: each pass over the data accumulates the
+        working linear model at the current coefficients, whose REML
+        criterion is minimized over the smoothing parameters and scale
+        using only nx by nx quantities, giving the coefficients for the
+        next pass.  For a Gaussian identity link model the working model
+        is the model itself, and the fit matches GAM.
+
+        """
+        theta, beta, dev_prev = self.theta.copy(), None, np.inf
+        bounds = dict(bounds=[(-LOG_SP_BOUND, LOG_SP_BOUND)]*self.ns+[(None, None)])
+        self.converged = False
+        for i in range(n_iters):
+            XtWX, XtWz, ztWz, dev = self.accumulate(beta)
+            if verbose and beta is not None:
+                print(i, dev)
+            if beta is not None and abs(dev - dev_prev) / (abs(dev) + 0.1) < tol:
+                self.converged = True
+                break
+            opt = sp.optimize.minimize(self.reml, theta, args=(XtWX, XtWz, ztWz),
+                                       jac=self.gradient, method='L-BFGS-B',
+                                       **dict(bounds, **opt_kws))
+            theta = opt.x
+            beta, dev_prev = self._working_state(theta, XtWX, XtWz, ztWz)[3], dev
+        lam, scale, c, beta, Dp, _ = self._working_state(theta, XtWX, XtWz, ztWz)
+        A = sp.linalg.cho_solve(c, np.eye(self.nx))
+        Vb = A * scale
+        Vp = np.linalg.inv(so_gc_cd(self.gradient, theta, args=(XtWX, XtWz, ztWz)))
+        Jb = np.zeros((self.nx, self.ns))
+        for j in range(self.ns):
+            Jb[:, j] = -lam[j] * A.dot(self.S.dot(j, beta))
+        Vc = Vb + Jb.dot(Vp[:-1, :-1]).dot(Jb.T)
+        F = A.dot(XtWX)
+        self.n_iters, self.opt, self.theta, self.scale = i, opt, theta, scale
+        self.beta, self.dev, self.Slambda = beta, dev, self.get_penalty_mat(lam)
+        self.Vb, self.Vp, self.Vc, self.F = Vb, Vp, Vc, F
+        self.edf, self.Hbeta = np.trace(F), XtWX
+
+        s_table = {}
+        for term in self.smooths.keys():
+            ix = self.smooths[term]['ix']
+            b = self.beta[ix]
+            Tr = b.dot(np.linalg.pinv(self.Vb[ix, ix[:, None]])).dot(b)
+            edf = np.sum(self.F[ix, ix])
+            r = np.floor(edf) if (edf - np.floor(edf)) < 0.05 else np.ceil(edf)
+            s_table[term] = {"edf":edf, "rdf":r, "chisq":Tr,
+                             "p_approx":sp.stats.chi2(r).sf(Tr)}
+        self.res_smooths = pd.DataFrame(s_table).T
+
+        b, se = self.beta, np.sqrt(np.diag(self.Vc))
+        b = np.concatenate((b, self.theta))
+        se = np.concatenate((se, np.sqrt(np.diag(self.Vp))))
+        c = sp.stats.norm(0, 1).ppf(1-(100-confint)/200)
+        t = b/se
+        p = sp.stats.t(self.edf).sf(np.abs(t))
+        res = np.vstack((b, b-c*se, b+c*se, se, t, p)).T
+        self.res = pd.DataFrame(res, index=self.varnames,
+                                columns=['param', f'CI{confint}-', f'CI{confint}+',
+                                         'SE', 't', 'p'])
+
+    def predict(self, data=None, chunk_size=None):
+        """
+        Parameters
+        ----------
+        data: dataframe, optional
+            Data to predict, processed in blocks.  Defaults to the model data
+
+        chunk_size: int, optional
+            Number of rows per block.  Defaults to the model chunk_size
+
+        Returns
+        -------
+        mu: array
+            Fitted mean
+
+        """
+        chunk_size = self.chunk_size if chunk_size is None else chunk_size
+        if data is None:
+            eta = [self.linear_predictor(chunk, self.beta) for chunk in self.chunks()]
+        else:
+            eta = [self.model_matrix(chunk, response=False).dot(self.beta)
+                   for chunk in data_chunks(data, chunk_size)]
+        return self.f.inv_link(np.concatenate(eta))
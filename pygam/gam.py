@@ -19,6 +19,9 @@ from ..utilities.splines import (crspline_basis, bspline_basis, ccspline_basis,
                                  absorb_constraints)
 
 from ..utilities.numerical_derivs import so_gc_cd
+from ..utilities.eval_cache import EvalCache
+
+WARM_START_RADIUS = 5.0
 
 def wcrossp(X, w):
     Y =  (X * w.reshape(-1, 1)).T.dot(X)
@@ -57,10 +60,12 @@ class GAM:
         self.ns, self.n_obs, self.nx = n_smooth_terms, Xp.shape[0], n_total_params
         self.mp = self.nx - np.sum(self.ranks)
         self.data = data
+        self.cache = EvalCache()
+        self.n_warm_starts, self.n_pirls_iters = 0, 0
         theta = np.zeros(self.ns+1)
         for i, (var, s) in enumerate(smooths.items()):
             ix = smooths[var]['ix']
-            a = self.S[i][ix, ix[:, None].T]
+            a = np.diag(self.S.blocks[i])
             d = np.diag(self.X[:, ix].T.dot(self.X[:, ix]))
             lam = (1.5 * (d / a)[a>0]).mean()
             theta[i] = np.log(lam)
@@ -119,7 +124,7 @@ class GAM:
         beta_new = np.linalg.solve(Xw.T.dot(self.X)+S, Xw.T.dot(z))
         return beta_new
         
-    def pirls(self, lam, n_iters=200, tol=1e-12):
+    def pirls(self, lam, n_iters=200, tol=1e-12, beta_init=None):
         """
         Parameters
         ----------
@@ -133,6 +138,11 @@ class GAM:
         tol: float, optional, default=1e-12
             Tolerance for change in deviance over iterations before
             convergence is declared
+        
+        beta_init: array of shape (nx, ), optional
+            Coefficients to start from, e.g. the solution at nearby
+            smoothing parameters.  Defaults to None, which starts
+            from eta = g(y)
                     
         Returns
         -------
@@ -160,6 +170,10 @@ class GAM:
         dev_prev = 1e16 #self.f.deviance(self.y, mu=self.f.inv_link(eta)).sum()
         convergence = False
         beta_prev = np.zeros(self.X.shape[1])
+        if beta_init is not None:
+            beta_prev, eta_prev = beta_init, self.X.dot(beta_init)
+            mu = self.f.inv_link(eta_prev)
+            dev_prev = self.f.deviance(self.y, mu=mu).sum()+beta_init.T.dot(S).dot(beta_init)
         for i in range(n_iters):
             beta = self.solve_pls(eta_prev, S)
             eta = self.X.dot(beta)
@@ -183,6 +197,60 @@ class GAM:
             beta_prev, eta_prev, dev_prev = beta, eta, dev
         return beta, eta, mu, dev, convergence, i
 
+    def _rho_state(self, rho):
+        """
+        Parameters
+        ----------
+        rho: array of shape (ns, )
+            Log smoothing penalty
+        
+        Returns
+        -------
+        state: dict
+            PIRLS solution (beta, eta, mu, dev) at rho along with the
+            penalty and the Hessian of the penalized deviance, its inverse
+            and log determinant, shared by reml, gradient and hessian and
+            reused from the cache when rho was solved recently
+        
+        Notes
+        -----
+        A new rho starts PIRLS from the cached solution at the nearest
+        rho, so an outer step usually costs a few PIRLS iterations.  Rhos
+        further than WARM_START_RADIUS from any cached one start from
+        eta = g(y), as a distant solution, e.g. after a long step toward an
+        infinite smoothing parameter, can be a worse start than the data
+        """
+        if rho in self.cache:
+            return self.cache(rho)
+        nearest = self.cache.nearest(rho, 'beta')
+        state = self.cache(rho)
+        lam = np.exp(rho)
+        beta_init = None
+        if nearest is not None and np.linalg.norm(nearest['rho'] - rho) < WARM_START_RADIUS:
+            beta_init = nearest['beta']
+        self.n_warm_starts += beta_init is not None
+        beta, eta, mu, dev, convergence, i = self.pirls(lam, beta_init=beta_init)
+        self.n_pirls_iters += i + 1
+        S = self.get_penalty_mat(lam)
+        D2, Dp2 = self.hess_dev_beta(beta, S)
+        _, ldh = np.linalg.slogdet(Dp2)
+        state.update(rho=np.array(rho), beta=beta, eta=eta, mu=mu, dev=dev, convergence=convergence,
+                     S=S, D2=D2, Dp2=Dp2, A=np.linalg.inv(Dp2), ldh=ldh)
+        return state
+    
+    def pirls_info(self):
+        """
+        Returns
+        -------
+        info: dict
+            Hits and misses of the PIRLS cache, the number of PIRLS runs
+            warm started from a nearby rho and the total PIRLS iterations
+        
+        """
+        info = self.cache.info()
+        info.update(warm_starts=self.n_warm_starts, pirls_iters=self.n_pirls_iters)
+        return info
+    
     def get_penalty_mat(self, lam):
         """
         Parameters
@@ -196,7 +264,7 @@ class GAM:
             Smoothing penalty matrix
         
         """
-        Sa = np.einsum('i,ijk->jk', lam, self.S)
+        Sa = self.S.penalty_mat(lam)
         return Sa
     
     def logdetS(self, lam, phi):
@@ -242,8 +310,7 @@ class GAM:
         A = np.linalg.inv(2.0 * Dp2)
         dbdr = np.zeros((beta.shape[0], lam.shape[0]))
         for i in range(self.ns):
-            Si, ai = self.S[i], lam[i]
-            dbdr[:, i] = -ai * A.dot(Si.dot(beta))*2.0
+            dbdr[:, i] = -lam[i] * A.dot(self.S.dot(i, beta))*2.0
         return dbdr
     
     def hess_beta_rho(self, beta, lam):
@@ -270,14 +337,14 @@ class GAM:
         mu = self.f.inv_link(self.X.dot(beta))
         b2 = np.zeros((self.ns, self.ns, beta.shape[0]))
         for i in range(self.ns):
-            Si, ai, b1i = self.S[i], lam[i], b1[:, i]
+            ai, b1i = lam[i], b1[:, i]
             eta1i = self.X.dot(b1i)
             for j in range(i, self.ns):
-                Sj, aj, b1j = self.S[j], lam[j], b1[:, j]
+                aj, b1j = lam[j], b1[:, j]
                 eta1j = self.X.dot(b1j)
                 w1 = self.f.dw_deta(self.y, mu)
                 fij = 1.0 * eta1j * eta1i * w1
-                u = self.X.T.dot(fij) + ai * Si.dot(b1j) + aj * Sj.dot(b1i)
+                u = self.X.T.dot(fij) + ai * self.S.dot(i, b1j) + aj * self.S.dot(j, b1i)
                 b2[i, j] = b2[j, i] = (i==j)*b1[:, j] - A.dot(u)
         return b2         
     
@@ -347,13 +414,12 @@ class GAM:
 
         """
         lam, phi = np.exp(theta[:-1]), np.exp(theta[-1])
-        S = self.get_penalty_mat(lam)
-        beta, eta, mu, _, _, _ = self.pirls(lam)
-        D2, Dp2 = self.hess_dev_beta(beta, S)
+        state = self._rho_state(theta[:-1])
+        beta, mu, S = state['beta'], state['mu'], state['S']
         
         D = self.f.deviance(y=self.y, mu=mu).sum()
         P = beta.T.dot(S).dot(beta)
-        _, ldh = np.linalg.slogdet( Dp2 / phi)
+        ldh = state['ldh'] - self.nx * np.log(phi)
         lds = self.logdetS(lam, phi)
         Dp = (D + P) / phi
         K = ldh - lds
@@ -376,20 +442,18 @@ class GAM:
 
         """
         lam, phi = np.exp(theta[:-1]), np.exp(theta[-1])
-        S = self.get_penalty_mat(lam)
         X = self.X
-        beta, eta, mu, _, _, _ = self.pirls(lam)
-        D2, Dp2 = self.hess_dev_beta(beta, S)
-        A = np.linalg.inv(Dp2)
+        state = self._rho_state(theta[:-1])
+        beta, mu, S, A = state['beta'], state['mu'], state['S'], state['A']
         dw_deta = self.f.dw_deta(self.y, mu)
         b1 = self.grad_beta_rho(beta, lam)
         g = np.zeros_like(theta)
         for i in range(self.ns):
-            Si, ai, b1i = self.S[i], lam[i], b1[:, i]
+            ai, b1i = lam[i], b1[:, i]
             w1i = (dw_deta * X.dot(b1i)).reshape(-1, 1)
             H1 = (X * w1i).T.dot(X)
-            dbsb = beta.T.dot(Si).dot(beta) * ai / phi
-            dldh = np.trace(A.dot(Si*ai + H1))
+            dbsb = self.S.quad(i, beta) * ai / phi
+            dldh = self.S.trace(i, A) * ai + np.sum(A * H1)
             dlds = self.ranks[i]
             g[i] = dbsb + dldh - dlds
         
@@ -414,34 +478,38 @@ class GAM:
 
         """
         lam, phi = np.exp(theta[:-1]), np.exp(theta[-1])
-        X, S = self.X, self.get_penalty_mat(lam)
-        beta, eta, mu, _, _, _ = self.pirls(lam)
-        D2, Dp2 = self.hess_dev_beta(beta, S)
-        A = np.linalg.inv(Dp2)
+        X = self.X
+        state = self._rho_state(theta[:-1])
+        beta, mu, S = state['beta'], state['mu'], state['S']
+        Dp2, A = state['Dp2'], state['A']
         b1, b2 = self.grad_beta_rho(beta, lam), self.hess_beta_rho(beta, lam)
         dw_deta, d2w_deta2 = self.f.dw_deta(self.y, mu), self.f.d2w_deta2(self.y, mu)
         D2r =  b1.T.dot(Dp2).dot(b1)
         H = np.zeros((self.ns+1, self.ns+1))
         for i in range(self.ns):
-            Si, ai , b1i = self.S[i], lam[i], b1[:, i]
+            ai , b1i = lam[i], b1[:, i]
             eta1i = X.dot(b1i)
             w1i = dw_deta * eta1i
             H1i = wcrossp(X, w1i)
+            AH1i = A.dot(H1i) + ai * self.S.rdot(i, A)
+            bSib = self.S.quad(i, beta)
             for j in range(i, self.ns):
-                 Sj, aj, b1j, eta2 = self.S[j], lam[j], b1[:, j], X.dot(b2[i, j])
+                 aj, b1j, eta2 = lam[j], b1[:, j], X.dot(b2[i, j])
                  eta1j = self.X.dot(b1j)
                  w1j = dw_deta * eta1j
                  w2 = eta1j * eta1i * d2w_deta2 + dw_deta * eta2
                  H1j = wcrossp(X, w1j)
                  H2 = wcrossp(X, w2)
                  d = (i==j)
-                 ldh2 = -(np.trace(A.dot(H1i+Si*ai).dot(A).dot(H1j+aj*Sj))\
-                          -np.trace(A.dot(H2+d*ai*Si)))
-                 t1 = d * ai / (2.0 * phi) * beta.T.dot(Si).dot(beta)
+                 AH1j = A.dot(H1j) + aj * self.S.rdot(j, A)
+                 # tr(PQ) = sum(P * Q') avoids forming the product
+                 ldh2 = -(np.sum(AH1i * AH1j.T)\
+                          -np.sum(A * H2) - d * ai * self.S.trace(i, A))
+                 t1 = d * ai / (2.0 * phi) * bSib
                  t2 = -D2r[i, j] / (phi)
                  H[i, j] = H[j, i] = t1 + t2 + ldh2/2
                  if d:
-                     H[-1, j] = H[j, -1] = -np.dot(beta.T, Si.dot(beta)) * ai / (2*phi)
+                     H[-1, j] = H[j, -1] = -bSib * ai / (2*phi)
     
         Dp = self.f.deviance(y=self.y, mu=mu).sum() + beta.T.dot(S).dot(beta)
         ls1, ls2 = self.f.dllscale(phi, self.y), self.f.d2llscale(phi, self.y)
@@ -562,7 +630,8 @@ class GAM:
         theta = opt.x.copy()
         rho, logscale = theta[:-1], theta[-1]
         lambda_, scale = np.exp(rho), np.exp(logscale)
-        beta, eta, mu, dev, _, _ = self.pirls(lambda_)
+        state = self._rho_state(rho)
+        beta, eta, mu, dev = state['beta'], state['eta'], state['mu'], state['dev']
         _, w = self.get_wz(eta)
         X, Slambda = self.X, self.get_penalty_mat(lambda_)
         Hbeta = wcrossp(X, w)
@@ -79,7 +79,7 @@ class PredictorTerm:
         self.t_varnames = []
         for i, (var, s) in enumerate(smooths.items()):
             ix = smooths[var]['ix']
-            a = self.S[i][ix, ix[:, None].T]
+            a = np.diag(self.S.blocks[i])
             d = np.diag(self.X[:, ix].T.dot(self.X[:, ix]))
             lam = (1.5 * (d / a)[a>0]).mean()
             theta[i] = np.log(lam)
@@ -126,10 +126,8 @@ class GauLS:
         self.nxs = self.s.X.shape[1]
         self.nx = self.nxm+self.nxs
         self.ns = self.ns_m + self.ns_s
-        Sm, Ss = self.m.S.copy(), self.s.S.copy()
-        p, q = Sm.shape[1], Ss.shape[1]
-        Sm = np.pad(Sm, ((0, 0), (0, q), (0, q)))
-        Ss = np.pad(Ss, ((0, 0), (p, 0), (p, 0)))
+        Sm = self.m.S.shifted(0, self.nx)
+        Ss = self.s.S.shifted(self.nxm, self.nx)
         key = np.arange(self.ns)
         val = np.zeros(self.ns)
         val[:self.ns_m] = 0
@@ -141,7 +139,7 @@ class GauLS:
         self.hix = hix
         self.xix = dict(zip(key, val.astype(int)))
         self.X = {0:self.m.X, 1:self.s.X}
-        self.S = np.concatenate([Sm, Ss], axis=0)
+        self.S = Sm.concatenate(Ss)
         self.Xt = np.concatenate([self.m.X, self.s.X], axis=1)
         self.mp = self.m.mp + self.s.mp
         self.ranks = self.m.ranks + self.s.ranks
@@ -401,7 +399,7 @@ class GauLS:
             Model penalty matrix
             
         """
-        Sa = np.einsum('i,ijk->jk', lam, self.S)
+        Sa = self.S.penalty_mat(lam)
         return Sa
     
     def outer_step(self, S, beta_init=None, n_iters=200, tol=1e-11):
@@ -506,8 +504,7 @@ class GauLS:
         Hp = np.linalg.inv(H + S)
         dbdr = np.zeros((beta.shape[0], lam.shape[0]))
         for i in range(self.ns):
-            Si, ai = self.S[i], lam[i]
-            dbdr[:, i] = -ai * Hp.dot(Si.dot(beta))
+            dbdr[:, i] = -lam[i] * Hp.dot(self.S.dot(i, beta))
         return dbdr
     
     
@@ -614,11 +611,10 @@ class GauLS:
         dH = self.dhess(beta, lam)
         b2 = np.zeros((self.ns, self.ns, beta.shape[0]))
         for i in range(self.ns):
-            Si, b1i, ai = self.S[i], b1[:, i], lam[i]
+            b1i, ai = b1[:, i], lam[i]
             for j in range(i, self.ns):
-                b1j = b1[:, j]
-                Sj, aj = self.S[j], lam[j]
-                u = dH[i].dot(b1[:, j]) + ai * Si.dot(b1j) + aj * Sj.dot(b1i)
+                b1j, aj = b1[:, j], lam[j]
+                u = dH[i].dot(b1[:, j]) + ai * self.S.dot(i, b1j) + aj * self.S.dot(j, b1i)
                 b2[i, j] = b2[j, i] = (i==j)*b1i - Hp.dot(u)
         return b2
     
@@ -640,10 +636,8 @@ class GauLS:
             log determinant of penalty matrix
         """
         logdet = 0.0
-        for i, (r, lds) in enumerate(list(zip(self.m.ranks, self.m.ldS))):
+        for i, (r, lds) in enumerate(list(zip(self.S.ranks, self.S.ldS))):
             logdet += r * rho[i] + lds
-        for j, (r, lds) in enumerate(list(zip(self.s.ranks, self.s.ldS))):
-            logdet += r * rho[j+i+1] + lds    
         return logdet
     
     def reml(self, rho):
@@ -691,9 +685,9 @@ class GauLS:
         ldh = np.zeros_like(rho)
         lds = np.zeros_like(rho)
         for i in range(self.ns):
-            Si, ai = self.S[i], lam[i]
-            dbsb = beta.T.dot(Si).dot(beta) * ai
-            dldh = np.trace(A.dot(Si*ai + dH[i]))
+            ai = lam[i]
+            dbsb = self.S.quad(i, beta) * ai
+            dldh = self.S.trace(i, A) * ai + np.sum(A * dH[i])
             dlds = self.ranks[i]
             bsb[i] = dbsb
             ldh[i] = dldh
@@ -725,15 +719,16 @@ class GauLS:
         A = np.linalg.inv(Hp)
         D2r = b1.T.dot(Hp).dot(b1)
         H = np.zeros((self.ns, self.ns))
+        AH1 = [A.dot(dHb[i]) + lam[i] * self.S.rdot(i, A) for i in range(self.ns)]
         for i in range(self.ns):
-            Si, ai = self.S[i], lam[i]
+            ai = lam[i]
             for j in range(i, self.ns):
-                Sj, aj = self.S[j], lam[j]
                 d = (i==j)
-                H1i, H1j, H2ij = dHb[i], dHb[j], d2Hb[i, j]
-                ldh2 = -(np.trace(A.dot(H1i+Si*ai).dot(A).dot(H1j+aj*Sj))\
-                          -np.trace(A.dot(H2ij+d*ai*Si)))
-                t1 = d * ai / (2.0) * beta.T.dot(Si).dot(beta)
+                H2ij = d2Hb[i, j]
+                # tr(PQ) = sum(P * Q') avoids forming the product
+                ldh2 = -(np.sum(AH1[i] * AH1[j].T)\
+                          -np.sum(A * H2ij) - d * ai * self.S.trace(i, A))
+                t1 = d * ai / (2.0) * self.S.quad(i, beta)
                 t2 = -D2r[i, j]
                 H[i, j] = H[j, i] = t1 + t2 + ldh2/2
         return H
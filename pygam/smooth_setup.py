@@ -38,7 +38,7 @@ def parse_smooths(smoother_formula, data):
             finfo = by_design_mat.design_info.factor_infos
             cats = finfo[list(finfo.keys())[0]].categories
             smooth_info['by'] = dict(by_vals=by_design_mat.values,
-                                     by_cats=cats)
+                                     by_cats=cats, by_var=smooth_info['by'])
         smooths[var] = smooth_info
     return smooths
 
@@ -69,10 +69,11 @@ def get_smooth(x, df=10, kind="cr", by=None):
             smooth_list.append(dict(X=Xi, S=S, knots=knots, kind=kind, 
                                         q=q, sc=sc, fkws=fkws, x0=x0,
                                         xm=x0[x0!=0],
-                                        by_cat=by['by_cats'][i]))
+                                        by_cat=by['by_cats'][i],
+                                        by_var=by['by_var']))
     else:
         smooth_list = [dict(X=X, S=S, knots=knots, kind=kind, q=q, sc=sc, 
-                            fkws=fkws, x0=x, xm=None, by_cat=None)]
+                            fkws=fkws, x0=x, xm=None, by_cat=None, by_var=None)]
     return smooth_list
 
 def get_smooth_terms(smooth_info, Xp):
@@ -80,6 +81,8 @@ def get_smooth_terms(smooth_info, Xp):
     smooths, n_smooth_terms, n_total_params = {}, 0, n_parametric
     for key, val in smooth_info.items():
         slist = get_smooth(**val)
+        for x in slist:
+            x['var'] = key
         if len(slist)==1:
             smooths[key], = slist
             p_i = smooths[key]['X'].shape[1]
@@ -96,20 +99,165 @@ def get_smooth_terms(smooth_info, Xp):
                 n_smooth_terms += 1
     return smooths, n_smooth_terms, n_total_params, varnames
 
+class BlockPenalty:
+
+    def __init__(self, ix, blocks, n_params):
+        """
+        parameters
+        ----------
+
+        ix: list of arrays
+            Coefficient indices of each penalty
+
+        blocks: list of arrays
+            Dense penalty of each term over its own coefficients
+
+        n_params: int
+            Total number of coefficients
+
+        Notes
+        -----
+        Stores the penalties S_j as (ix_j, S_j) pairs rather than as a
+        (ns, nx, nx) tensor that is zero outside each term's block
+
+        """
+        self.ix, self.blocks, self.n_params = list(ix), list(blocks), n_params
+        self.ranks = [np.linalg.matrix_rank(Si) for Si in self.blocks]
+        self.ldS = []
+        for Si in self.blocks:
+            u = np.linalg.eigvals(Si)
+            self.ldS.append(np.log(u[u>np.finfo(float).eps]).sum())
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def shifted(self, offset, n_params):
+        """
+        Returns
+        -------
+        S: BlockPenalty
+            Penalties with their coefficient indices offset, as a part of
+            a model with n_params coefficients
+
+        """
+        return BlockPenalty([ix + offset for ix in self.ix], self.blocks, n_params)
+
+    def concatenate(self, other):
+        """
+        Returns
+        -------
+        S: BlockPenalty
+            Penalties of self followed by those of other, which must already
+            be indexed into the same coefficients
+
+        """
+        return BlockPenalty(self.ix + other.ix, self.blocks + other.blocks,
+                            self.n_params)
+
+    def penalty_mat(self, lam):
+        """
+        Parameters
+        ----------
+        lam: array of shape (ns, )
+            Smoothing penalty
+
+        Returns
+        -------
+        Sa: array of shape (nx, nx)
+            Smoothing penalty matrix sum_j lam_j S_j
+
+        """
+        Sa = np.zeros((self.n_params, self.n_params))
+        for lj, ix, Sj in zip(lam, self.ix, self.blocks):
+            Sa[ix[:, None], ix] += lj * Sj
+        return Sa
+
+    def dense(self, i):
+        """
+        Returns
+        -------
+        Si: array of shape (nx, nx)
+            S_i embedded in the full coefficient space
+
+        """
+        Si = np.zeros((self.n_params, self.n_params))
+        Si[self.ix[i][:, None], self.ix[i]] = self.blocks[i]
+        return Si
+
+    def dot(self, i, b):
+        """
+        Returns
+        -------
+        Sb: array of the same shape as b
+            S_i b, computed from the rows of b in the block of S_i
+
+        """
+        ix = self.ix[i]
+        Sb = np.zeros_like(b, dtype=float)
+        Sb[ix] = self.blocks[i].dot(b[ix])
+        return Sb
+
+    def quad(self, i, b):
+        """
+        Returns
+        -------
+        bSb: float
+            b' S_i b
+
+        """
+        bi = b[self.ix[i]]
+        return bi.dot(self.blocks[i]).dot(bi)
+
+    def rdot(self, i, A):
+        """
+        Returns
+        -------
+        AS: array of shape (nx, nx)
+            A S_i, which is zero outside the columns of the block of S_i
+
+        """
+        ix = self.ix[i]
+        AS = np.zeros((A.shape[0], self.n_params))
+        AS[:, ix] = A[:, ix].dot(self.blocks[i])
+        return AS
+
+    def trace(self, i, A):
+        """
+        Returns
+        -------
+        tr: float
+            tr(A S_i), from the block of A matching S_i
+
+        """
+        ix = self.ix[i]
+        return np.sum(A[ix[:, None], ix] * self.blocks[i].T)
+
+
 def get_smooth_matrices(Xp, smooths, n_smooth_terms, n_total_params):
-    X, ranks, ldS, start = [Xp], [], [], Xp.shape[1]
-    S = np.zeros((n_smooth_terms, n_total_params, n_total_params))
+    X, ixs, blocks, start = [Xp], [], [], Xp.shape[1]
     for i, (var, s) in enumerate(smooths.items()):
         p_i = s['X'].shape[1]
-        Si = np.zeros((n_total_params, n_total_params))
         ix = np.arange(start, start+p_i)
         start += p_i
-        Si[ix, ix.reshape(-1, 1)] = s['S']
-        smooths[var]['ix'], smooths[var]['Si'] = ix, Si
+        smooths[var]['ix'] = ix
         X.append(smooths[var]['X'])
-        S[i] = Si
-        ranks.append(np.linalg.matrix_rank(Si))
-        u = np.linalg.eigvals(s['S'])
-        ldS.append(np.log(u[u>np.finfo(float).eps]).sum())
-    return X, S, ranks, ldS
+        ixs.append(ix)
+        blocks.append(s['S'])
+    S = BlockPenalty(ixs, blocks, n_total_params)
+    return X, S, S.ranks, S.ldS
+
+
+def discretize_covariate(x, n_bins=1000):
+    # distinct values if there are few enough, else an evenly spaced grid
+    xd = np.unique(x)
+    if len(xd) > n_bins:
+        xd = np.linspace(xd[0], xd[-1], n_bins)
+    return xd
 
+def discrete_index(x, xd):
+    # index of the nearest value of xd for each element of x
+    if len(xd)==1:
+        return np.zeros(len(x), dtype=np.int32)
+    k = np.clip(np.searchsorted(xd, x), 1, len(xd)-1)
+    k = k - ((x - xd[k-1]) < (xd[k] - x))
+    return k.astype(np.int32)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 14:05:37 2026
+"""
+import json
+import time
+import platform
+import itertools
+import tracemalloc
+import numpy as np
+import scipy as sp
+from .lmm import LMM, inverse_transform_theta
+from .sim_lmm import MixedModelSim
+
+
+def make_benchmark_data(n_obs, n_groups, n_slopes=0, n_factors=1,
+                        design='nested', seed=0):
+    """
+    Parameters
+    ----------
+    n_obs : int
+        Number of observations, rounded down to a multiple of n_groups.
+    n_groups : int
+        Number of groups of the first grouping factor.
+    n_slopes : int, optional
+        Number of random slopes in each grouping factor. The default is 0.
+    n_factors : int, optional
+        Number of grouping factors. The default is 1.
+    design : str, optional
+        Either 'nested', in which factor k splits each group of factor k-1
+        in two, or 'crossed', in which factors after the first have n_groups
+        groups assigned to observations at random. The default is 'nested'.
+    seed : int, optional
+        Seed of the random number generator. The default is 0.
+
+    Returns
+    -------
+    formula : str
+        Model formula.
+    df : dataframe
+        Data simulated from the model with MixedModelSim.
+
+    """
+    rng = np.random.default_rng(seed)
+    n_obs = (n_obs // n_groups) * n_groups
+    re_vars = "+".join(["1"]+[f"z{j}" for j in range(1, n_slopes+1)])
+    re_terms = "+".join([f"({re_vars}|id{k})" for k in range(1, n_factors+1)])
+    formula = "y~x1+x2+" + re_terms
+    group_dict, ginfo, gcov = {}, {}, {}
+    for k in range(1, n_factors+1):
+        if k==1 or design=='nested':
+            n_grp = n_groups * 2**(k-1)
+            codes = np.arange(n_obs) * n_grp // n_obs
+        elif design=='crossed':
+            n_grp = n_groups
+            codes = rng.permutation(np.arange(n_obs) % n_grp)
+        else:
+            raise ValueError("design must be 'nested' or 'crossed'")
+        group_dict[f"id{k}"] = codes
+        ginfo[f"id{k}"] = dict(n_grp=len(np.unique(codes)), n_per=n_obs//n_grp)
+        gcov[f"id{k}"] = np.eye(n_slopes+1) * 0.5 + 0.5
+    model_dict = dict(gcov=gcov, ginfo=ginfo, mu=np.zeros(n_slopes+2),
+                      vcov=np.eye(n_slopes+2), beta=np.array([0.0, 1.0, -1.0]),
+                      n_obs=n_obs)
+    msim = MixedModelSim(formula, model_dict, rng=rng, group_dict=group_dict)
+    df = msim.df
+    df["y"] = msim.simulate_response(rsq=0.6, exact_ranefs=False)
+    return formula, df
+
+
+def _time_call(func, n_repeats):
+    times = []
+    for i in range(n_repeats):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def _max_rss_kb():
+    # resource is only available on unix
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _peak_memory(func):
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark_model(formula, df, stages=None, n_repeats=3, fit_kws=None):
+    """
+    Parameters
+    ----------
+    formula : str
+        Model formula.
+    df : dataframe
+        Data.
+    stages : list of str, optional
+        Subset of 'init', 'loglike', 'gradient', 'hessian' and 'fit' to
+        benchmark. The default is None, which runs all of them.
+    n_repeats : int, optional
+        Number of timed runs of each stage. The default is 3.
+    fit_kws : dict, optional
+        Arguments passed to LMM.fit. The default is None, which skips the
+        adjusted p-values.
+
+    Returns
+    -------
+    res : dict
+        Model dimensions and, for each stage, the wall times of every run in
+        seconds and the peak memory in bytes traced by tracemalloc during a
+        separate untimed run.
+
+    Notes
+    -----
+    tracemalloc only sees memory allocated through Python's allocators, 
+    which includes numpy arrays but not the factors and workspace CHOLMOD
+    or other C libraries allocate themselves, so the peak memory 
+    understates the real memory use of the sparse stages.
+    
+    The evaluation cache is cleared before every loglike, gradient and
+    hessian call so each stage is timed from a cold factorization at the
+    initial theta.
+    """
+    stages = ['init', 'loglike', 'gradient', 'hessian', 'fit'] if stages is None else stages
+    fit_kws = dict(adjusted_pvals=False) if fit_kws is None else fit_kws
+    model = LMM(formula, df)
+    theta_chol = model.theta_chol.copy()
+    theta = inverse_transform_theta(theta_chol.copy(), model.dims, model.indices)
+
+    def cold(method):
+        def func():
+            model.cache.clear()
+            method(theta.copy())
+        return func
+
+    funcs = dict(init=lambda: LMM(formula, df),
+                 loglike=cold(model.loglike),
+                 gradient=cold(model.gradient),
+                 hessian=cold(model.hessian),
+                 fit=lambda: model.fit(theta_init=theta_chol.copy(), **fit_kws))
+    res = dict(n_obs=model.X.shape[0], n_fixed=model.X.shape[1],
+               n_ranef=model.Zs.shape[1], n_theta=len(theta),
+               nnz_M=int(model.M.nnz), nnz_Q=int(model.Q.nnz), times={},
+               peak_memory={})
+    for stage in stages:
+        res['times'][stage] = _time_call(funcs[stage], n_repeats)
+        res['peak_memory'][stage] = _peak_memory(funcs[stage])
+    if 'fit' in stages:
+        res['fit_iterations'] = int(model.optimizer.nit)
+    return res
+
+
+def benchmark_grid(n_obs=(1000, 10000), n_groups=(10, 100), n_slopes=(0, 1),
+                   n_factors=(1, 2), designs=('nested', 'crossed')):
+    """
+    Returns
+    -------
+    configs : list of dict
+        Every combination of the given sizes, skipping those with fewer
+        than two observations per group and duplicate single factor designs.
+
+    """
+    configs = []
+    for n, g, s, k, d in itertools.product(n_obs, n_groups, n_slopes,
+                                           n_factors, designs):
+        if n < 2*g*2**(k-1) or (k==1 and d!=designs[0]):
+            continue
+        configs.append(dict(n_obs=n, n_groups=g, n_slopes=s, n_factors=k,
+                            design=d))
+    return configs
+
+
+def run_benchmarks(configs=None, path=None, stages=None, n_repeats=3, seed=0,
+                   fit_kws=None, verbose=True):
+    """
+    Parameters
+    ----------
+    configs : list of dict, optional
+        Arguments of make_benchmark_data for each design. The default is
+        None, which uses benchmark_grid().
+    path : str, optional
+        File the results are written to as JSON. The default is None.
+    stages, n_repeats, fit_kws : optional
+        Passed to benchmark_model.
+    seed : int, optional
+        Seed used to simulate every design. The default is 0.
+
+    Returns
+    -------
+    out : dict
+        Library versions and platform, the maximum resident set size of 
+        the process in kilobytes (None where the resource module is not 
+        available), along with the configuration and benchmark_model 
+        results of each design.
+
+    """
+    configs = benchmark_grid() if configs is None else configs
+    results = []
+    for config in configs:
+        formula, df = make_benchmark_data(seed=seed, **config)
+        res = dict(config, formula=formula)
+        res.update(benchmark_model(formula, df, stages, n_repeats, fit_kws))
+        results.append(res)
+        if verbose:
+            times = ", ".join([f"{key}={np.min(val):.3g}s" for key, val in res['times'].items()])
+            print(f"{config}: {times}")
+    out = dict(numpy=np.__version__, scipy=sp.__version__,
+               python=platform.python_version(), machine=platform.machine(),
+               processor=platform.processor(), n_repeats=n_repeats, seed=seed,
+               max_rss_kb=_max_rss_kb(),
+               results=results)
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(out, f, indent=2)
+    return out
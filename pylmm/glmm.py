@@ -13,12 +13,12 @@ import scipy.stats
 import scipy.sparse as sps
 from sksparse.cholmod import cholesky# analysis:ignore
 
-from ..utilities.linalg_operations import (_check_np, _check_shape,
-                                           _check_shape_nb, dummy,
-                                           invech)
-from .model_matrices import (construct_model_matrices, 
-                             create_gmats,make_theta,  update_gmat)
+from ..utilities.linalg_operations import (_check_np, _check_shape_nb,
+                                           invech, vech)
+from .model_matrices import construct_model_matrices, make_theta
 from ..utilities.output import get_param_table
+from ..utilities.eval_cache import EvalCache
+from ..utilities.numerical_derivs import so_gc_cd
 from ..pyglm.families import (Binomial, ExponentialFamily, Gamma, Gaussian,  # analysis:ignore
                        InverseGaussian, Poisson, NegativeBinomial)
 
@@ -40,6 +40,32 @@ def gh_rules(n, wn=True):
     f = sp.stats.norm(0, 1).logpdf(z)
     return z, w, f
 
+def agq_rules(n, n_vars=1):
+    """
+    Parameters
+    ----------
+    n : int
+        Number of Gauss-Hermite nodes per random effect.
+    n_vars : int, optional
+        Number of random effects per group. The default is 1.
+
+    Returns
+    -------
+    z : ndarray
+        n**n_vars by n_vars tensor product grid of nodes.
+    lw : ndarray
+        Log weights of the grid for integrating unweighted functions, i.e.
+        the log of the Hermite weights plus z'z/2, with nodes whose weights
+        underflow dropped.
+
+    """
+    z, w = sp.special.roots_hermitenorm(n)
+    keep = w > 0
+    z, lw = z[keep], np.log(w[keep]) + z[keep]**2 / 2.0
+    z = np.stack(np.meshgrid(*[z]*n_vars, indexing='ij'), axis=-1)
+    lw = np.sum(np.stack(np.meshgrid(*[lw]*n_vars, indexing='ij'), axis=-1), axis=-1)
+    return z.reshape(-1, n_vars), lw.reshape(-1)
+
 def vech2vec(vh):
     A = invech(vh)
     v = A.reshape(-1, order='F')
@@ -76,113 +102,323 @@ class GLMM_AGQ:
         self.f = family
         X, Z, y, dims = construct_model_matrices(formula, data)
         theta, indices = make_theta(dims)
-        Gmats, g_indices = create_gmats(theta, indices, dims)
-        Gmats_inverse, _ = create_gmats(theta, indices, dims, inverse=True)
-        G = sps.block_diag(list(Gmats.values())).tocsc()
-        Ginv =  sps.block_diag(list(Gmats_inverse.values())).tocsc()
         self.X = _check_shape_nb(_check_np(X), 2)
         self.y = _check_shape_nb(_check_np(y), 1)
         self.Z = Z
         self.Zs = sps.csc_matrix(Z)
         self.Zt = self.Zs.T
         group_var, = list(dims.keys())
-        self.J = dummy(data[group_var])
         n_vars = dims[group_var]['n_vars']
-        self.n_indices = data.groupby(group_var).indices
-        self.Xg, self.Zg, self.yg = {}, {}, {}
-        self.u_indices, self.c_indices = {}, {}
-        k = 0
-        for j, (i, ix) in enumerate(self.n_indices.items()):
-            self.Xg[i] = self.X[ix]
-            self.Zg[i] = self.Z[ix, j][:, None]
-            self.yg[i] = self.y[ix]
-            self.u_indices[i] = np.arange(k, k+n_vars)
-            self.c_indices[i] = (np.arange(k, k+n_vars)[:, None].T, 
-                                 np.arange(k, k+n_vars)[:, None])
-            k+=n_vars
-        self.n_groups = len(self.Xg)
+        _, self.codes = np.unique(data[group_var], return_inverse=True)
+        self.n_groups = dims[group_var]['n_groups']
         self.n, self.p = self.X.shape
         self.q = self.Z.shape[1]
+        self.n_vars = n_vars
+        cols = self.codes[:, None] * n_vars + np.arange(n_vars)
+        rows = np.repeat(np.arange(self.n), n_vars)
+        self.Zr = np.asarray(self.Zs.tocsr()[rows, cols.reshape(-1)]).reshape(self.n, n_vars)
+        self.Jt = sps.csr_matrix((np.ones(self.n), (self.codes, np.arange(self.n))),
+                                 shape=(self.n_groups, self.n))
+        self.weights = np.ones(self.n) * self.f.weights
         self.nt = len(theta)
         self.params = np.zeros(self.p+self.nt)
         self.params[-self.nt:] = theta
-        self.bounds = [(None, None) for i in range(self.p)]+\
-                 [(None, None) if int(x)==0 else (0, None) for x in theta]
-        
-        self.D = np.eye(n_vars)
-        self.W = sps.csc_matrix((np.ones(self.n), (np.arange(self.n), 
-                                                   np.arange(self.n))))
-        
-        self.G = G
-        self.Ginv = Ginv
-        self.g_indices = g_indices
+        mu0 = np.ones(self.n) * np.mean(self.y)
+        T0 = self.f.canonical_parameter(mu0)
+        self.llconst = -np.sum(self.f._full_loglike(self.y, mu=mu0)) - \
+                        np.sum(self.weights * (self.y * T0 - self.f.cumulant(T0)))
+        self.u = np.zeros((self.n_groups, n_vars))
+        self.cache = EvalCache()
         self.dims = dims
         self.indices = indices
     
-    def pirls(self, params):
+    def _group_sum(self, A):
+        return self.Jt.dot(A)
+    
+    def _eval_obs(self, eta):
+        mu = self.f.inv_link(eta)
+        dmu = self.f.dinv_link(eta)
+        v = self.f.var_func(mu=mu)
+        return mu, dmu, v
+    
+    def pirls(self, params, tol=1e-10, n_iters=100):
+        """
+        Parameters
+        ----------
+        params : ndarray
+            Fixed effects followed by the vech of the random effects 
+            covariance.
+        tol : float, optional
+            Tolerance for the largest Newton step. The default is 1e-10.
+        n_iters : int, optional
+            Maximum number of Newton steps. The default is 100.
+
+        Returns
+        -------
+        pirls_dict : dict
+            Conditional modes u of the random effects, an n_groups by n_vars
+            array started from the modes of the last call, the lower 
+            cholesky factors L of the n_groups blocks of the negative hessian
+            of the log joint density at u, the fixed effect linear predictor
+            Xb, and the inverse of the random effects covariance.
+
+        Notes
+        -----
+        The negative hessian Z'WZ+G^{-1} is block diagonal with one n_vars 
+        by n_vars block per group, so every Newton step is a batch of small
+        dense solves accumulated with the sparse group indicator matrix.
+        """
         beta, theta = params[:self.p], params[self.p:]
-        Psi_inv = update_gmat(theta, self.G.copy(), self.dims, self.indices, 
-                           self.g_indices, inverse=True)
-        D = cholesky(Psi_inv).L()
-        u = np.zeros(self.q)
+        Sigma_inv = np.linalg.inv(invech(theta))
         Xb = self.X.dot(beta)
-        for i in range(100):
-            eta = Xb + self.Z.dot(u)
-            mu = self.f.inv_link(eta)
-            var_mu = self.f.var_func(mu=mu)
-            self.W.data = var_mu
-            ZtWZ = self.Zt.dot(self.W.dot(self.Zs))
-            Ztr = self.Zt.dot(_check_shape(self.y, 1) - mu)
-            RtR, r = ZtWZ + Psi_inv, Ztr - Psi_inv.dot(u)
-            u_new = u + sps.linalg.spsolve(RtR, r)
-            diff = np.linalg.norm(u_new - u) / len(u)
-            if diff<1e-6:
+        u = self.u.copy()
+        Zr, m = self.Zr, self.n_vars
+        ZZ = (Zr[:, :, None] * Zr[:, None, :]).reshape(self.n, m * m)
+        for i in range(n_iters):
+            eta = Xb + np.sum(Zr * u[self.codes], axis=1)
+            mu, dmu, v = self._eval_obs(eta)
+            s = self.weights * (self.y - mu) * dmu / v
+            w = self.weights * dmu**2 / v
+            g = self._group_sum(Zr * s[:, None]) - u.dot(Sigma_inv)
+            H = self._group_sum(ZZ * w[:, None]).reshape(-1, m, m) + Sigma_inv
+            du = np.linalg.solve(H, g[:, :, None])[:, :, 0]
+            u = u + du
+            if np.max(np.abs(du))<tol:
                 break
-            u = u_new
-        eta = Xb + self.Zs.dot(u)
-        mu = self.f.inv_link(eta)
-        var_mu = self.f.var_func(mu=mu)
-        self.W.data = var_mu
-        ZtWZ = self.Zt.dot(self.W.dot(self.Zs))
-        Ztr = self.Zt.dot(self.y - mu)
-        RtR, r = ZtWZ + Psi_inv, Ztr - Psi_inv.dot(u)
-        Q = cholesky(RtR.tocsc()).L()
-        Qinv = sps.linalg.inv(Q)
-        return dict(u=u, D=D, Xb=Xb, Qinv=Qinv, Q=Q)
-    
-    def _dloglike(self, db, Xb, Qinv, D, u):
-        db = np.zeros(Qinv.shape[0]) + db
-        u_tilde = Qinv.dot(db) + u
-        eta = (self.Z.dot(u_tilde)) + Xb
-        mu = self.f.inv_link(eta)
-        T = self.f.canonical_parameter(mu)
-        bT = self.f.cumulant(T)
-        Du = D.dot(u_tilde)
-        ll = (np.exp((self.y * T - bT).dot(self.J) - Du**2 / 2))
-        return ll
+        eta = Xb + np.sum(Zr * u[self.codes], axis=1)
+        mu, dmu, v = self._eval_obs(eta)
+        w = self.weights * dmu**2 / v
+        H = self._group_sum(ZZ * w[:, None]).reshape(-1, m, m) + Sigma_inv
+        L = np.linalg.cholesky(H)
+        self.u = u
+        return dict(u=u, L=L, Xb=Xb, Sigma_inv=Sigma_inv)
+    
+    def _agq_state(self, params, nagq=20):
+        """
+        Parameters
+        ----------
+        params : ndarray
+            Fixed effects followed by the vech of the random effects 
+            covariance.
+        nagq : int, optional
+            Number of quadrature nodes per random effect. The default is 20.
 
+        Returns
+        -------
+        state : dict
+            Log likelihood, the random effects at every node of every group,
+            the normalized weights of the nodes within each group and the 
+            derivative of the conditional log likelihood with respect to eta
+            at every observation and node, along with the modes, the inverse
+            cholesky factors and the nodes they were placed with, reused 
+            from the cache when params was evaluated recently.
+
+        Notes
+        -----
+        With H = LL' the negative hessian of group g at its mode u, the
+        nodes are u + L^{-T}z and
+            log p(y_g) = log sum_k w_k exp(z_k'z_k/2) p(y_g, u_k) - log|L|
+        evaluated for all groups and nodes as n by n_nodes arrays.
+        """
+        state = self.cache(np.r_[params, nagq])
+        if 'll' in state:
+            return state
+        pirls_dict = self.pirls(params)
+        u, L, Xb = pirls_dict['u'], pirls_dict['L'], pirls_dict['Xb']
+        Sigma_inv = pirls_dict['Sigma_inv']
+        z, lw = agq_rules(nagq, self.n_vars)
+        Linv = np.linalg.inv(L)
+        B = u[:, None, :] + np.einsum('gji,kj->gki', Linv, z)
+        eta = Xb[:, None] + np.einsum('nj,nkj->nk', self.Zr, B[self.codes])
+        mu, dmu, v = self._eval_obs(eta)
+        T = self.f.canonical_parameter(mu)
+        w, y = self.weights[:, None], self.y[:, None]
+        with np.errstate(invalid='ignore'):
+            lnk = w * (y * T - self.f.cumulant(T))
+            dlnk = w * (y - mu) * dmu / v
+        ok = np.isfinite(lnk)
+        lnk, dlnk = np.where(ok, lnk, -np.inf), np.where(ok, dlnk, 0.0)
+        _, lndS = np.linalg.slogdet(Sigma_inv)
+        h = self._group_sum(lnk) + lw - np.einsum('gki,ij,gkj->gk', B, Sigma_inv, B) / 2.0
+        hmax = np.max(h, axis=1, keepdims=True)
+        ph = np.exp(h - hmax)
+        lse = np.log(np.sum(ph, axis=1)) + hmax[:, 0]
+        lndL = np.sum(np.log(np.diagonal(L, axis1=1, axis2=2)), axis=1)
+        ll = np.sum(lse - lndL) + self.n_groups * (lndS - self.n_vars * np.log(2.0 * np.pi)) / 2.0
+        state.update(ll=ll+self.llconst, B=B, P=ph/np.sum(ph, axis=1, keepdims=True),
+                     dlnk=dlnk, Sigma_inv=Sigma_inv, u=u, Linv=Linv, z=z, Xb=Xb)
+        return state
     
     def loglike(self, params, nagq=20):
-        pirls_dict = self.pirls(params)
-        z, w, f = gh_rules(nagq, False)
-        args = (pirls_dict['Xb'], pirls_dict['Qinv'], pirls_dict['D'], 
-                pirls_dict['u'])
-        sq2 = np.sqrt(2)
-        ll_i = np.sum([self._dloglike(z[i], *args) * w[i] 
-                     for i in range(len(w))], axis=0) * sq2
-        ll_i = np.log(ll_i)
-        lnd = np.linalg.slogdet(pirls_dict['D'].A)[1]\
-              -np.linalg.slogdet(pirls_dict['Q'].A)[1]
-        ll = -(np.sum(ll_i) + lnd)
-        return ll
+        """
+        Parameters
+        ----------
+        params : ndarray
+            Fixed effects followed by the vech of the random effects 
+            covariance.
+        nagq : int, optional
+            Number of quadrature nodes per random effect. The default is 20.
+
+        Returns
+        -------
+        ll : float
+            Negative log likelihood approximated by adaptive Gauss-Hermite
+            quadrature, which reduces to the Laplace approximation when 
+            nagq=1.
+
+        """
+        return -self._agq_state(params, nagq)['ll']
+    
+    def _obs_derivs(self, eta):
+        mu, dmu, v = self._eval_obs(eta)
+        d2mu, v1 = self.f.d2inv_link(eta), self.f.dvar_dmu(mu)
+        u = d2mu / v - dmu**2 * v1 / v**2
+        ds = self.weights * ((self.y - mu) * u - dmu**2 / v)
+        dw = self.weights * dmu * (u + d2mu / v)
+        return ds, dw
+    
+    def _gradient_parts(self, params, nagq=20):
+        """
+        Parameters
+        ----------
+        params : ndarray
+            Fixed effects followed by the vech of the random effects 
+            covariance.
+        nagq : int, optional
+            Number of quadrature nodes per random effect. The default is 20.
+
+        Returns
+        -------
+        gb : ndarray
+            Derivative of the log likelihood with respect to beta.
+        dS : ndarray
+            Derivative of the log likelihood with respect to the random 
+            effects covariance, as a symmetric matrix.
+        
+        Notes
+        -----
+        The nodes u_k = u + L^{-T}z_k move with params through the mode u 
+        and the factor L of H = Z'WZ+G^{-1}, so the derivative along a 
+        direction t is
+            sum_k P_k [d_t log p(y, u_k) + r_k'(du/dt + dL^{-T}/dt z_k)]
+            - tr(H^{-1} dH/dt)/2
+        with r_k the derivative of log p(y, u) with respect to u at u_k.
+        The first term is the score with the nodes held fixed. du/dt comes
+        from differentiating the mode equation, and with
+        C = L^{-1} dH/dt L^{-T}, dL^{-T}/dt = -L^{-T} Phi(C)' where Phi keeps
+        the lower triangle of C and halves its diagonal. Every direction, 
+        one per element of beta and of vech(G), is evaluated at once, with
+        the covariance directions converted to a symmetric matrix at the 
+        end.
+        """
+        state = self._agq_state(params, nagq)
+        B, P, Sigma_inv = state['B'], state['P'], state['Sigma_inv']
+        u, Linv, z, dlnk = state['u'], state['Linv'], state['z'], state['dlnk']
+        gb = self.X.T.dot(np.sum(dlnk * P[self.codes], axis=1))
+        A = np.einsum('gk,gki,gkj->ij', P, B, B)
+        dS = (Sigma_inv.dot(A).dot(Sigma_inv) - self.n_groups * Sigma_inv) / 2.0
+        
+        n, m, p, G, K = self.n, self.n_vars, self.p, self.n_groups, len(z)
+        nd = p + self.nt
+        Zr = self.Zr
+        eta = state['Xb'] + np.sum(Zr * u[self.codes], axis=1)
+        ds, dw = self._obs_derivs(eta)
+        ZZ = (Zr[:, :, None] * Zr[:, None, :]).reshape(n, m * m)
+        J = self._group_sum(ZZ * ds[:, None]).reshape(G, m, m) - Sigma_inv
+        # derivatives of G^{-1} along each element of vech(G)
+        E = np.zeros((self.nt, m, m))
+        rows, cols = np.tril_indices(m)
+        E[np.arange(self.nt), rows, cols] = E[np.arange(self.nt), cols, rows] = 1.0
+        dSinv = -np.einsum('ij,ljk,km->lim', Sigma_inv, E, Sigma_inv)
+        # derivative of the mode equation along each direction
+        dG = np.zeros((G, m, nd))
+        dG[:, :, :p] = self._group_sum((Zr[:, :, None] * (ds[:, None] * self.X)[:, None, :]
+                                        ).reshape(n, m * p)).reshape(G, m, p)
+        dG[:, :, p:] = -np.einsum('gi,lij->gjl', u, dSinv)
+        du = -np.linalg.solve(J, dG)
+        deta = np.einsum('ni,nid->nd', Zr, du[self.codes])
+        deta[:, :p] += self.X
+        dH = self._group_sum((ZZ[:, :, None] * (dw[:, None] * deta)[:, None, :]
+                              ).reshape(n, m * m * nd)).reshape(G, m, m, nd)
+        dH[..., p:] += np.moveaxis(dSinv, 0, -1)
+        # r_k weighted by P_k, summed over nodes and against the nodes
+        R = self._group_sum((Zr[:, None, :] * dlnk[:, :, None]).reshape(n, K * m))
+        PR = P[:, :, None] * (R.reshape(G, K, m) - B.dot(Sigma_inv))
+        T = np.einsum('gki,kj->gij', PR, z)
+        Hinv = np.einsum('gji,gjk->gik', Linv, Linv)
+        C = np.einsum('gia,gabd,gjb->gijd', Linv, dH, Linv)
+        Phi = C * (np.tril(np.ones((m, m)), -1) + np.eye(m) / 2.0)[:, :, None]
+        g = np.einsum('gi,gid->d', np.sum(PR, axis=1), du) \
+            - np.einsum('gij,gai,gjad->d', T, Linv, Phi) \
+            - np.einsum('gij,gijd->d', Hinv, dH) / 2.0
+        gb = gb + g[:p]
+        dS = dS + invech(g[p:] / vech(2.0 - np.eye(m)))
+        return gb, dS
+    
+    def gradient(self, params, nagq=20):
+        """
+        Parameters
+        ----------
+        params : ndarray
+            Fixed effects followed by the vech of the random effects 
+            covariance.
+        nagq : int, optional
+            Number of quadrature nodes per random effect. The default is 20.
+
+        Returns
+        -------
+        g : ndarray
+            Gradient of the negative log likelihood, including the movement
+            of the adaptive nodes with params, so it is the derivative of 
+            loglike for every nagq.
+        
+        """
+        gb, dS = self._gradient_parts(params, nagq)
+        gt = vech(dS * (2.0 - np.eye(self.n_vars)))
+        return -np.concatenate([gb, gt])
+    
+    def _params_to_chol(self, params):
+        L = np.linalg.cholesky(invech(params[self.p:]))
+        return np.concatenate([params[:self.p], vech(L)])
+    
+    def _chol_to_params(self, params_chol):
+        L = np.tril(invech(params_chol[self.p:]))
+        return np.concatenate([params_chol[:self.p], vech(L.dot(L.T))])
+    
+    def loglike_chol(self, params_chol, nagq=20):
+        return self.loglike(self._chol_to_params(params_chol), nagq)
+    
+    def gradient_chol(self, params_chol, nagq=20):
+        """
+        Parameters
+        ----------
+        params_chol : ndarray
+            Fixed effects followed by the vech of the cholesky factor of the
+            random effects covariance.
+        nagq : int, optional
+            Number of quadrature nodes per random effect. The default is 20.
+
+        Returns
+        -------
+        g : ndarray
+            Gradient of the negative log likelihood with respect to 
+            params_chol.
+
+        """
+        L = np.tril(invech(params_chol[self.p:]))
+        gb, dS = self._gradient_parts(self._chol_to_params(params_chol), nagq)
+        return -np.concatenate([gb, vech(2.0 * dS.dot(L))])
+    
+    def _loglike_grad_chol(self, params_chol, nagq=20):
+        return self.loglike_chol(params_chol, nagq), self.gradient_chol(params_chol, nagq)
     
     def fit(self, nagq=20):
-        self.optimizer = sp.optimize.minimize(self.loglike, self.params, 
-                                   bounds=self.bounds, 
-                                   options=dict(disp=1), args=(nagq,),
-                                   jac='3-point')
-        self.params = self.optimizer.x
-        self.hess_theta = approx_hess(self.loglike, self.optimizer.x)
+        self.optimizer = sp.optimize.minimize(self._loglike_grad_chol, 
+                                   self._params_to_chol(self.params), 
+                                   method='L-BFGS-B', options=dict(disp=1),
+                                   args=(nagq,), jac=True)
+        self.params = self._chol_to_params(self.optimizer.x)
+        self.hess_theta = so_gc_cd(self.gradient, self.params, args=(nagq,))
         self.se_params = np.sqrt(np.diag(np.linalg.inv(self.hess_theta)))
         self.res = get_param_table(self.params, self.se_params, 
                                    self.X.shape[0]-len(self.params))
@@ -5,18 +5,24 @@ Created on Mon Jul 27 20:00:38 2020
 
 @author: lukepinkel
 """
+import os
+import time
+import pickle
 import tqdm
+import numba
 import arviz as az
 import numpy as np
 import scipy as sp
 import scipy.stats
 import pandas as pd # analysis:ignore
+from concurrent.futures import ProcessPoolExecutor
 from .lmm import LMM, make_theta
-from ..utilities.linalg_operations import vech, _check_shape
-from sksparse.cholmod import cholesky
-from ..utilities.trnorm import trnorm, scalar_truncnorm
+from .mcmc_store import SampleStore
+from ..utilities.linalg_operations import (vech, _check_shape, sparse_pattern_union,
+                                           sparse_pattern_positions)
+from sksparse.cholmod import analyze
+from ..utilities.trnorm import rtruncnorm
 from ..utilities.wishart import r_invwishart, r_invgamma
-from ..utilities.poisson import poisson_logp
 
 SQRT2 = np.sqrt(2)
 
@@ -50,20 +56,21 @@ def wishart_info(dims):
         ws[key]['nu'] = nu
     return ws
 
-def sample_gcov(theta, u, wsinfo, indices, key, priors):
+def sample_gcov(theta, u, wsinfo, indices, key, priors, rng=None):
     u_i = u[indices['u'][key]]
     U_i = u_i.reshape(-1, wsinfo[key]['k'], order='C')
     Sg_i =  U_i.T.dot(U_i)
     Gs = r_invwishart(wsinfo[key]['nu']+priors[key]['n'], 
-                             Sg_i+priors[key]['V'])
+                             Sg_i+priors[key]['V'], rng=rng)
     theta[indices['theta'][key]] = vech(Gs)
     return theta
 
-def sample_rcov(theta, y, yhat, wsinfo, priors):
+def sample_rcov(theta, y, yhat, wsinfo, priors, rng=None):
     resid = y - yhat
     sse = resid.T.dot(resid)
     nu = wsinfo['r']['nu'] 
-    ss = r_invgamma((nu+priors['R']['n'])/2, scale=(sse+priors['R']['V'])/2)
+    ss = r_invgamma((nu+priors['R']['n'])/2, scale=(sse+priors['R']['V'])/2,
+                    rng=rng)
     theta[-1] = ss 
     return theta
 
@@ -74,6 +81,63 @@ def to_arviz_dict(samples, var_dict, burnin=0):
         az_dict[key] = samples[:, burnin:, val]
     return az_dict    
 
+
+@numba.jit(nopython=True)
+def _mh_lvar_binomial(y, weights, pred, s, z, x_step, u_accept, propC, n_accept,
+                      damping):
+    n = len(z)
+    accept = np.zeros(n, dtype=numba.boolean)
+    for i in range(n):
+        z0, z1 = z[i], z[i] + x_step[i] * propC[i]
+        r0, r1 = (z0 - pred[i]) / s, (z1 - pred[i]) / s
+        #log(1+exp(z)) evaluated without overflow
+        c0 = max(z0, 0.0) + np.log1p(np.exp(-abs(z0)))
+        c1 = max(z1, 0.0) + np.log1p(np.exp(-abs(z1)))
+        d = weights[i] * (y[i] * (z1 - z0) - c1 + c0) - (r1 * r1 - r0 * r0) / 2.0
+        n_accept[i] *= damping
+        if d > u_accept[i]:
+            z[i] = z1
+            accept[i] = True
+            n_accept[i] += 1.0
+    return accept
+
+
+@numba.jit(nopython=True)
+def _mh_lvar_poisson(y, pred, s, z, x_step, u_accept, propC, n_accept, damping):
+    n = len(z)
+    accept = np.zeros(n, dtype=numba.boolean)
+    for i in range(n):
+        z0, z1 = z[i], z[i] + x_step[i] * propC[i]
+        r0, r1 = (z0 - pred[i]) / s, (z1 - pred[i]) / s
+        d = y[i] * (z1 - z0) - np.exp(z1) + np.exp(z0) - (r1 * r1 - r0 * r0) / 2.0
+        n_accept[i] *= damping
+        if d > u_accept[i]:
+            z[i] = z1
+            accept[i] = True
+            n_accept[i] += 1.0
+    return accept
+
+
+def _sample_chain(model, n_samples, chain, rng, state, sampling_kws):
+    model._chain_store = model.secondary_store.writer(chain, state.get('i', 0))
+    samples = model._sampler()(n_samples, chain=chain, rng=rng, state=state,
+                               **sampling_kws)
+    return samples, model._chain_store.close(), rng, state
+
+
+# model unpickled once per worker process by _init_worker, so that only the
+# generator and state of a chain are sent with each block of draws
+_worker_model = None
+
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+
+def _sample_chain_worker(n_samples, chain, rng, state, sampling_kws):
+    return _sample_chain(_worker_model, n_samples, chain, rng, state, sampling_kws)
+
             
 
 class MixedMCMC(LMM):
@@ -119,7 +183,12 @@ class MixedMCMC(LMM):
         #Initialize parameters, get misc information for sampling
         self.t_init, _ = make_theta(self.dims)
         self.W = sp.sparse.csc_matrix(self.XZ)
-        self.WtW = self.W.T.dot(self.W)
+        self.WtW = sparse_pattern_union(self.W.T.dot(self.W), self.G, self.X.shape[1])
+        # G^{-1} occupies a fixed set of entries of M = W'W/s2 + blockdiag(0, G^{-1})
+        self.M_loc = self.WtW.copy()
+        self.loc_g_ix = sparse_pattern_positions(self.M_loc, self.G, self.X.shape[1])
+        self.loc_chol = analyze(self.M_loc)
+        self.g_chol = analyze(self.G, ordering_method='natural')
         self.wsinfo = wishart_info(self.dims)
         self.y = _check_shape(self.y, 1)
         self.indices['u'] = get_u_indices(self.dims)
@@ -151,13 +220,12 @@ class MixedMCMC(LMM):
         #Initialize containers requiring constants above
         self.offset = np.zeros(self.n_lc)
         self.location = np.zeros(self.n_re+self.n_fe)
-        self.zero_mat = sp.sparse.eye(self.n_fe)*0.0
         self.re_mu = np.zeros(self.n_re)
         
         #Get model specific indices and constants
         if response_dist == 'bernoulli':
             self.ix0, self.ix1 = self.y==0, self.y==1
-            self.jv0, self.jv1 = np.ones(len(self.ix0)), np.ones(len(self.ix1))
+            self.jv = np.ones(self.n_ob)
             freeR = False if freeR is None else freeR
         elif response_dist == 'ordinal_probit':
             self.jv = np.ones(self.n_ob)
@@ -169,6 +237,7 @@ class MixedMCMC(LMM):
             for i in range(self.n_cats):
                 self.y_ix[i] = self.y==i
                 self.y_cat[self.y==i, i] = 1
+            self.y_code = np.argmax(self.y_cat, axis=1)
             freeR = False if freeR is None else freeR
         elif response_dist == 'binomial':
             freeR = False if freeR is None else freeR
@@ -202,6 +271,16 @@ class MixedMCMC(LMM):
             param_names = param_names[:-1]
         self.param_names = param_names
         
+    def __getstate__(self):
+        state = super().__getstate__()
+        for key in ['loc_chol', 'g_chol']:
+            state.pop(key, None)
+        return state
+    
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.loc_chol = analyze(self.M_loc)
+        self.g_chol = analyze(self.G, ordering_method='natural')
 
     def sample_location(self, theta, x1, x2, y):
         """
@@ -225,70 +304,111 @@ class MixedMCMC(LMM):
         location: array_like
             Sample from P(beta, u|y, G, R)
         
+        Notes
+        -----
+        M = W'W/s2 + blockdiag(0, G^{-1}) and G^{-1} keep the sparsity 
+        pattern analyzed at initialization, so only their values are 
+        updated and refactored in place at each draw.
         """
         s, s2 =  np.sqrt(theta[-1]), theta[-1]
-        M = self.WtW.copy() / s2
-        Ginv = self.update_gmat(theta, inverse=True).copy()
-        Omega = sp.sparse.block_diag([self.zero_mat, Ginv])
-        M+=Omega
-        chol_fac = cholesky(Ginv, ordering_method='natural')
-        a_star = chol_fac.solve_Lt(x1, use_LDLt_decomposition=False)
+        Ginv = self.update_gmat(theta, inverse=True)
+        M = self.M_loc
+        np.divide(self.WtW.data, s2, out=M.data)
+        M.data[self.loc_g_ix] += Ginv.data
+        self.g_chol.cholesky_inplace(Ginv)
+        a_star = self.g_chol.solve_Lt(x1, use_LDLt_decomposition=False)
         y_z = y - (self.Zs.dot(a_star) + x2 * s)
         ofs = self.offset.copy()
         ofs[-self.n_re:] = a_star
-        m_chol = cholesky(M.tocsc())
+        self.loc_chol.cholesky_inplace(M)
         u = sp.sparse.csc_matrix.dot(y_z, self.W) / s2
-        location = ofs + m_chol.solve_A(u) 
+        location = ofs + self.loc_chol.solve_A(u) 
         return location
     
-    def mh_lvar_binomial(self, pred, s, z, x_step, u_accept, propC):
-        z_prop = x_step * propC + z
-        
-        mndenom1, mndenom2 = np.exp(z)+1, np.exp(z_prop)+1
-        densityl1 = ((self.y*z) - np.log(mndenom1))*self.weights
-        densityl2 = ((self.y*z_prop) - np.log(mndenom2))*self.weights
-        densityl1 += sp.stats.norm(pred, s).logpdf(z)
-        densityl2 += sp.stats.norm(pred, s).logpdf(z_prop)
-        density_diff = densityl2 - densityl1
-        accept = (density_diff>u_accept)
-        z[accept] = z_prop[accept]
+    def mh_lvar_binomial(self, pred, s, z, x_step, u_accept, propC, n_accept=None,
+                         damping=1.0):
+        """
+        Parameters
+        ----------
+        pred : array_like
+            Linear predictor, the mean of the latent variables.
+        s : float
+            Residual standard deviation.
+        z : array_like
+            Latent variables, updated in place.
+        x_step : array_like
+            Standard normal proposal steps.
+        u_accept : array_like
+            Log uniform acceptance thresholds.
+        propC : float or array_like
+            Scale of the proposal steps, either shared or one for each 
+            latent variable.
+        n_accept : array_like, optional
+            Acceptance counters of the latent variables, which are 
+            multiplied by damping and incremented for each accepted 
+            proposal in place. The default is None.
+        damping : float, optional
+            Decay of the acceptance counters, with 1.0 giving plain counts.
+            The default is 1.0.
+
+        Returns
+        -------
+        z : array_like
+            Updated latent variables.
+        accept : array_like
+            Whether the proposal of each latent variable was accepted.
+            
+        Notes
+        -----
+        The proposal, the change in log density, the acceptance test and 
+        the update are done in a single compiled pass over the latent 
+        variables.
+        """
+        n_accept = np.zeros(self.n_ob) if n_accept is None else n_accept
+        propC = np.full(self.n_ob, propC, dtype=np.double) if np.ndim(propC)==0 else propC
+        accept = _mh_lvar_binomial(self.y, self.weights, pred, s, z, x_step,
+                                   u_accept, propC, n_accept, damping)
         return z, accept
     
-    def mh_lvar_poisson(self, pred, s, z, x_step, u_accept, propC):
-        z_prop = x_step * propC + z
-        
-        densityl1 = poisson_logp(self.y, np.exp(z))
-        densityl2 = poisson_logp(self.y, np.exp(z_prop))
-        densityl1 += sp.stats.norm(pred, s).logpdf(z)
-        densityl2 += sp.stats.norm(pred, s).logpdf(z_prop)
-        density_diff = densityl2 - densityl1
-        accept = (density_diff>u_accept)
-        z[accept] = z_prop[accept]
+    def mh_lvar_poisson(self, pred, s, z, x_step, u_accept, propC, n_accept=None,
+                        damping=1.0):
+        """
+        Parameters
+        ----------
+        pred, s, z, x_step, u_accept, propC, n_accept, damping : optional
+            See mh_lvar_binomial.
+
+        Returns
+        -------
+        z : array_like
+            Updated latent variables.
+        accept : array_like
+            Whether the proposal of each latent variable was accepted.
+
+        """
+        n_accept = np.zeros(self.n_ob) if n_accept is None else n_accept
+        propC = np.full(self.n_ob, propC, dtype=np.double) if np.ndim(propC)==0 else propC
+        accept = _mh_lvar_poisson(self.y, pred, s, z, x_step, u_accept, propC,
+                                  n_accept, damping)
         return z, accept
     
-    def mh_lvar_ordinal_probit(self, theta, t, pred, v):
-        tau = np.pad(t, ((1, 1)), mode='constant', constant_values=[-1e17, 1e17])
-        mu, sd = np.zeros_like(pred), np.ones_like(pred)
+    def mh_lvar_ordinal_probit(self, theta, t, pred, v, rng=None):
+        rng = self.rng if rng is None else rng
+        tau = np.pad(t, ((1, 1)), mode='constant', constant_values=[-np.inf, np.inf])
         s = np.sqrt(theta[-1])
-        for i in range(1, self.y_cat.shape[1]+1):
-            ix = self.y_ix[i-1]
-            j = self.jv[ix]
-            mu = pred[ix]
-            sd = j*s
-            lb = j*tau[i-1]
-            ub = j*tau[i]
-            v[ix] = trnorm(mu, sd, lb, ub)
-        return v
+        lb, ub = self.jv * tau[self.y_code], self.jv * tau[self.y_code+1]
+        return rtruncnorm(pred, self.jv*s, lb, ub, rng=rng, out=v)
     
-    def sample_theta(self, theta, u, z, pred, freeR=True):
+    def sample_theta(self, theta, u, z, pred, freeR=True, rng=None):
         for key in self.levels:
             theta = sample_gcov(theta.copy(), u, self.wsinfo, self.indices,
-                                key, self.priors)
+                                key, self.priors, rng)
         if freeR:
-            theta = sample_rcov(theta, z, pred, self.wsinfo, self.priors)
+            theta = sample_rcov(theta, z, pred, self.wsinfo, self.priors, rng)
         return theta
     
-    def slice_sample_lvar(self, rexpon, v, z, theta, pred):
+    def slice_sample_lvar(self, rexpon, v, z, theta, pred, rng=None):
+        rng = self.rng if rng is None else rng
         v[self.ix1] = z[self.ix1] - log1p(np.exp(z[self.ix1]))
         v[self.ix1]-= rexpon[self.ix1]
         v[self.ix1] = v[self.ix1] - log1p(-np.exp(v[self.ix1]))
@@ -297,16 +417,14 @@ class MixedMCMC(LMM):
         v[self.ix0]-= rexpon[self.ix0]
         v[self.ix0] = log1p(-np.exp(v[self.ix0])) - v[self.ix0]
         s = np.sqrt(theta[-1])
-        z[self.ix1] = trnorm(mu=pred[self.ix1], sd=s*self.jv1, 
-                             lb=v[self.ix1], ub=200*self.jv1)
-        z[self.ix0] = trnorm(mu=pred[self.ix0], sd=s*self.jv0, 
-                             lb=-200*self.jv0, ub=v[self.ix0])
-        return z
+        lb, ub = np.where(self.ix1, v, -np.inf), np.where(self.ix1, np.inf, v)
+        return rtruncnorm(pred, s*self.jv, lb, ub, rng=rng, out=z)
     
     
-    def sample_tau(self, theta, t, pred, v, propC):
+    def sample_tau(self, theta, t, pred, v, propC, rng=None):
+        rng = self.rng if rng is None else rng
         alpha_prev = np.pad(np.log(np.diff(t)), (1, 0), mode='constant', constant_values=[np.log(t[0])])
-        alpha_prop = self.rng.normal(alpha_prev, propC)
+        alpha_prop = rng.normal(alpha_prev, propC)
         ll = 0.0
         t_prop = np.cumsum(np.exp(alpha_prop))
         s = np.sqrt(theta[-1])
@@ -317,7 +435,7 @@ class MixedMCMC(LMM):
         m = pred[self.y_ix[i+1]]
         ll += np.sum(np.log(1.0 - norm_cdf((t_prop[i]-m)/s)))
         ll -= np.sum(np.log(1.0 - norm_cdf((t[i]-m)/s)))
-        if ll>np.log(np.random.uniform(0, 1)):
+        if ll>np.log(rng.uniform(0, 1)):
             t_accept = True
             t = t_prop
         else:
@@ -325,136 +443,146 @@ class MixedMCMC(LMM):
             t = t
         return t, t_accept 
     
-    def sample_ordinal_probit(self, n_samples, chain=0, save_pred=False, 
-                              save_u=False, save_lvar=False, propC=0.04, damping=0.99,
-                              adaption_rate=1.02,  target_accept=0.44, n_adapt=None):
-
-        if n_adapt is None:
-            n_adapt = np.minimum(int(n_samples/2), 1000)
-        
+    def sample_ordinal_probit(self, n_samples, chain=0, propC=0.04, damping=0.99,
+                              adaption_rate=1.02,  target_accept=0.44, n_adapt=None,
+                              rng=None, state=None):
         freeR = self.freeR
+        rng = self.rng if rng is None else rng
+        state = {} if state is None else state
+        if 'theta' not in state:
+            location = self.location.copy()
+            t = sp.stats.norm(0, 1).ppf((self.y_cat.sum(axis=0).cumsum()/np.sum(self.y_cat))[:-1])
+            t = t - t[0]
+            t = t+1.0
+            n_adapt = state.get('n_adapt', np.minimum(int(n_samples/2), 1000)) if n_adapt is None else n_adapt
+            state.update(i=0, location=location, pred=self.W.dot(location), 
+                         theta=self.t_init.copy(), t=t, z=np.zeros_like(self.y).astype(float),
+                         propC=propC, wtrace=1.0, waccept=1.0, n_accept=0.0, n_adapt=n_adapt)
         param_samples = np.zeros((n_samples, self.n_params+self.n_thresh))
-        t_acceptances = np.zeros((n_samples))
-        rng = self.rng
-        location = self.location.copy()
-        pred =  self.W.dot(location)
-        theta = self.t_init.copy()
-        t = sp.stats.norm(0, 1).ppf((self.y_cat.sum(axis=0).cumsum()/np.sum(self.y_cat))[:-1])
-        t = t - t[0]
-        t = t+1.0
-        z = np.zeros_like(self.y).astype(float)
-        wtrace, waccept = 1.0, 1.0
+        i0, n_adapt = state['i'], state['n_adapt']
+        theta, t, z, pred = state['theta'], state['t'], state['z'], state['pred']
+        propC, wtrace, waccept = state['propC'], state['wtrace'], state['waccept']
         pbar = tqdm.tqdm(range(n_samples), smoothing=0.01)
         for i in range(n_samples):
-            t, t_accept = self.sample_tau(theta, t, pred, z, propC)
+            t, t_accept = self.sample_tau(theta, t, pred, z, propC, rng)
             wtrace = wtrace * damping + 1.0
             waccept *= damping
             if t_accept:
                 waccept +=1
-            if i<n_adapt:
+            if i0+i<n_adapt:
                 propC = propC * np.sqrt(adaption_rate**((waccept/wtrace)-target_accept))
             if t_accept:
-                z = self.mh_lvar_ordinal_probit(theta, t, pred, z)
+                z = self.mh_lvar_ordinal_probit(theta, t, pred, z, rng)
             location = self.sample_location(theta, rng.normal(0, 1, size=self.n_re), 
                                             rng.normal(0, 1, size=self.n_ob), z)
             pred = self.W.dot(location)
             u = location[-self.n_re:]
-            theta  = self.sample_theta(theta, u, z, pred, freeR)
+            theta  = self.sample_theta(theta, u, z, pred, freeR, rng)
             param_samples[i, self.n_fe:-self.n_thresh] = theta.copy()
             param_samples[i, :self.n_fe] = location[:self.n_fe]
             param_samples[i, -self.n_thresh:] = t
-            t_acceptances[i] = t_accept
-            self._secondary_samples(chain, i, pred, u, z)
-            if i>1:
-                pbar.set_description(f"Chain {chain+1} Tau Acceptance Prob: {t_acceptances[:i].mean():.3f} C: {propC:.5f}")
+            state['n_accept'] += t_accept
+            self._secondary_samples(chain, i0+i, pred, u, z)
+            if i0+i>1:
+                pbar.set_description(f"Chain {chain+1} Tau Acceptance Prob: {state['n_accept']/(i0+i+1):.3f} C: {propC:.5f}")
             pbar.update(1)
         pbar.close() 
+        state.update(i=i0+n_samples, location=location, pred=pred, theta=theta, t=t,
+                     z=z, propC=propC, wtrace=wtrace, waccept=waccept)
         return param_samples
     
-    def sample_binomial(self, n_samples, chain=0, save_pred=False, save_u=False,
-                        save_lvar=False, propC=1.0, damping=0.99, 
+    def sample_binomial(self, n_samples, chain=0, propC=1.0, damping=0.99, 
                         adaption_rate=1.01,  target_accept=0.44,
-                        n_adapt=None):
+                        n_adapt=None, rng=None, state=None):
         freeR = self.freeR
-        if n_adapt is None:
-            n_adapt = np.minimum(int(n_samples/2), 1000)
-            
+        rng = self.rng if rng is None else rng
+        state = {} if state is None else state
+        if 'theta' not in state:
+            location = self.location.copy()
+            n_adapt = state.get('n_adapt', np.minimum(int(n_samples/2), 1000)) if n_adapt is None else n_adapt
+            state.update(i=0, location=location, pred=self.W.dot(location),
+                         z=rng.normal(self.y, self.y.var()), theta=self.t_init.copy(),
+                         propC=np.ones(self.n_ob)*propC, wtrace=1.0, n_accept=0.0,
+                         n_adapt=n_adapt, obs_accept=np.ones(self.n_ob))
         param_samples = np.zeros((n_samples, self.n_params))
-        rng = self.rng
-        acceptances = np.zeros((n_samples))
-        location = self.location.copy()
-        pred =  self.W.dot(location)
-        z = sp.stats.norm(self.y, self.y.var()).rvs()
-        theta = self.t_init.copy()
+        i0, n_adapt = state['i'], state['n_adapt']
+        theta, z, pred = state['theta'], state['z'], state['pred']
+        propC, wtrace, obs_accept = state['propC'], state['wtrace'], state['obs_accept']
         progress_bar = tqdm.tqdm(range(n_samples), smoothing=0.01)
-        wtrace, waccept = 1.0, 1.0
 
         for i in progress_bar:
             s2 = theta[-1]
             s = np.sqrt(s2)
             z, accept = self.mh_lvar_binomial(pred, s, z, rng.normal(0, 1, size=self.n_ob),
-                                              np.log(rng.uniform(0, 1, size=self.n_ob)), propC)
+                                              np.log(rng.uniform(0, 1, size=self.n_ob)), propC,
+                                              obs_accept, damping)
             
             mean_accept = accept.mean()
             wtrace = wtrace * damping + 1.0
-            waccept = waccept * damping + mean_accept
 
-            if i<n_adapt:
-                propC = propC * np.sqrt(adaption_rate**((waccept/wtrace)-target_accept))
+            if i0+i<n_adapt:
+                propC *= np.sqrt(adaption_rate**((obs_accept/wtrace)-target_accept))
                 
             location = self.sample_location(theta, rng.normal(0, 1, size=self.n_re), 
                                             rng.normal(0, 1, size=self.n_ob), z)
             pred = self.W.dot(location)
             u = location[-self.n_re:]
-            theta = self.sample_theta(theta, u, z, pred, freeR)
-            acceptances[i] = mean_accept
+            theta = self.sample_theta(theta, u, z, pred, freeR, rng)
+            state['n_accept'] += mean_accept
             param_samples[i, self.n_fe:] = theta.copy()
             param_samples[i, :self.n_fe] = location[:self.n_fe]
-            self._secondary_samples(chain, i, pred, u, z)
-            if i>1:
-                progress_bar.set_description(f"Chain {chain+1} Acceptance Prob: {acceptances[:i].mean():.4f} C: {propC:.5f}")
+            self._secondary_samples(chain, i0+i, pred, u, z)
+            if i0+i>1:
+                progress_bar.set_description(f"Chain {chain+1} Acceptance Prob: {state['n_accept']/(i0+i+1):.4f} C: {np.median(propC):.5f}")
         progress_bar.close()
+        state.update(i=i0+n_samples, location=location, pred=pred, theta=theta, z=z,
+                     propC=propC, wtrace=wtrace, obs_accept=obs_accept)
         return param_samples
     
-    def sample_bernoulli(self, n_samples, chain=0, save_pred=False, save_u=False, 
-                         save_lvar=False):
+    def sample_bernoulli(self, n_samples, chain=0, rng=None, state=None):
         freeR = self.freeR
-        rng = self.rng
+        rng = self.rng if rng is None else rng
+        state = {} if state is None else state
+        if 'theta' not in state:
+            state.update(i=0, location=self.location.copy(), pred=self.W.dot(self.location),
+                         theta=self.t_init.copy(), z=rng.normal(0, 1, size=self.n_ob))
         n_pr, n_ob = self.n_params, self.n_ob
         n_smp = n_samples
         samples = np.zeros((n_smp, n_pr))
-        location, pred = self.location.copy(), self.W.dot(self.location)
-        theta, z = self.t_init.copy(), sp.stats.norm(0, 1).rvs(n_ob)
+        i0, theta, z, pred = state['i'], state['theta'], state['z'], state['pred']
         v = np.zeros_like(z).astype(float)
         progress_bar = tqdm.tqdm(range(n_smp), smoothing=0.01)
         progress_bar.set_description(f"Chain {chain+1}")
         for i in progress_bar:
             #P(z|location, theta)
             z = self.slice_sample_lvar(rng.exponential(scale=1.0, size=self.n_ob),
-                                       v, z, theta, pred)
+                                       v, z, theta, pred, rng)
             #P(location|z, theta)
             location = self.sample_location(theta, rng.normal(0, 1, size=self.n_re), 
                                              rng.normal(0, 1, size=self.n_ob), z)
             pred, u = self.W.dot(location), location[-self.n_re:]
             #P(theta|z, location)
-            theta  = self.sample_theta(theta, u, z, pred, freeR)
+            theta  = self.sample_theta(theta, u, z, pred, freeR, rng)
             samples[i, self.n_fe:] = theta.copy()
             samples[i, :self.n_fe] = location[:self.n_fe]
-            self._secondary_samples(chain, i, pred, u, z)
+            self._secondary_samples(chain, i0+i, pred, u, z)
         progress_bar.close()
+        state.update(i=i0+n_smp, location=location, pred=pred, theta=theta, z=z)
         return samples
     
-    def sample_normal(self, n_samples, chain=0, save_pred=False, save_u=False, 
-                      save_lvar=False):
+    def sample_normal(self, n_samples, chain=0, rng=None, state=None):
         freeR = self.freeR
-        rng = self.rng
+        rng = self.rng if rng is None else rng
+        state = {} if state is None else state
+        if 'theta' not in state:
+            state.update(i=0, location=self.location.copy(), pred=self.W.dot(self.location),
+                         theta=self.t_init.copy())
         n_pr= self.n_params
         n_smp = n_samples
         samples = np.zeros((n_smp, n_pr))
         
         y = self.y
-        location, pred = self.location.copy(), self.W.dot(self.location)
-        theta = self.t_init.copy()
+        i0, theta = state['i'], state['theta']
         progress_bar = tqdm.tqdm(range(n_smp), smoothing=0.01)
         progress_bar.set_description(f"Chain {chain+1}")
         for i in progress_bar:
@@ -463,39 +591,29 @@ class MixedMCMC(LMM):
                                              rng.normal(0, 1, size=self.n_ob), y)
             pred, u = self.W.dot(location), location[-self.n_re:]
             #P(theta|z, location)
-            theta  = self.sample_theta(theta, u, y, pred, freeR)
+            theta  = self.sample_theta(theta, u, y, pred, freeR, rng)
             samples[i, self.n_fe:] = theta.copy()
             samples[i, :self.n_fe] = location[:self.n_fe]
-            self._secondary_samples(chain, i, pred, u, None)
+            self._secondary_samples(chain, i0+i, pred, u, None)
         progress_bar.close()
+        state.update(i=i0+n_smp, location=location, pred=pred, theta=theta)
         return samples
            
     
     def _secondary_samples(self, chain, i, pred=None, u=None, z=None):
-        if self.save_pred:
-            self.secondary_samples["pred"][chain, i] = pred
+        self._chain_store.write(i, pred=pred, u=u, lvar=z)
+    
+    def _secondary_shapes(self):
+        shapes = {}
         if self.save_u:
-            self.secondary_samples["u"][chain, i] = u        
+            shapes['u'] = (self.n_re,)
+        if self.save_pred:
+            shapes['pred'] = (self.n_ob,)
         if self.save_lvar:
-            self.secondary_samples["lvar"][chain, i] = z
-            
-    def sample(self, n_samples=5000, n_chains=8, burnin=1000, save_pred=False, 
-               save_u=False, save_lvar=False, sampling_kws={},
-               summary_kws={}):
-        n_params = self.n_params
-        if self.response_dist=="ordinal_probit":
-            n_params = n_params+np.unique(self.y).shape[0]-1
-        samples = np.zeros((n_chains, n_samples, n_params))
-
-        self.secondary_samples = {}
-        if save_u:
-            self.secondary_samples['u'] = np.zeros((n_chains, n_samples, self.n_re))
-        if save_pred:
-            self.secondary_samples['pred'] = np.zeros((n_chains, n_samples, self.n_ob))        
-        if save_lvar:
-            self.secondary_samples['u'] = np.zeros((n_chains, n_samples, self.n_ob))
-        self.save_pred, self.save_u, self.save_lvar = save_pred, save_u, save_lvar
-
+            shapes['lvar'] = (self.n_ob,)
+        return shapes
+    
+    def _sampler(self):
         if self.response_dist=='binomial':
             func = self.sample_binomial
         elif self.response_dist=='bernoulli':
@@ -504,11 +622,245 @@ class MixedMCMC(LMM):
             func = self.sample_ordinal_probit
         elif self.response_dist=='normal':
             func = self.sample_normal
+        return func
             
-        for i in range(n_chains):
-            samples[i] = func(n_samples, chain=i, **sampling_kws)
+    def _convergence(self, samples, burnin):
+        """
+        Parameters
+        ----------
+        samples : ndarray
+            Draws of shape (n_chains, n_samples, n_params).
+        burnin : int
+            Number of draws discarded from the start of each chain.
+
+        Returns
+        -------
+        diagnostics : dict
+            Largest rank normalized split R-hat and smallest bulk and tail
+            effective sample sizes over the parameters in vnames.
+        """
+        data = az.from_dict(to_arviz_dict(samples, self.vnames, burnin=burnin))
+        diagnostics = {}
+        for key, func, reduce in [('r_hat', lambda x: az.rhat(x), np.max),
+                                  ('ess_bulk', lambda x: az.ess(x, method='bulk'), np.min),
+                                  ('ess_tail', lambda x: az.ess(x, method='tail'), np.min)]:
+            vals = np.concatenate([np.ravel(val.values) for val in func(data).data_vars.values()])
+            diagnostics[key] = reduce(vals)
+        return diagnostics
+    
+    def _converged(self, diagnostics, targets):
+        converged = True
+        for key, target in targets.items():
+            if key == 'r_hat':
+                converged = converged and diagnostics[key] < target
+            else:
+                converged = converged and diagnostics[key] > target
+        return converged
             
+    def sample(self, n_samples=5000, n_chains=8, burnin=1000, save_pred=False, 
+               save_u=False, save_lvar=False, sampling_kws={},
+               summary_kws={}, n_jobs=1, seed=None, thin=1, store_path=None,
+               store_kws={}, check_every=None, targets=None, max_time=None,
+               checkpoint_path=None, checkpoint_every=None, resume=None):
+        """
+        Parameters
+        ----------
+        n_samples : int, optional
+            Number of draws per chain, including burnin. The default is 5000.
+        n_chains : int, optional
+            Number of chains. The default is 8.
+        burnin : int, optional
+            Number of draws discarded from the start of each chain in the 
+            summary. The default is 1000.
+        save_pred, save_u, save_lvar : bool, optional
+            Whether the linear predictor, random effects and latent 
+            variables of each draw are kept in secondary_samples. The 
+            defaults are False.
+        sampling_kws : dict, optional
+            Arguments passed to the sampler of the response distribution.
+            The default is {}.
+        summary_kws : dict, optional
+            Arguments passed to az.summary. The default is {}.
+        n_jobs : int, optional
+            Number of worker processes the chains are run in, with -1 using
+            every core. The default is 1, which runs them in this process.
+        seed : int or SeedSequence, optional
+            Seed from which each chain's generator is spawned. The default
+            is None, which draws one from the rng of the model.
+        thin : int, optional
+            Every thin-th draw of the secondary samples is kept. The default
+            is 1.
+        store_path : str, optional
+            Directory the secondary samples are streamed to as memory-mapped
+            .npy files. The default is None, which keeps them in memory.
+        store_kws : dict, optional
+            Other arguments passed to SampleStore. The default is {}.
+        check_every : int, optional
+            Number of draws per chain between convergence checks, after 
+            which sampling stops as soon as every target is met, so that 
+            n_samples is only an upper bound. The default is None, which 
+            runs all n_samples draws without checks.
+        targets : dict, optional
+            Upper bound on the largest 'r_hat' and lower bounds on the 
+            smallest 'ess_bulk' and 'ess_tail' of the parameters. The 
+            default is None, which uses r_hat=1.01, ess_bulk=400 and
+            ess_tail=400.
+        max_time : float, optional
+            Number of seconds after which sampling stops at the next check
+            or checkpoint. The default is None.
+        checkpoint_path : str, optional
+            File the state of the run is written to every checkpoint_every
+            draws. The default is None.
+        checkpoint_every : int, optional
+            Number of draws per chain between checkpoints. The default is
+            None, which only writes a checkpoint when sampling ends.
+        resume : str, optional
+            Checkpoint from which an interrupted run is continued, with the
+            arguments of that run, apart from n_jobs. The default is None.
+
+        Returns
+        -------
+        None.
+        
+        Notes
+        -----
+        Every chain draws only from its own generator, spawned from seed 
+        with SeedSequence.spawn, so the draws for a given seed do not 
+        depend on n_jobs.  Each worker process unpickles the model once,
+        after which only the generator and state of a chain are sent with
+        every block of draws.
+        
+        The secondary samples are kept in secondary_store, whose arrays, 
+        also available as secondary_samples, have shape 
+        (n_chains, n_kept, n) and are written by each chain in chunks, 
+        directly to disk when store_path is given.  Its to_arviz method 
+        gives an InferenceData view of them without loading them.
+        
+        With check_every, the chains are advanced check_every draws at a 
+        time from their saved states, and the rank normalized split R-hat 
+        and the bulk and tail ESS of the draws after burnin are recorded 
+        in convergence_hist.  These are recomputed from all of the draws
+        after burnin at every check, since the ranks, the split halves and
+        the autocorrelations change with every new draw and have no exact
+        running update, so the checks cost O(n_samples^2 / check_every) in
+        total.  That is small next to the sampling itself unless check_every
+        is a small fraction of n_samples, in which case it should be raised.
+
+        A checkpoint holds the arguments of the run, the draws so far and 
+        the state and generator of every chain, and is replaced atomically,
+        so a run continued with resume gives exactly the draws of an 
+        uninterrupted run.  Secondary samples kept in memory are included 
+        in the checkpoint, while those in store_path are reopened from it.
+        """
+        config = dict(n_samples=n_samples, n_chains=n_chains, burnin=burnin,
+                      save_pred=save_pred, save_u=save_u, save_lvar=save_lvar,
+                      sampling_kws=sampling_kws, summary_kws=summary_kws, seed=seed,
+                      thin=thin, store_path=store_path, store_kws=store_kws,
+                      check_every=check_every, targets=targets, max_time=max_time,
+                      checkpoint_path=checkpoint_path, 
+                      checkpoint_every=checkpoint_every)
+        checkpoint = None
+        if resume is not None:
+            with open(resume, 'rb') as f:
+                checkpoint = pickle.load(f)
+            config = checkpoint['config']
+            if config['checkpoint_path'] is None:
+                config['checkpoint_path'] = resume
+        self._sample(config, n_jobs, checkpoint)
+    
+    def _save_checkpoint(self, path, checkpoint):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    
+    def _sample(self, config, n_jobs, checkpoint=None):
+        n_samples, n_chains, burnin = [config[key] for key in ['n_samples', 'n_chains', 'burnin']]
+        thin, store_path, check_every, checkpoint_every = [config[key] for key in 
+            ['thin', 'store_path', 'check_every', 'checkpoint_every']]
+        sampling_kws, max_time = config['sampling_kws'], config['max_time']
+
+        n_params = self.n_params
+        if self.response_dist=="ordinal_probit":
+            n_params = n_params+np.unique(self.y).shape[0]-1
+        samples = np.zeros((n_chains, n_samples, n_params))
+        self.save_pred, self.save_u, self.save_lvar = [config[key] for key in 
+                                                       ['save_pred', 'save_u', 'save_lvar']]
+        if checkpoint is not None and store_path is not None:
+            self.secondary_store = SampleStore.open(store_path, mode='r+')
+            # an early stop truncates the store to the draws actually made
+            self.secondary_store.extend(n_samples)
+        else:
+            self.secondary_store = SampleStore(self._secondary_shapes(), n_chains, n_samples,
+                                               thin=thin, path=store_path, **config['store_kws'])
+        targets = dict(r_hat=1.01, ess_bulk=400, ess_tail=400) if config['targets'] is None\
+                  else config['targets']
+        if checkpoint is None:
+            seed = self.rng.integers(2**63) if config['seed'] is None else config['seed']
+            seeds = np.random.SeedSequence(seed).spawn(n_chains) \
+                    if not isinstance(seed, np.random.SeedSequence) else seed.spawn(n_chains)
+            rngs = [np.random.default_rng(s) for s in seeds]
+            states = [dict(n_adapt=np.minimum(int(n_samples/2), 1000)) for i in range(n_chains)]
+            self.convergence_hist, n_drawn = [], 0
+        else:
+            rngs, states = checkpoint['rngs'], checkpoint['states']
+            self.convergence_hist, n_drawn = checkpoint['convergence_hist'], checkpoint['n_drawn']
+            samples[:, :n_drawn] = checkpoint['samples']
+            for key, val in checkpoint['secondary_samples'].items():
+                self.secondary_store.arrays[key][:, :val.shape[1]] = val
+        n_jobs = os.cpu_count() if n_jobs==-1 else n_jobs
+        executor = None if n_jobs==1 else ProcessPoolExecutor(min(n_jobs, n_chains),
+                                                              initializer=_init_worker,
+                                                              initargs=(self,))
+        t_start = time.time()
+        try:
+            while n_drawn < n_samples:
+                #advance the chains to the next check, checkpoint or the end
+                n_next = n_samples
+                for every in [check_every, checkpoint_every]:
+                    if every is not None:
+                        n_next = min(n_next, (n_drawn // every + 1) * every)
+                n_draws = n_next - n_drawn
+                args = ([n_draws]*n_chains, range(n_chains), rngs, states,
+                        [sampling_kws]*n_chains)
+                if executor is None:
+                    results = list(map(_sample_chain, [self]*n_chains, *args))
+                else:
+                    results = list(executor.map(_sample_chain_worker, *args))
+                for i, (samples_i, written_i, rng_i, state_i) in enumerate(results):
+                    samples[i, n_drawn:n_drawn+n_draws] = samples_i
+                    self.secondary_store.gather(i, written_i)
+                    rngs[i], states[i] = rng_i, state_i
+                n_drawn += n_draws
+                stop = max_time is not None and time.time()-t_start > max_time
+                if check_every is not None and n_drawn % check_every == 0 \
+                   and n_drawn - burnin >= 4:
+                    diagnostics = self._convergence(samples[:, :n_drawn], burnin)
+                    diagnostics.update(n_samples=n_drawn, time=time.time()-t_start)
+                    self.convergence_hist.append(diagnostics)
+                    stop = stop or self._converged(diagnostics, targets)
+                if config['checkpoint_path'] is not None and (stop or n_drawn==n_samples or \
+                   (checkpoint_every is not None and n_drawn % checkpoint_every == 0)):
+                    n_kept = -(-n_drawn // thin)
+                    secondary = {} if store_path is not None else \
+                                dict([(key, val[:, :n_kept].copy()) for key, val in
+                                      self.secondary_store.arrays.items()])
+                    self._save_checkpoint(config['checkpoint_path'], 
+                                          dict(config=config, n_drawn=n_drawn, rngs=rngs,
+                                               states=states, samples=samples[:, :n_drawn],
+                                               secondary_samples=secondary,
+                                               convergence_hist=self.convergence_hist))
+                if stop:
+                    break
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        samples = samples[:, :n_drawn]
+        self.secondary_store.truncate(n_drawn)
+        self.secondary_samples = self.secondary_store.arrays
+        self._chain_store, self.chain_states = None, states
         
+        summary_kws = config['summary_kws']
         self.samples = samples
         self.az_dict = to_arviz_dict(samples, self.vnames, burnin=burnin)
         self.az_data = az.from_dict(self.az_dict)
@@ -6,6 +6,8 @@ Created on Wed Feb 10 00:01:29 2021
 """
 
 import re
+import os
+import time
 import tqdm
 import patsy
 import pandas as pd
@@ -13,14 +15,22 @@ import numpy as np # analysis:ignore
 import scipy as sp # analysis:ignore
 import matplotlib.pyplot as plt
 import scipy.sparse as sps # analysis:ignore
+from concurrent.futures import ProcessPoolExecutor
 from ..utilities.linalg_operations import (dummy, vech, invech, _check_np, 
                                            sparse_woodbury_inversion,
-                                           _check_shape)
+                                           _check_shape, sparse_pattern_union,
+                                           sparse_border_pattern,
+                                           sparse_pattern_positions,
+                                           sparse_pattern_fill, sparse_group_design,
+                                           sparse_selected_inversion)
 from ..utilities.special_mats import lmat, nmat
+from .model_matrices import update_gmat_blocks
 from ..utilities.numerical_derivs import so_gc_cd, so_fc_cd, fo_fc_cd
 from ..pyglm.families import (Binomial, ExponentialFamily, Poisson, NegativeBinomial, Gaussian, InverseGaussian)
 from ..utilities.output import get_param_table
-from sksparse.cholmod import cholesky
+from ..utilities.eval_cache import EvalCache
+from .sim_lmm import MixedModelSim
+from sksparse.cholmod import analyze
 
 def replace_duplicate_operators(match):
     return match.group()[-1:]
@@ -54,15 +64,13 @@ def construct_random_effects(groups, data, n_vars):
     re_vars, re_groupings = list(zip(*groups))
     re_vars, re_groupings = set(re_vars), set(re_groupings)
     Zdict = dict(zip(re_vars, [_check_np(patsy.dmatrix(x, data=data, return_type='dataframe')) for x in re_vars]))
-    Jdict = dict(zip(re_groupings, [dummy(data[x]) for x in re_groupings]))
     dim_dict = {}
     Z = []
     for x, y in groups:
-        Ji, Xi = Jdict[y], Zdict[x]
-        dim_dict[y] = {'n_groups':Ji.shape[1], 'n_vars':Xi.shape[1]}
-        Zi = sp.linalg.khatri_rao(Ji.T, Xi.T).T
+        Zi, n_groups = sparse_group_design(data[y], Zdict[x])
+        dim_dict[y] = {'n_groups':n_groups, 'n_vars':Zdict[x].shape[1]}
         Z.append(Zi)
-    Z = np.concatenate(Z, axis=1)
+    Z = sps.hstack(Z, format='csc')
     return Z, dim_dict
 
 def construct_model_matrices(formula, data, return_fe=False):
@@ -133,15 +141,6 @@ def make_gcov(theta, indices, dims, inverse=False):
     G = sps.block_diag(list(Gmats.values())).tocsc()
     return G, g_indices
 
-def lndet_gmat(theta, dims, indices):
-    lnd = 0.0
-    for key, value in dims.items():
-        dims_i = dims[key]
-        ng = dims_i['n_groups']
-        Sigma_i = invech(theta[indices['theta'][key]])
-        lnd += ng*np.linalg.slogdet(Sigma_i)[1]
-    return lnd
-
 def lndet_gmat_chol(theta, dims, indices):
     lnd = 0.0
     for key, value in dims.items():
@@ -274,20 +273,32 @@ class LMM:
         indices['g'] = g_indices
     
     
-        XZ, Xty, Zty, yty = np.hstack([X, Z]), X.T.dot(y), Z.T.dot(y), y.T.dot(y)
-        XZ = sp.sparse.csc_matrix(XZ)
+        XZ, Xty, Zty, yty = sps.hstack([X, Z], format='csc'), X.T.dot(y), Z.T.dot(y), y.T.dot(y)
         C, m = sps.csc_matrix(XZ.T.dot(XZ)), sps.csc_matrix(np.vstack([Xty, Zty]))
         M = sps.bmat([[C, m], [m.T, yty]])
-        M = M.tocsc()
+        M = sparse_pattern_union(M.tocsc(), G, X.shape[1])
+        M = sparse_pattern_union(M, sparse_border_pattern(M.shape[0]))
         self.fe_vars = fe_vars
         self.X, self.Z, self.y, self.dims, self.levels = X, Z, y, dims, levels
         self.XZ, self.Xty, self.Zty, self.yty = XZ, Xty, Zty, yty
         self.C, self.m, self.M = C, m, M
         self.theta, self.theta_chol = theta, transform_theta(theta, dims, indices)
         self.G = G
+        # each level occupies a contiguous run of G.data, one block per group
+        self.g_slices = dict([(key, slice(ix[0], ix[-1]+1)) for key, ix in g_indices.items()])
         self.indices = indices
         self.R = sps.eye(Z.shape[0])
-        self.Zs = sps.csc_matrix(Z)
+        self.Zs = Z
+        self.Q = sparse_pattern_union(self.Zs.T.dot(self.Zs), G)
+        self.m_g_ix = sparse_pattern_positions(M, G, X.shape[1])
+        self.q_g_ix = sparse_pattern_positions(self.Q, G)
+        self.m_chol, self.q_chol = analyze(M), analyze(self.Q)
+        # positions of [X Z y]'y in the last row and column of M
+        self.m_y_ix = np.concatenate([M.indptr[1:-1]-1, 
+                                      np.arange(M.indptr[-2], M.indptr[-1])])
+        self.e_y = np.zeros(M.shape[0])
+        self.e_y[-1] = 1.0
+        self.cache = EvalCache()
         self.g_derivs, self.jac_inds = get_jacmats(self.Zs, self.dims, 
                                                    self.indices['theta'],
                                                    self.indices['g'], self.theta)
@@ -313,6 +324,48 @@ class LMM:
  
 
        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # CHOLMOD factors cannot be pickled and are re-analyzed on load
+        for key in ['m_chol', 'q_chol', 'cache']:
+            state.pop(key, None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.m_chol, self.q_chol = analyze(self.M), analyze(self.Q)
+        self.cache = EvalCache()
+    
+    def _set_response(self, y, Xty=None, Zty=None, yty=None):
+        """
+        Parameters
+        ----------
+        y: ndarray
+            New response, in the same row order as the data used to build
+            the model.
+        Xty, Zty, yty: ndarray, optional
+            Precomputed cross products X'y, Z'y and y'y.
+        
+        Returns
+        -------
+        None.
+        
+        Notes
+        -----
+        Only the last row and column of M are rewritten, so the design, 
+        its cross products and the symbolic factorizations are reused.
+        """
+        y = _check_shape(np.asarray(y, dtype=np.double), 2)
+        Xty = self.X.T.dot(y) if Xty is None else Xty
+        Zty = self.Zs.T.dot(y) if Zty is None else Zty
+        yty = y.T.dot(y) if yty is None else np.atleast_2d(yty)
+        m = np.vstack([Xty, Zty])
+        self.y, self.Xty, self.Zty, self.yty = y, Xty, Zty, yty
+        self.m = sps.csc_matrix(m)
+        self.M.data[self.m_y_ix] = np.concatenate([m[:, 0], m[:, 0], 
+                                                   yty.reshape(-1)])
+        self.cache.clear()
+        
     def update_mme(self, Ginv, Rinv):
         """
         Parameters
@@ -331,17 +384,40 @@ class LMM:
         """
         if type(Rinv) in [float, int, np.float64, np.float32, np.float16,
                           np.int, np.int16, np.int32, np.int64]:
-            M = self.M.copy()/Rinv
+            M = self.M / Rinv
         else:
             RZX = Rinv.dot(self.XZ)
             C = sps.csc_matrix(RZX.T.dot(self.XZ))
             Ry = Rinv.dot(self.y)
             m = sps.csc_matrix(np.vstack([self.X.T.dot(Ry), self.Zs.T.dot(Ry)]))
-            M = sps.bmat([[C, m], [m.T, self.y.T.dot(Ry)]]).tocsc()
-        Omega = sp.sparse.block_diag([self.zero_mat, Ginv, self.zero_mat2])
-        M+=Omega
+            M = sps.bmat([[C, m], [m.T, self.y.T.dot(Ry)]])
+            M = sparse_pattern_fill(self.M, M)
+        M.data[self.m_g_ix] += Ginv.data
         return M
     
+    def update_qmat(self, Ginv, Rinv):
+        """
+        Parameters
+        ----------
+        Ginv: sparse matrix
+             scipy sparse matrix with inverse covariance block diagonal
+            
+        Rinv: float or sparse matrix
+            resid covariance if scalar, otherwise its inverse
+        
+        Returns
+        -------
+        Q: sparse matrix
+            Z'R^{-1}Z + G^{-1} on the sparsity pattern analyzed in q_chol
+            
+        """
+        if np.isscalar(Rinv):
+            Q = self.Q / Rinv
+        else:
+            Q = sparse_pattern_fill(self.Q, (Rinv.dot(self.Zs)).T.dot(self.Zs))
+        Q.data[self.q_g_ix] += Ginv.data
+        return Q
+    
     def update_gmat(self, theta, inverse=False):
         """
         Parameters
@@ -358,16 +434,70 @@ class LMM:
             updated random effects covariance
             
         """
-        G = self.G
-        for key in self.levels:
-            ng = self.dims[key]['n_groups']
-            theta_i = theta[self.indices['theta'][key]]
-            if inverse:
-                theta_i = np.linalg.inv(invech(theta_i)).reshape(-1, order='F')
-            else:
-                theta_i = invech(theta_i).reshape(-1, order='F')
-            G.data[self.indices['g'][key]] = np.tile(theta_i, ng)
-        return G
+        if inverse:
+            return self.update_ginv(theta)[0]
+        return update_gmat_blocks(theta, self.G, self.dims, self.indices['theta'],
+                                  self.g_slices)[0]
+    
+    def update_ginv(self, theta):
+        """
+        Parameters
+        ----------
+        theta: ndarray
+             covariance parameters on the original scale
+        
+        Returns
+        -------
+        Ginv: sparse matrix
+            updated inverse of the random effects covariance
+        logdetG: float
+            log determinant of the random effects covariance
+            
+        """
+        return update_gmat_blocks(theta, self.G, self.dims, self.indices['theta'],
+                                  self.g_slices, inverse=True)
+        
+    def _theta_state(self, theta):
+        """
+        Parameters
+        ----------
+        theta: array_like
+            The original parameterization of the model parameters
+        
+        Returns
+        -------
+        state: dict
+            Factor of Q = Z'R^{-1}Z + G^{-1} and the products shared by 
+            loglike, gradient and hessian at theta, reused from the cache 
+            when theta was evaluated recently
+        """
+        state = self.cache(theta)
+        if 'chol_fac' in state:
+            return state
+        s = theta[-1]
+        Ginv, logdetG = self.update_ginv(theta)
+        Ginv = Ginv.copy()
+        if self.rcov is None:
+            RZ, RX, Ry = self.Zs / s, self.X / s, self.y / s
+            XtRX, ZtRX = self.XtX / s, self.ZtX / s
+            XtRy, ZtRy, ytRy = self.Xty / s, self.Zty / s, self.yty / s
+            Q = self.update_qmat(Ginv, s)
+        else:
+            Rinv = self.R / s
+            RZ, RX, Ry = Rinv.dot(self.Zs), Rinv.dot(self.X), Rinv.dot(self.y)
+            XtRX, ZtRX = self.X.T.dot(RX), RZ.T.dot(self.X)
+            XtRy, ZtRy, ytRy = self.X.T.dot(Ry), RZ.T.dot(self.y), self.y.T.dot(Ry)
+            Q = self.update_qmat(Ginv, Rinv)
+        chol_fac = self.q_chol.cholesky(Q)
+        MZtRX, MZtRy = chol_fac.solve_A(ZtRX), chol_fac.solve_A(ZtRy)
+        XtWX = XtRX - ZtRX.T.dot(MZtRX)
+        XtWy = XtRy - ZtRX.T.dot(MZtRy)
+        XtWX_inv = np.linalg.inv(XtWX)
+        ytPy = ytRy - ZtRy.T.dot(MZtRy) - XtWy.T.dot(XtWX_inv.dot(XtWy))
+        state.update(Ginv=Ginv, chol_fac=chol_fac, RZ=RZ, RX=RX, Ry=Ry,
+                     MZtRX=MZtRX, MZtRy=MZtRy, XtWX=XtWX, XtWy=XtWy,
+                     XtWX_inv=XtWX_inv, ytPy=ytPy.item(), logdetG=logdetG)
+        return state
         
     def loglike(self, theta, reml=True, use_sw=False, use_sparse=True):
         """
@@ -382,23 +512,26 @@ class LMM:
         loglike: scalar
             Log likelihood of the model
         """
-        Ginv = self.update_gmat(theta, inverse=True)
-        M = self.update_mme(Ginv, theta[-1])
-        if (M.nnz / np.product(M.shape) < 0.05) and use_sparse:
-            L = cholesky(M.tocsc()).L().A
+        if (self.M.nnz / np.product(self.M.shape) < 0.05) and use_sparse:
+            # logdet(C) = logdet(Q) + logdet(X'V^{-1}X)
+            state = self._theta_state(theta)
+            ytPy, logdetV = state['ytPy'], state['chol_fac'].logdet()
+            logdetC = logdetV + np.linalg.slogdet(state['XtWX'])[1]
+            logdetG = state['logdetG']
         else:
+            Ginv, logdetG = self.update_ginv(theta)
+            M = self.update_mme(Ginv, theta[-1])
             L = np.linalg.cholesky(M.A)
-        ytPy = np.diag(L)[-1]**2
-        logdetG = lndet_gmat(theta, self.dims, self.indices)
+            ytPy = np.diag(L)[-1]**2
+            logdetC = np.sum(2*np.log(np.diag(L))[:-1])
+            if not reml:
+                Q = self.update_qmat(Ginv, theta[-1])
+                self.q_chol.cholesky_inplace(Q)
+                _, logdetV = self.q_chol.slogdet()
         logdetR = np.log(theta[-1]) * self.Z.shape[0]
         if reml:
-            logdetC = np.sum(2*np.log(np.diag(L))[:-1])
             ll = logdetR + logdetC + logdetG + ytPy
         else:
-            Rinv = self.R / theta[-1]
-            RZ = Rinv.dot(self.Zs)
-            Q = Ginv + self.Zs.T.dot(RZ)
-            _, logdetV = cholesky(Q).slogdet()
             ll = logdetR + logdetV + logdetG + ytPy
         return ll
 
@@ -421,8 +554,9 @@ class LMM:
         Rinv = self.R / theta[-1]
         Ginv = self.update_gmat(theta, inverse=True)
         RZ = Rinv.dot(self.Zs)
-        Q = Ginv + self.Zs.T.dot(RZ)
-        M = cholesky(Q).inv()
+        Q = self.update_qmat(Ginv, theta[-1])
+        self.q_chol.cholesky_inplace(Q)
+        M = self.q_chol.inv()
         AtRB = ((Rinv.dot(B)).T.dot(A)).T 
         AtRZ = (RZ.T.dot(A)).T
         ZtRB = RZ.T.dot(B)
@@ -448,40 +582,22 @@ class LMM:
 
             
         """
-        s = theta[-1]
-        Rinv = self.R / s
-        Ginv = self.update_gmat(theta, inverse=True)
-        if self.rcov is None:
-            RZ = self.Zs / s
-            RX = self.X / s
-            Ry = self.y / s
-            ZtRZ = self.ZtZ / s
-            XtRX = self.XtX / s
-            ZtRX = self.ZtX / s
-            ZtRy = self.Zty / s
-        else:
-            RZ = Rinv.dot(self.Zs)
-            RX = Rinv.dot(self.X)
-            Ry = Rinv.dot(self.y)
-            ZtRZ = RZ.T.dot(self.Zs)
-            XtRX = self.X.T.dot(RX) 
-            ZtRX = RZ.T.dot(self.X)
-            ZtRy = RZ.T.dot(self.y)
-            
-        Q = Ginv + ZtRZ
-        M = cholesky(Q).inv()
-        
-        ZtWZ = ZtRZ - ZtRZ.dot(M).dot(ZtRZ)
-        
-        MZtRX = M.dot(ZtRX)
-        
-        XtWX = XtRX - ZtRX.T.dot(MZtRX)
-        XtWX_inv = np.linalg.inv(XtWX)
-        ZtWX = ZtRX - ZtRZ.dot(MZtRX)
-        WX = RX - RZ.dot(MZtRX)
-        U = XtWX_inv.dot(WX.T)
-        Vy = Ry - RZ.dot(M.dot(ZtRy))
-        Py = Vy - WX.dot(U.dot(self.y))
+        Rinv = self.R / theta[-1]
+        state = self._theta_state(theta)
+        Ginv, RZ, MZtRX = state['Ginv'], state['RZ'], state['MZtRX']
+        XtWX_inv = state['XtWX_inv']
+        if 'Py' not in state:
+            M = sparse_selected_inversion(state['chol_fac'])
+            WX = state['RX'] - RZ.dot(MZtRX)
+            Py = state['Ry'] - RZ.dot(state['MZtRy']) \
+                 - WX.dot(XtWX_inv.dot(state['XtWy']))
+            state.update(Qinv=M, WX=WX, Py=Py)
+        M, WX, Py = state['Qinv'], state['WX'], state['Py']
+        # Z'V^{-1}Z = G^{-1} - G^{-1}Q^{-1}G^{-1} and Z'V^{-1}X = G^{-1}Q^{-1}Z'R^{-1}X;
+        # only group diagonal blocks of the former are used, and those 
+        # need only the selected entries of Q^{-1}
+        ZtWZ = Ginv - Ginv.dot(M).dot(Ginv)
+        ZtWX = Ginv.dot(MZtRX)
         ZtPy = self.Zs.T.dot(Py)
         grad = []
         for key in (self.levels):
@@ -500,7 +616,7 @@ class LMM:
                 grad.append(gi)
 
         for dR in self.g_derivs['resid']:
-            g1 = Rinv.diagonal().sum() - (M.dot((RZ.T).dot(dR).dot(RZ))).diagonal().sum()
+            g1 = Rinv.diagonal().sum() - M.multiply((RZ.T).dot(dR).dot(RZ)).sum()
             g2 = Py.T.dot(Py)
             if reml:
                 g3 = np.trace(XtWX_inv.dot(WX.T.dot(WX)))
@@ -531,11 +647,9 @@ class LMM:
         covariances that are yet to be implemented.  
 
         """
-        Ginv = self.update_gmat(theta, inverse=True)
         Rinv = self.R / theta[-1]
         RZ = Rinv.dot(self.Zs)
-        Q = Ginv + self.Zs.T.dot(RZ)
-        M = cholesky(Q).inv()
+        M = self._theta_state(theta)['chol_fac'].inv()
         W = Rinv - RZ.dot(M).dot(RZ.T)
 
         WZ = W.dot(self.Zs)
@@ -783,24 +897,26 @@ class LMM:
         theta = self.theta if theta is None else theta
         Ginv = self.update_gmat(theta, inverse=True)
         M = self.update_mme(Ginv, theta[-1])
-        XZy = self.XZ.T.dot(self.y) / theta[-1]
-        chol_fac = cholesky(M[:-1, :-1].tocsc())
-        betau = chol_fac.solve_A(XZy)
+        self.m_chol.cholesky_inplace(M)
+        # last column of M^{-1} is [-C^{-1}[X Z]'R^{-1}y; 1] / y'Py
+        My = self.m_chol.solve_A(self.e_y)
+        betau = -My[:-1] / My[-1]
         u = betau[self.X.shape[1]:].reshape(-1)
         beta = betau[:self.X.shape[1]].reshape(-1)
         
         Rinv = self.R / theta[-1]
         RZ = Rinv.dot(self.Zs)
-        Q = Ginv + self.Zs.T.dot(RZ)
-        M = cholesky(Q).inv()
+        Q = self.update_qmat(Ginv, theta[-1])
+        self.q_chol.cholesky_inplace(Q)
+        M = self.q_chol.inv()
         XtRinvX = self.X.T.dot(Rinv.dot(self.X)) 
-        XtRinvZ = self.X.T.dot(Rinv.dot(self.Z)) 
+        XtRinvZ = RZ.T.dot(self.X).T
         XtVinvX = XtRinvX - XtRinvZ.dot(M.dot(XtRinvZ.T))
         XtVinvX_inv = np.linalg.inv(XtVinvX)
         return beta, XtVinvX_inv, u
     
     def _optimize(self, reml=True, use_grad=True, use_hess=False, approx_hess=False,
-                  opt_kws={}):
+                  opt_kws={}, theta_init=None):
         """
 
         Parameters
@@ -816,6 +932,9 @@ class LMM:
         opt_kws : dict, optional
             Dictionary of options to use in scipy.optimize.minimize.
             The default is {}.
+        theta_init : ndarray, optional
+            Starting value on the cholesky parameterization. The default is
+            None, which starts from the current theta.
 
         Returns
         -------
@@ -826,6 +945,7 @@ class LMM:
         for key, value in default_opt_kws.items():
                 if key not in opt_kws.keys():
                     opt_kws[key] = value
+        theta_init = self.theta if theta_init is None else theta_init
         if use_grad:
 
             if use_hess:
@@ -834,14 +954,14 @@ class LMM:
                 hess = lambda x, reml: so_gc_cd(self.gradient_chol, x, args=(reml,))
             else:
                 hess = None
-            optimizer = sp.optimize.minimize(self.loglike_c, self.theta, args=(reml,),
+            optimizer = sp.optimize.minimize(self.loglike_c, theta_init, args=(reml,),
                                              jac=self.gradient_chol, hess=hess, 
                                              options=opt_kws, bounds=self.bounds,
                                              method='trust-constr')
         else:
             jac = lambda x, reml: fo_fc_cd(self.loglike_c, x, args=(reml,))
             hess = lambda x, reml: so_fc_cd(self.loglike_c, x, args=(reml,))
-            optimizer = sp.optimize.minimize(self.loglike_c, self.theta, args=(reml,),
+            optimizer = sp.optimize.minimize(self.loglike_c, theta_init, args=(reml,),
                                              jac=jac, hess=hess, bounds=self.bounds,
                                              method='trust-constr', options=opt_kws)
         theta_chol = optimizer.x
@@ -938,7 +1058,7 @@ class LMM:
         return yhat
     
     def fit(self, reml=True, use_grad=True, use_hess=False, approx_hess=False,
-            analytic_se=False, adjusted_pvals=True, opt_kws={}):
+            analytic_se=False, adjusted_pvals=True, opt_kws={}, theta_init=None):
         """
         
 
@@ -958,6 +1078,9 @@ class LMM:
         opt_kws : dict, optional
             Dictionary of options to use in scipy.optimize.minimize.
             The default is {}.
+        theta_init : ndarray, optional
+            Starting value on the cholesky parameterization. The default is
+            None, which starts from the current theta.
 
         Returns
         -------
@@ -965,7 +1088,8 @@ class LMM:
 
         """
         theta, theta_chol, optimizer = self._optimize(reml, use_grad, use_hess, 
-                                                      approx_hess, opt_kws)
+                                                      approx_hess, opt_kws,
+                                                      theta_init)
         self._post_fit(theta, theta_chol, optimizer, reml, use_grad, 
                        analytic_se)
         param_names = list(self.fe_vars)
@@ -988,6 +1112,154 @@ class LMM:
             res.loc[self.fe_vars, 'p'] = adj_table['p']
         self.res = res
     
+    def _fit_responses(self, Y, XtY, ZtY, yty, theta_init, warm_start=True,
+                       fit_kws={}):
+        res = []
+        for j in range(Y.shape[1]):
+            self._set_response(Y[:, [j]], XtY[:, [j]], ZtY[:, [j]], yty[j])
+            kws = dict(fit_kws, opt_kws=dict(fit_kws.get('opt_kws', {})))
+            self.fit(theta_init=theta_init, **kws)
+            if warm_start:
+                theta_init = self.theta_chol.copy()
+            else:
+                theta_init = theta_init.copy()
+            res_j = self.res.copy()
+            res_j['ll'] = self.ll
+            res.append(res_j)
+        return res
+    
+    def fit_many(self, Y, reml=True, use_grad=True, use_hess=False, 
+                 approx_hess=False, analytic_se=False, adjusted_pvals=True,
+                 opt_kws={}, warm_start=True, n_jobs=1):
+        """
+        Parameters
+        ----------
+        Y : ndarray or dataframe
+            n by k array of responses sharing the design of the model, with 
+            rows in the same order as the data used to build it.
+        warm_start : bool, optional
+            If true, each fit starts from the estimate of the response fit 
+            before it, otherwise from the identity covariances used when the 
+            model is built. The default is True.
+        n_jobs : int, optional
+            Number of worker processes the responses are split over, with -1
+            using every core. The default is 1, which fits in this process.
+        
+        The remaining arguments are passed to fit for every response.
+
+        Returns
+        -------
+        res : dataframe
+            The results tables of each response stacked with a (response,
+            parameter) index, along with the -2 log likelihood of each fit.
+            
+        Notes
+        -----
+        X'Y, Z'Y and the diagonal of Y'Y are computed for all responses at 
+        once, after which each fit only rewrites the response row and column 
+        of M, reusing the design, the jacobian matrices and the symbolic 
+        factorizations.  Workers each fit a contiguous block of responses 
+        with warm starts inside the block.  The response and any earlier 
+        fit of the model are restored afterwards.
+
+        """
+        names = Y.columns if isinstance(Y, pd.DataFrame) else np.arange(np.shape(Y)[1])
+        Y = _check_shape(np.asarray(_check_np(Y), dtype=np.double), 2)
+        XtY, ZtY = self.X.T.dot(Y), self.Zs.T.dot(Y)
+        yty = np.einsum("ij,ij->j", Y, Y)
+        fit_kws = dict(reml=reml, use_grad=use_grad, use_hess=use_hess, 
+                       approx_hess=approx_hess, analytic_se=analytic_se,
+                       adjusted_pvals=adjusted_pvals, opt_kws=opt_kws)
+        theta_init = transform_theta(make_theta(self.dims)[0], self.dims, 
+                                     self.indices)
+        y, Xty, Zty, yty0 = self.y, self.Xty, self.Zty, self.yty
+        n_jobs = os.cpu_count() if n_jobs==-1 else n_jobs
+        if n_jobs==1:
+            # fitted attributes are rebound by each fit, so a shallow copy
+            # is enough to put them back
+            state = self.__dict__.copy()
+            res = self._fit_responses(Y, XtY, ZtY, yty, theta_init, warm_start,
+                                      fit_kws)
+            self.__dict__.clear()
+            self.__dict__.update(state)
+        else:
+            blocks = np.array_split(np.arange(Y.shape[1]), n_jobs)
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(self._fit_responses, Y[:, ix], 
+                                           XtY[:, ix], ZtY[:, ix], yty[ix],
+                                           theta_init, warm_start, fit_kws)
+                           for ix in blocks if len(ix)>0]
+                res = [r for f in futures for r in f.result()]
+        self._set_response(y, Xty, Zty, yty0)
+        res = pd.concat(res, keys=names, names=['response', 'param'])
+        return res
+    
+    def _bootstrap_fits(self, sim, seeds, theta_chol):
+        params, se, ll = [], [], []
+        s = np.sqrt(self.theta[-1])
+        for seed in seeds:
+            sim.rng = np.random.default_rng(seed)
+            y = sim.simulate_response(resid_scale=s, exact_ranefs=False,
+                                      exact_resids=False)
+            sim.update_model(self, y)
+            params_i, se_i, opt = sim.sim_fit(self, theta_chol.copy())
+            params.append(params_i)
+            se.append(se_i)
+            ll.append(opt.fun)
+        return np.array(params), np.array(se), np.array(ll)
+    
+    def parametric_bootstrap(self, n_boot=1000, n_jobs=1, seed=None):
+        """
+        Parameters
+        ----------
+        n_boot : int, optional
+            Number of simulated responses to refit. The default is 1000.
+        n_jobs : int, optional
+            Number of worker processes the refits are split over, with -1 
+            using every core. The default is 1.
+        seed : int or SeedSequence, optional
+            Seed from which an independent random stream is spawned for each
+            replicate, so the draws do not depend on n_jobs. The default is 
+            None.
+
+        Returns
+        -------
+        boot_params : dataframe
+            Estimates from each refit.
+        boot_se : dataframe
+            Standard errors from each refit.
+        boot_ll : ndarray
+            -2 restricted log likelihood of each refit, up to a constant.
+        
+        Notes
+        -----
+        Responses are simulated from the fitted model with MixedModelSim and
+        refit on the design of this model, rewriting only the response of 
+        the mixed model matrix.  Each refit starts from the fitted theta.
+        
+        """
+        sim = MixedModelSim.from_model(self)
+        seeds = np.random.SeedSequence(seed).spawn(n_boot) \
+                if not isinstance(seed, np.random.SeedSequence) else seed.spawn(n_boot)
+        theta_chol = self.theta_chol.copy()
+        y, Xty, Zty, yty = self.y, self.Xty, self.Zty, self.yty
+        n_jobs = os.cpu_count() if n_jobs==-1 else n_jobs
+        if n_jobs==1:
+            res = [self._bootstrap_fits(sim, seeds, theta_chol)]
+        else:
+            blocks = np.array_split(np.arange(n_boot), n_jobs)
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(self._bootstrap_fits, sim, 
+                                           [seeds[i] for i in ix], theta_chol)
+                           for ix in blocks if len(ix)>0]
+                res = [f.result() for f in futures]
+        self._set_response(y, Xty, Zty, yty)
+        boot_params = pd.DataFrame(np.concatenate([r[0] for r in res]), 
+                                   columns=self.param_names)
+        boot_se = pd.DataFrame(np.concatenate([r[1] for r in res]), 
+                               columns=self.param_names)
+        boot_ll = np.concatenate([r[2] for r in res])
+        return boot_params, boot_se, boot_ll
     
     def _restricted_ll_grad(self, theta_chol_f, free_ix, theta_chol_r, reml=True):
         theta_chol_r[free_ix] = theta_chol_f
@@ -995,57 +1267,101 @@ class LMM:
         g = self.gradient_chol(theta_chol_r.copy(), reml)[free_ix]
         return ll, g
     
-    def profile(self, n_points=40, par_ind=None, reml=True):
+    def _profile_param(self, i, theta_chol, tspace, llmax, reml=True):
+        free_ix = np.ones_like(theta_chol, dtype=bool)
+        free_ix[i] = False
+        bounds = np.array(self.bounds)[free_ix].tolist()
+        n_points = len(tspace)
+        thetas, zetas = np.zeros((n_points, len(theta_chol))), np.zeros(n_points)
+        # walk outward from the grid point nearest the estimate, starting
+        # each optimization at the solution of the previous point
+        j0 = np.argmin(np.abs(tspace - theta_chol[i]))
+        for grid_walk in [range(j0, n_points), range(j0-1, -1, -1)]:
+            theta_chol_f = theta_chol[free_ix]
+            for j in grid_walk:
+                t0 = tspace[j]
+                theta_chol_r = theta_chol.copy()
+                theta_chol_r[~free_ix] = t0
+                func = lambda x : self._restricted_ll_grad(x, free_ix, theta_chol_r,
+                                                           reml)
+                opt = sp.optimize.minimize(func, theta_chol_f, jac=True,
+                                           bounds=bounds,
+                                           method='trust-constr')
+                theta_chol_f = opt.x
+                theta_chol_r[free_ix] = theta_chol_f
+                LR = 2.0 * (opt.fun - llmax)
+                zetas[j] = np.sqrt(LR) * np.sign(t0 - theta_chol[~free_ix])
+                thetas[j] = theta_chol_r
+        return thetas, zetas
+    
+    def profile(self, n_points=40, par_ind=None, reml=True, n_jobs=1):
+        """
+        Parameters
+        ----------
+        n_points : int, optional
+            Number of grid points for each parameter. The default is 40.
+        reml : bool, optional
+            Whether to profile the restricted likelihood. The default is True.
+        n_jobs : int, optional
+            Number of worker processes the parameters are profiled on, with -1
+            using every core.  Each parameter's grid is walked by one worker, 
+            so the result does not depend on n_jobs. The default is 1.
+
+        Returns
+        -------
+        thetas : ndarray
+            Cholesky parameterization maximizing the likelihood at each grid 
+            point.
+        zetas : ndarray
+            Signed square root of the likelihood ratio at each grid point.
+        ix : ndarray
+            Index of the parameter profiled at each grid point.
+
+        """
         par_ind = np.ones_like(self.theta_chol) if par_ind is None else par_ind
         theta_chol = self.theta_chol.copy()
         n_theta = len(theta_chol)
-        
- 
         llmax = self.loglike(self.theta.copy())
-        free_ix = np.ones_like(theta_chol, dtype=bool)
         
         Hchol = so_gc_cd(self.gradient_chol, theta_chol, args=(reml,))
         se_chol = np.diag(np.linalg.inv(Hchol/2.0))**0.5
-        thetas, zetas = np.zeros((n_theta*n_points, n_theta)), np.zeros(n_theta*n_points)
-        k = 0
-        pbar = tqdm.tqdm(total=n_theta*n_points, smoothing=0.001)
+        tspaces = []
         for i in range(n_theta):
-            free_ix[i] = False
             t_mle = theta_chol[i]
-            theta_chol_r = theta_chol.copy()
             if self.bounds[i][0]==0:
                 lb = np.maximum(0.01, t_mle-4.5*se_chol[i])
             else:
                 lb = t_mle - 4.5 * se_chol[i]
             ub = t_mle + 4.5 * se_chol[i]
-            tspace = np.linspace(lb, ub, n_points)
-            for t0 in tspace:
-                theta_chol_r = theta_chol.copy()
-                theta_chol_r[~free_ix] = t0
-                theta_chol_f = theta_chol[free_ix]
-                func = lambda x : self._restricted_ll_grad(x, free_ix, theta_chol_r,
-                                                           reml)
-                bounds = np.array(self.bounds)[free_ix].tolist()
-                opt = sp.optimize.minimize(func, theta_chol_f, jac=True,
-                                           bounds=bounds,
-                                           method='trust-constr')
-                theta_chol_f = opt.x
-                theta_chol_r[free_ix] = theta_chol_f
-                LR = 2.0 * (opt.fun - llmax)
-                zeta = np.sqrt(LR) * np.sign(t0 - theta_chol[~free_ix])
-                zetas[k] = zeta
-                thetas[k] = theta_chol_r
-                k+=1
+            tspaces.append(np.linspace(lb, ub, n_points))
+        n_jobs = os.cpu_count() if n_jobs==-1 else n_jobs
+        pbar = tqdm.tqdm(total=n_theta, smoothing=0.001)
+        if n_jobs==1:
+            res = []
+            for i in range(n_theta):
+                res.append(self._profile_param(i, theta_chol, tspaces[i], 
+                                               llmax, reml))
                 pbar.update(1)
-            free_ix[i] = True
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(self._profile_param, i, theta_chol,
+                                           tspaces[i], llmax, reml)
+                           for i in range(n_theta)]
+                res = []
+                for f in futures:
+                    res.append(f.result())
+                    pbar.update(1)
         pbar.close()
+        thetas = np.concatenate([r[0] for r in res], axis=0)
+        zetas = np.concatenate([r[1] for r in res])
         ix = np.repeat(np.arange(n_theta), n_points)
         return thetas, zetas, ix
     
-    def plot_profile(self, n_points=40, par_ind=None, reml=True, quantiles=None):
+    def plot_profile(self, n_points=40, par_ind=None, reml=True, quantiles=None,
+                     n_jobs=1):
         if quantiles is None:
             quantiles = [0.001, 0.05, 1, 5, 10, 20, 50, 80, 90, 95, 99, 99.5, 99.999]   
-        thetas, zetas, ix = self.profile(n_points, par_ind, reml)
+        thetas, zetas, ix = self.profile(n_points, par_ind, reml, n_jobs)
         n_thetas = thetas.shape[1]
         q = sp.stats.norm(0, 1).ppf(np.array(quantiles)/100)
         fig, axes = plt.subplots(figsize=(14, 4), ncols=n_thetas, sharey=True)
@@ -1123,7 +1439,8 @@ class WLMM:
             manually before passing the dataframe.
             
         weights : ndarray, optional
-            Array of model weights. The default is None, which sets the
+            Vector of observation weights, or a dense or sparse diagonal 
+            matrix holding them. The default is None, which sets the
             weights to one internally.
 
         Returns
@@ -1131,10 +1448,7 @@ class WLMM:
         None.
 
         """
-        if weights is None:
-            weights = np.eye(len(data))
-        self.weights = sps.csc_matrix(weights)
-        self.weights_inv = sps.csc_matrix(np.linalg.inv(weights))
+        self._set_weights(np.ones(len(data)) if weights is None else weights)
       
         indices = {}
         X, Z, y, dims, levels, fe_vars = construct_model_matrices(formula, data, return_fe=True)
@@ -1146,20 +1460,29 @@ class WLMM:
         indices['g'] = g_indices
     
     
-        XZ, Xty, Zty, yty = np.hstack([X, Z]), X.T.dot(y), Z.T.dot(y), y.T.dot(y)
-        XZ = sp.sparse.csc_matrix(XZ)
+        XZ, Xty, Zty, yty = sps.hstack([X, Z], format='csc'), X.T.dot(y), Z.T.dot(y), y.T.dot(y)
         C, m = sps.csc_matrix(XZ.T.dot(XZ)), sps.csc_matrix(np.vstack([Xty, Zty]))
         M = sps.bmat([[C, m], [m.T, yty]])
-        M = M.tocsc()
+        M = sparse_pattern_union(M.tocsc(), G, X.shape[1])
+        M = sparse_pattern_union(M, sparse_border_pattern(M.shape[0]))
         self.fe_vars = fe_vars
         self.X, self.Z, self.y, self.dims, self.levels = X, Z, y, dims, levels
         self.XZ, self.Xty, self.Zty, self.yty = XZ, Xty, Zty, yty
         self.C, self.m, self.M = C, m, M
         self.theta, self.theta_chol = theta, transform_theta(theta, dims, indices)
         self.G = G
+        # each level occupies a contiguous run of G.data, one block per group
+        self.g_slices = dict([(key, slice(ix[0], ix[-1]+1)) for key, ix in g_indices.items()])
         self.indices = indices
         self.R = sps.eye(Z.shape[0])
-        self.Zs = sps.csc_matrix(Z)
+        self.Zs = Z
+        self.Q = sparse_pattern_union(self.Zs.T.dot(self.Zs), G)
+        self.m_g_ix = sparse_pattern_positions(M, G, X.shape[1])
+        self.q_g_ix = sparse_pattern_positions(self.Q, G)
+        self.m_chol, self.q_chol = analyze(M), analyze(self.Q)
+        self.e_y = np.zeros(M.shape[0])
+        self.e_y[-1] = 1.0
+        self.cache = EvalCache()
         self.g_derivs, self.jac_inds = get_jacmats(self.Zs, self.dims, 
                                                    self.indices['theta'],
                                                    self.indices['g'], self.theta)
@@ -1176,11 +1499,48 @@ class WLMM:
         self.bounds_2 = [(1e-6, None) if x==1 else (None, None) for x in self.theta[:-1]]+[(None, None)]
         self.zero_mat = sp.sparse.eye(self.X.shape[1])*0.0
         self.zero_mat2 = sp.sparse.eye(1)*0.0
-        self.rcov = self.weights
-    
         self.fixed_resid_cov = fixed_resid_cov
 
        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # CHOLMOD factors cannot be pickled and are re-analyzed on load
+        for key in ['m_chol', 'q_chol', 'cache']:
+            state.pop(key, None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.m_chol, self.q_chol = analyze(self.M), analyze(self.Q)
+        self.cache = EvalCache()
+        
+    def _set_weights(self, weights):
+        """
+        Parameters
+        ----------
+        weights: ndarray or sparse matrix
+            Vector of observation weights or a diagonal matrix holding them
+        
+        Returns
+        -------
+        None.
+        
+        Notes
+        -----
+        The weights and their inverse are stored as sparse diagonal
+        matrices, so memory and work stay linear in the number of 
+        observations.
+        """
+        if sps.issparse(weights) or np.ndim(weights)==2:
+            weights = sps.csc_matrix(weights)
+            if (weights - sps.diags(weights.diagonal())).count_nonzero()>0:
+                raise ValueError("weights must be diagonal")
+            weights = weights.diagonal()
+        w = np.asarray(weights, dtype=np.double).reshape(-1)
+        self.weights = sps.diags(w, format='csc')
+        self.weights_inv = sps.diags(1.0 / w, format='csc')
+        self.rcov = self.weights
+        
     def update_mme(self, Ginv, Rinv):
         """
         Parameters
@@ -1199,17 +1559,40 @@ class WLMM:
         """
         if type(Rinv) in [float, int, np.float64, np.float32, np.float16,
                           np.int, np.int16, np.int32, np.int64]:
-            M = self.M.copy()/Rinv
+            M = self.M / Rinv
         else:
             RZX = Rinv.dot(self.XZ)
             C = sps.csc_matrix(RZX.T.dot(self.XZ))
             Ry = Rinv.dot(self.y)
             m = sps.csc_matrix(np.vstack([self.X.T.dot(Ry), self.Zs.T.dot(Ry)]))
-            M = sps.bmat([[C, m], [m.T, self.y.T.dot(Ry)]]).tocsc()
-        Omega = sp.sparse.block_diag([self.zero_mat, Ginv, self.zero_mat2])
-        M+=Omega
+            M = sps.bmat([[C, m], [m.T, self.y.T.dot(Ry)]])
+            M = sparse_pattern_fill(self.M, M)
+        M.data[self.m_g_ix] += Ginv.data
         return M
     
+    def update_qmat(self, Ginv, Rinv):
+        """
+        Parameters
+        ----------
+        Ginv: sparse matrix
+             scipy sparse matrix with inverse covariance block diagonal
+            
+        Rinv: float or sparse matrix
+            resid covariance if scalar, otherwise its inverse
+        
+        Returns
+        -------
+        Q: sparse matrix
+            Z'R^{-1}Z + G^{-1} on the sparsity pattern analyzed in q_chol
+            
+        """
+        if np.isscalar(Rinv):
+            Q = self.Q / Rinv
+        else:
+            Q = sparse_pattern_fill(self.Q, (Rinv.dot(self.Zs)).T.dot(self.Zs))
+        Q.data[self.q_g_ix] += Ginv.data
+        return Q
+    
     def update_gmat(self, theta, inverse=False):
         """
         Parameters
@@ -1226,16 +1609,64 @@ class WLMM:
             updated random effects covariance
             
         """
-        G = self.G
-        for key in self.levels:
-            ng = self.dims[key]['n_groups']
-            theta_i = theta[self.indices['theta'][key]]
-            if inverse:
-                theta_i = np.linalg.inv(invech(theta_i)).reshape(-1, order='F')
-            else:
-                theta_i = invech(theta_i).reshape(-1, order='F')
-            G.data[self.indices['g'][key]] = np.tile(theta_i, ng)
-        return G
+        if inverse:
+            return self.update_ginv(theta)[0]
+        return update_gmat_blocks(theta, self.G, self.dims, self.indices['theta'],
+                                  self.g_slices)[0]
+    
+    def update_ginv(self, theta):
+        """
+        Parameters
+        ----------
+        theta: ndarray
+             covariance parameters on the original scale
+        
+        Returns
+        -------
+        Ginv: sparse matrix
+            updated inverse of the random effects covariance
+        logdetG: float
+            log determinant of the random effects covariance
+            
+        """
+        return update_gmat_blocks(theta, self.G, self.dims, self.indices['theta'],
+                                  self.g_slices, inverse=True)
+        
+    def _theta_state(self, theta):
+        """
+        Parameters
+        ----------
+        theta: array_like
+            The original parameterization of the model parameters
+        
+        Returns
+        -------
+        state: dict
+            Factor of Q = Z'R^{-1}Z + G^{-1} and the products shared by 
+            loglike, gradient and hessian at theta, reused from the cache 
+            when theta was evaluated recently
+        """
+        state = self.cache(theta)
+        if 'chol_fac' in state:
+            return state
+        s = 1.0 if self.fixed_resid_cov else theta[-1]
+        Rinv = self.weights_inv.dot(self.R / s).dot(self.weights_inv)
+        Ginv, logdetG = self.update_ginv(theta)
+        Ginv = Ginv.copy()
+        RZ, RX, Ry = Rinv.dot(self.Zs), Rinv.dot(self.X), Rinv.dot(self.y)
+        XtRX, ZtRX = self.X.T.dot(RX), RZ.T.dot(self.X)
+        XtRy, ZtRy, ytRy = self.X.T.dot(Ry), RZ.T.dot(self.y), self.y.T.dot(Ry)
+        Q = self.update_qmat(Ginv, Rinv)
+        chol_fac = self.q_chol.cholesky(Q)
+        MZtRX, MZtRy = chol_fac.solve_A(ZtRX), chol_fac.solve_A(ZtRy)
+        XtWX = XtRX - ZtRX.T.dot(MZtRX)
+        XtWy = XtRy - ZtRX.T.dot(MZtRy)
+        XtWX_inv = np.linalg.inv(XtWX)
+        ytPy = ytRy - ZtRy.T.dot(MZtRy) - XtWy.T.dot(XtWX_inv.dot(XtWy))
+        state.update(Ginv=Ginv, chol_fac=chol_fac, RZ=RZ, RX=RX, Ry=Ry,
+                     MZtRX=MZtRX, MZtRy=MZtRy, XtWX=XtWX, XtWy=XtWy,
+                     XtWX_inv=XtWX_inv, ytPy=ytPy.item(), logdetG=logdetG)
+        return state
         
     def loglike(self, theta, reml=True, use_sw=False, use_sparse=True):
         """
@@ -1250,25 +1681,28 @@ class WLMM:
         loglike: scalar
             Log likelihood of the model
         """
-        s = 1.0 if self.fixed_resid_cov else theta[-1]
-        Rinv = self.weights_inv.dot(self.R / s).dot(self.weights_inv)
-        Ginv = self.update_gmat(theta, inverse=True)
-        M = self.update_mme(Ginv, Rinv)
-        if (M.nnz / np.product(M.shape) < 0.05) and use_sparse:
-            L = cholesky(M.tocsc()).L().A
+        if (self.M.nnz / np.product(self.M.shape) < 0.05) and use_sparse:
+            # logdet(C) = logdet(Q) + logdet(X'V^{-1}X)
+            state = self._theta_state(theta)
+            ytPy, logdetV = state['ytPy'], state['chol_fac'].logdet()
+            logdetC = logdetV + np.linalg.slogdet(state['XtWX'])[1]
+            logdetG = state['logdetG']
         else:
+            s = 1.0 if self.fixed_resid_cov else theta[-1]
+            Rinv = self.weights_inv.dot(self.R / s).dot(self.weights_inv)
+            Ginv, logdetG = self.update_ginv(theta)
+            M = self.update_mme(Ginv, Rinv)
             L = np.linalg.cholesky(M.A)
-        ytPy = np.diag(L)[-1]**2
-        logdetG = lndet_gmat(theta, self.dims, self.indices)
+            ytPy = np.diag(L)[-1]**2
+            logdetC = np.sum(2*np.log(np.diag(L))[:-1])
+            if not reml:
+                Q = self.update_qmat(Ginv, Rinv)
+                self.q_chol.cholesky_inplace(Q)
+                _, logdetV = self.q_chol.slogdet()
         logdetR = np.log(theta[-1]) * self.Z.shape[0]
         if reml:
-            logdetC = np.sum(2*np.log(np.diag(L))[:-1])
             ll = logdetR + logdetC + logdetG + ytPy
         else:
-            Rinv = self.R / theta[-1]
-            RZ = Rinv.dot(self.Zs)
-            Q = Ginv + self.Zs.T.dot(RZ)
-            _, logdetV = cholesky(Q).slogdet()
             ll = logdetR + logdetV + logdetG + ytPy
         return ll
 
@@ -1292,10 +1726,11 @@ class WLMM:
         Rinv = self.weights_inv.dot(self.R / s).dot(self.weights_inv)
         Ginv = self.update_gmat(theta, inverse=True)
         RZ = Rinv.dot(self.Zs)
-        Q = Ginv + self.Zs.T.dot(RZ)
-        M = cholesky(Q).inv()
+        Q = self.update_qmat(Ginv, Rinv)
+        self.q_chol.cholesky_inplace(Q)
+        M = self.q_chol.inv()
         XtRX = X.T.dot(Rinv.dot(X)) 
-        XtRZ = X.T.dot(Rinv.dot(self.Z)) 
+        XtRZ = RZ.T.dot(X).T
         XtVX = XtRX - XtRZ.dot(M.dot(XtRZ.T))
         return XtVX
 
@@ -1320,30 +1755,21 @@ class WLMM:
         """
         s = 1.0 if self.fixed_resid_cov else theta[-1]
         Rinv = self.weights_inv.dot(self.R / s).dot(self.weights_inv)
-        Ginv = self.update_gmat(theta, inverse=True)
-
-        RZ = Rinv.dot(self.Zs)
-        RX = Rinv.dot(self.X)
-        Ry = Rinv.dot(self.y)
-        ZtRZ = RZ.T.dot(self.Zs)
-        XtRX = self.X.T.dot(RX) 
-        ZtRX = RZ.T.dot(self.X)
-        ZtRy = RZ.T.dot(self.y)
-            
-        Q = Ginv + ZtRZ
-        M = cholesky(Q).inv()
-        
-        ZtWZ = ZtRZ - ZtRZ.dot(M).dot(ZtRZ)
-        
-        MZtRX = M.dot(ZtRX)
-        
-        XtWX = XtRX - ZtRX.T.dot(MZtRX)
-        XtWX_inv = np.linalg.inv(XtWX)
-        ZtWX = ZtRX - ZtRZ.dot(MZtRX)
-        WX = RX - RZ.dot(MZtRX)
-        U = XtWX_inv.dot(WX.T)
-        Vy = Ry - RZ.dot(M.dot(ZtRy))
-        Py = Vy - WX.dot(U.dot(self.y))
+        state = self._theta_state(theta)
+        Ginv, RZ, MZtRX = state['Ginv'], state['RZ'], state['MZtRX']
+        XtWX_inv = state['XtWX_inv']
+        if 'Py' not in state:
+            M = sparse_selected_inversion(state['chol_fac'])
+            WX = state['RX'] - RZ.dot(MZtRX)
+            Py = state['Ry'] - RZ.dot(state['MZtRy']) \
+                 - WX.dot(XtWX_inv.dot(state['XtWy']))
+            state.update(Qinv=M, WX=WX, Py=Py)
+        M, WX, Py = state['Qinv'], state['WX'], state['Py']
+        # Z'V^{-1}Z = G^{-1} - G^{-1}Q^{-1}G^{-1} and Z'V^{-1}X = G^{-1}Q^{-1}Z'R^{-1}X;
+        # only group diagonal blocks of the former are used, and those 
+        # need only the selected entries of Q^{-1}
+        ZtWZ = Ginv - Ginv.dot(M).dot(Ginv)
+        ZtWX = Ginv.dot(MZtRX)
         ZtPy = self.Zs.T.dot(Py)
         grad = []
         for key in (self.levels):
@@ -1362,7 +1788,7 @@ class WLMM:
                 grad.append(gi)
 
         for dR in self.g_derivs['resid']:
-            g1 = Rinv.diagonal().sum() - (M.dot((RZ.T).dot(dR).dot(RZ))).diagonal().sum()
+            g1 = Rinv.diagonal().sum() - M.multiply((RZ.T).dot(dR).dot(RZ)).sum()
             g2 = Py.T.dot(Py)
             if reml:
                 g3 = np.trace(XtWX_inv.dot(WX.T.dot(WX)))
@@ -1395,11 +1821,8 @@ class WLMM:
         """
         s = 1.0 if self.fixed_resid_cov else theta[-1]
         Rinv = self.weights_inv.dot(self.R / s).dot(self.weights_inv)
-        Ginv = self.update_gmat(theta, inverse=True)
-
         RZ = Rinv.dot(self.Zs)
-        Q = Ginv + self.Zs.T.dot(RZ)
-        M = cholesky(Q).inv()
+        M = self._theta_state(theta)['chol_fac'].inv()
         W = Rinv - RZ.dot(M).dot(RZ.T)
 
         WZ = W.dot(self.Zs)
@@ -1649,24 +2072,31 @@ class WLMM:
         theta = self.theta if theta is None else theta
         Ginv = self.update_gmat(theta, inverse=True)
         M = self.update_mme(Ginv, Rinv)
-        XZy = self.XZ.T.dot(Rinv.dot(self.y))
-        chol_fac = cholesky(M[:-1, :-1].tocsc())
-        betau = chol_fac.solve_A(XZy)
+        self.m_chol.cholesky_inplace(M)
+        # last column of M^{-1} is [-C^{-1}[X Z]'R^{-1}y; 1] / y'Py
+        My = self.m_chol.solve_A(self.e_y)
+        betau = -My[:-1] / My[-1]
         u = betau[self.X.shape[1]:].reshape(-1)
         beta = betau[:self.X.shape[1]].reshape(-1)
         
 
         RZ = Rinv.dot(self.Zs)
-        Q = Ginv + self.Zs.T.dot(RZ)
-        M = cholesky(Q).inv()
+        Q = self.update_qmat(Ginv, Rinv)
+        self.q_chol.cholesky_inplace(Q)
+        M = self.q_chol.inv()
         XtRinvX = self.X.T.dot(Rinv.dot(self.X)) 
-        XtRinvZ = self.X.T.dot(Rinv.dot(self.Z)) 
+        XtRinvZ = RZ.T.dot(self.X).T
         XtVinvX = XtRinvX - XtRinvZ.dot(M.dot(XtRinvZ.T))
         XtVinvX_inv = np.linalg.inv(XtVinvX)
         return beta, XtVinvX_inv, u
     
+    def _project_theta(self, theta):
+        lb = np.array([-np.inf if b[0] is None else b[0] for b in self.bounds])
+        ub = np.array([np.inf if b[1] is None else b[1] for b in self.bounds])
+        return np.clip(theta, lb, ub)
+    
     def _optimize(self, reml=True, use_grad=True, use_hess=False, approx_hess=False,
-                  opt_kws={}):
+                  opt_kws={}, theta_init=None):
         """
 
         Parameters
@@ -1682,38 +2112,61 @@ class WLMM:
         opt_kws : dict, optional
             Dictionary of options to use in scipy.optimize.minimize.
             The default is {}.
+        theta_init : ndarray, optional
+            Starting value on the cholesky parameterization, which is 
+            projected onto the bounds. The default is None, which starts 
+            from the current theta.
 
         Returns
         -------
         None.
+        
+        Notes
+        -----
+        Parameters whose lower and upper bounds are equal, like the residual
+        variance of non-gaussian GLMMs, are held at that value and left out
+        of the vector passed to the optimizer, since trust-constr does not
+        keep them fixed and never reports success with them included.
 
         """
         default_opt_kws = dict(verbose=0, gtol=1e-6, xtol=1e-6)
         for key, value in default_opt_kws.items():
                 if key not in opt_kws.keys():
                     opt_kws[key] = value
+        theta_init = self.theta if theta_init is None else theta_init
+        theta_init = self._project_theta(theta_init)
+        free = np.array([b[0] is None or b[0]!=b[1] for b in self.bounds])
+        bounds = [b for b, is_free in zip(self.bounds, free) if is_free]
+        
+        def expand(x):
+            theta_chol = theta_init.copy()
+            theta_chol[free] = x
+            return theta_chol
+        
         if use_grad:
-
+            grad = self.gradient_chol
             if use_hess:
-               hess = self.hessian_chol
+                hess = self.hessian_chol
             elif approx_hess:
                 hess = lambda x, reml: so_gc_cd(self.gradient_chol, x, args=(reml,))
             else:
                 hess = None
-            optimizer = sp.optimize.minimize(self.loglike_c, self.theta, args=(reml,),
-                                             jac=self.gradient_chol, hess=hess, 
-                                             options=opt_kws, bounds=self.bounds,
-                                             method='trust-constr')
         else:
-            jac = lambda x, reml: fo_fc_cd(self.loglike_c, x, args=(reml,))
+            grad = lambda x, reml: fo_fc_cd(self.loglike_c, x, args=(reml,))
             hess = lambda x, reml: so_fc_cd(self.loglike_c, x, args=(reml,))
-            optimizer = sp.optimize.minimize(self.loglike_c, self.theta, args=(reml,),
-                                             jac=jac, hess=hess, bounds=self.bounds,
-                                             method='trust-constr', options=opt_kws)
+        func = lambda x, reml: self.loglike_c(expand(x), reml)
+        jac = lambda x, reml: grad(expand(x), reml)[free]
+        hess_free = None if hess is None else \
+                    lambda x, reml: hess(expand(x), reml)[np.ix_(free, free)]
+        optimizer = sp.optimize.minimize(func, theta_init[free], args=(reml,),
+                                         jac=jac, hess=hess_free, bounds=bounds,
+                                         method='trust-constr', options=opt_kws)
+        optimizer.x = expand(optimizer.x)
         theta_chol = optimizer.x
         theta = inverse_transform_theta(theta_chol.copy(), self.dims, self.indices)
         return theta, theta_chol, optimizer
         
+        
     def _post_fit(self, theta, theta_chol, optimizer, reml=True,
                   use_grad=True, analytic_se=False):
         """
@@ -1965,13 +2418,12 @@ class GLMM(WLMM):
     
     def _update_model(self, W, nu):
         nu = _check_shape(nu, 2)
-        self.weights = sps.csc_matrix(W)
-        self.weights_inv = sps.csc_matrix(np.diag(1.0/np.diag((W))))
+        self._set_weights(W)
         self.y = nu
         self.Xty = self.X.T.dot(nu)
         self.Zty = self.Z.T.dot(nu)
-        self.theta = self.theta_init
         self.yty = nu.T.dot(nu)
+        self.cache.clear()
         
         
     
@@ -1981,25 +2433,70 @@ class GLMM(WLMM):
         var_mu = _check_shape(self.f.var_func(mu=mu), 1)
         gp = self.f.dlink(mu)
         nu = eta + gp * (_check_shape(self.y_original, 1) - mu)
-        W = np.diag(np.sqrt(var_mu * (self.f.dlink(mu)**2)))
+        W = np.sqrt(var_mu * (self.f.dlink(mu)**2))
         return W, nu
 
-    def fit(self, n_iters=200, tol=1e-3, optimizer_kwargs={}, verbose_outer=True):
+    def fit(self, n_iters=200, tol=1e-3, optimizer_kwargs={}, verbose_outer=True,
+            warm_start=True, inner_tol=(1e-3, 1e-6)):
+        """
+        Parameters
+        ----------
+        n_iters : int, optional
+            Maximum number of pseudo-likelihood iterations. The default is 200.
+        tol : float, optional
+            Relative change in theta at which the iterations stop. The 
+            default is 1e-3.
+        optimizer_kwargs : dict, optional
+            Arguments passed to _optimize. A gtol or xtol given in its 
+            opt_kws is used for every solve in place of the inner_tol 
+            schedule. The default is {}.
+        verbose_outer : bool, optional
+            If true, the change in theta is printed each iteration. The 
+            default is True.
+        warm_start : bool, optional
+            If true, each iteration starts the optimizer at the previous 
+            estimate of theta, otherwise at its initial value.  Either start
+            is projected onto the bounds first. The default is True.
+        inner_tol : tuple, optional
+            Loosest and final gtol and xtol of the optimizer.  The tolerance
+            starts loose and follows a tenth of the last change in theta down
+            to the final value, and the iterations only stop after a 
+            successful solve at the final tolerance. The default is 
+            (1e-3, 1e-6).
+
+        Returns
+        -------
+        None.
+
+        """
         theta, theta_chol, optimizer = self.theta, self.theta_chol, self.optimizer
+        loose_tol, final_tol = inner_tol
+        itol = loose_tol
         fit_hist = {}
         for i in range(n_iters):
+            t = time.perf_counter()
             W, nu = self._get_pseudovar()
             self._update_model(W, nu)
-            theta_new, theta_chol_new, optimizer_new = self._optimize(**optimizer_kwargs)
+            opt_kws = dict(dict(gtol=itol, xtol=itol), **optimizer_kwargs.get('opt_kws', {}))
+            theta_init = theta_chol.copy() if warm_start else self.theta_init.copy()
+            theta_new, theta_chol_new, optimizer_new = self._optimize(**dict(optimizer_kwargs, opt_kws=opt_kws),
+                                                                      theta_init=theta_init)
             tvar = (np.linalg.norm(theta)+np.linalg.norm(theta_new))
             eps = np.linalg.norm(theta - theta_new) / tvar
-            fit_hist[i] = dict(param_change=eps, theta=theta_new, nu=nu)
+            fit_hist[i] = dict(param_change=eps, theta=theta_new, nu=nu,
+                               inner_tol=itol, inner_iters=optimizer_new.nit,
+                               inner_fevals=optimizer_new.nfev,
+                               inner_success=optimizer_new.success,
+                               time=time.perf_counter()-t)
             if verbose_outer:
                 print(eps)
-            if eps < tol:
-                break
             theta, theta_chol, optimizer = theta_new, theta_chol_new, optimizer_new
             self.beta, _, self.u = self._compute_effects(theta)
+            small_change = optimizer_new.success and eps < tol
+            if small_change and itol <= final_tol:
+                break
+            itol = final_tol if small_change else max(final_tol, min(itol, eps / 10.0))
+        self.fit_hist = fit_hist
         self._post_fit(theta, theta_chol, optimizer)
         self.res = get_param_table(self.params, self.se_params, 
                                    self.X.shape[0]-len(self.params))
@@ -2043,6 +2540,411 @@ class GLMM(WLMM):
         param_names.append("resid_cov")
         self.param_names = param_names
         self.res.index = param_names
+
+
+class GLMM_Laplace:
+    '''
+    GLMM fit by the Laplace approximation to the marginal likelihood, for 
+    any combination of crossed and nested random effects.  For each theta 
+    the conditional modes are found by penalized iteratively reweighted 
+    least squares on Z'WZ+G^{-1}, whose sparsity pattern is fixed, so CHOLMOD 
+    analyzes it once and only the numeric factorization is repeated.
+    '''
+    def __init__(self, formula, data, family):
+        """
+        Parameters
+        ----------
+        formula : string
+            lme4 style formula with random effects specified by terms in 
+            parentheses with a bar
+        data : dataframe
+            Dataframe containing data.  Missing values should be dropped 
+            manually before passing the dataframe.
+        family : ExponentialFamily
+            Family from pyglm.families supplying the link, variance and 
+            log likelihood, along with any prior weights such as the number
+            of trials of a binomial proportion.
+
+        Returns
+        -------
+        None.
+
+        """
+        if isinstance(family, ExponentialFamily)==False:
+            family = family()
+        indices = {}
+        X, Z, y, dims, levels, fe_vars = construct_model_matrices(formula, data, return_fe=True)
+        theta, theta_indices = make_theta(dims)
+        indices['theta'] = theta_indices
+        G, g_indices = make_gcov(theta, indices, dims)
+        indices['g'] = g_indices
+        self.f = family
+        self.fe_vars = fe_vars
+        self.X, self.Zs, self.y = X, Z, _check_shape(y, 1)
+        self.Zt = Z.T.tocsc()
+        self.dims, self.levels, self.indices = dims, levels, indices
+        self.G = G
+        self.g_slices = dict([(key, slice(ix[0], ix[-1]+1)) for key, ix in g_indices.items()])
+        self.Q = sparse_pattern_union(self.Zt.dot(self.Zs), G)
+        self.q_g_ix = sparse_pattern_positions(self.Q, G)
+        self.q_chol = analyze(self.Q)
+        self.weights = np.ones(X.shape[0]) * family.weights
+        self.bounds = [(1e-6, None) if x==1 else (None, None) for x in theta[:-1]]
+        self.theta = theta
+        self.theta_chol = transform_theta(theta.copy(), dims, indices)
+        self.n_theta = len(theta) - 1
+        self.beta = np.zeros(X.shape[1])
+        self.u = np.zeros(Z.shape[1])
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # CHOLMOD factors cannot be pickled and are re-analyzed on load
+        state.pop('q_chol', None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.q_chol = analyze(self.Q)
+    
+    def update_ginv(self, theta):
+        """
+        Parameters
+        ----------
+        theta: ndarray
+             covariance parameters on the original scale
+        
+        Returns
+        -------
+        Ginv: sparse matrix
+            updated inverse of the random effects covariance
+        logdetG: float
+            log determinant of the random effects covariance
+            
+        """
+        return update_gmat_blocks(theta, self.G, self.dims, self.indices['theta'],
+                                  self.g_slices, inverse=True)
+    
+    def _penalized_deviance(self, beta, u, Ginv):
+        mu = self.f.inv_link(self.X.dot(beta) + self.Zs.dot(u))
+        dev = 2.0 * np.sum(self.f._full_loglike(self.y, mu=mu)) + u.dot(Ginv.dot(u))
+        return dev
+    
+    def _working_system(self, beta, u, Ginv):
+        eta = self.X.dot(beta) + self.Zs.dot(u)
+        mu = self.f.inv_link(eta)
+        dmu = self.f.dinv_link(eta)
+        w = self.weights * dmu**2 / self.f.var_func(mu=mu)
+        z = eta + (self.y - mu) / dmu
+        ZtW = self.Zt.dot(sps.diags(w))
+        Q = sparse_pattern_fill(self.Q, ZtW.dot(self.Zs))
+        Q.data[self.q_g_ix] += Ginv.data
+        return ZtW, w, z, self.q_chol.cholesky(Q)
+    
+    def pirls(self, theta, beta=None, tol=1e-12, n_iters=100, n_halvings=20):
+        """
+        Parameters
+        ----------
+        theta : ndarray
+            Covariance parameters on the original scale.
+        beta : ndarray, optional
+            Fixed effects, which if None are updated along with the random
+            effects. The default is None.
+        tol : float, optional
+            Relative change in the penalized deviance at which the 
+            iterations stop. The default is 1e-12.
+        n_iters : int, optional
+            Maximum number of iterations. The default is 100.
+        n_halvings : int, optional
+            Maximum number of step halvings per iteration. The default is 20.
+
+        Returns
+        -------
+        deviance : float
+            Laplace approximation of -2 times the log likelihood at the 
+            modes.
+        beta : ndarray
+            Fixed effects.
+        u : ndarray
+            Conditional modes of the random effects.
+        XtVinvX : ndarray
+            Schur complement of Z'WZ+G^{-1} in the weighted crossproduct of
+            [X, Z] with the penalty added, whose inverse approximates the 
+            covariance of beta.
+
+        Notes
+        -----
+        Each iteration solves the penalized weighted least squares problem
+        for the working response, with beta obtained from the p by p 
+        Schur complement, and halves the step until the penalized deviance
+        does not increase.  Iterations start from the modes of the previous
+        call.
+        """
+        return self._pirls(theta, beta, tol, n_iters, n_halvings)[:4]
+    
+    def _pirls(self, theta, beta=None, tol=1e-12, n_iters=100, n_halvings=20):
+        Ginv, logdetG = self.update_ginv(theta)
+        update_beta = beta is None
+        beta = self.beta.copy() if update_beta else beta
+        u = self.u.copy()
+        pdev = self._penalized_deviance(beta, u, Ginv)
+        for i in range(n_iters):
+            ZtW, w, z, fac = self._working_system(beta, u, Ginv)
+            if update_beta:
+                ZtWX = ZtW.dot(self.X)
+                MZtWX, MZtWz = fac.solve_A(ZtWX), fac.solve_A(ZtW.dot(z))
+                S = self.X.T.dot(self.X * w[:, None]) - ZtWX.T.dot(MZtWX)
+                beta_new = np.linalg.solve(S, self.X.T.dot(w * z) - ZtWX.T.dot(MZtWz))
+                u_new = MZtWz - MZtWX.dot(beta_new)
+            else:
+                beta_new = beta
+                u_new = fac.solve_A(ZtW.dot(z - self.X.dot(beta)))
+            db, du = beta_new - beta, u_new - u
+            for k in range(n_halvings):
+                pdev_new = self._penalized_deviance(beta + db, u + du, Ginv)
+                if pdev_new <= pdev:
+                    break
+                db, du = db / 2.0, du / 2.0
+            if not pdev_new <= pdev:
+                break
+            beta, u = beta + db, u + du
+            converged = (pdev - pdev_new) < tol * (np.abs(pdev_new) + 1.0)
+            pdev = pdev_new
+            if converged:
+                break
+        ZtW, w, z, fac = self._working_system(beta, u, Ginv)
+        ZtWX = ZtW.dot(self.X)
+        XtVinvX = self.X.T.dot(self.X * w[:, None]) - ZtWX.T.dot(fac.solve_A(ZtWX))
+        self.beta, self.u = beta, u
+        deviance = pdev + logdetG + fac.logdet()
+        return deviance, beta, u, XtVinvX, Ginv, fac
+    
+    def _obs_derivs(self, eta):
+        mu, dmu = self.f.inv_link(eta), self.f.dinv_link(eta)
+        v, d2mu, v1 = self.f.var_func(mu=mu), self.f.d2inv_link(eta), self.f.dvar_dmu(mu)
+        u = d2mu / v - dmu**2 * v1 / v**2
+        s = self.weights * (self.y - mu) * dmu / v
+        ds = self.weights * ((self.y - mu) * u - dmu**2 / v)
+        dw = self.weights * dmu * (u + d2mu / v)
+        return s, ds, dw
+    
+    def _laplace_gradient(self, theta_chol_re, beta, u, Ginv, fac, profile_beta):
+        """
+        Parameters
+        ----------
+        theta_chol_re : ndarray
+            Random effect covariance parameters on the cholesky 
+            parameterization.
+        beta, u : ndarray
+            Fixed effects and conditional modes returned by PIRLS.
+        Ginv : sparse matrix
+            Inverse of the random effects covariance.
+        fac : Factor
+            CHOLMOD factor of Q=Z'WZ+G^{-1} at the modes.
+        profile_beta : bool
+            Whether beta was updated by PIRLS along with u, in which case 
+            only the gradient with respect to theta_chol_re is returned, 
+            and otherwise the gradient with respect to beta follows it.
+
+        Returns
+        -------
+        grad : ndarray
+            Gradient of the Laplace deviance.
+        
+        Notes
+        -----
+        With D = -2l(y|eta) + u'G^{-1}u + log|G| + log|Q| at the modes, the 
+        derivative along a direction dSigma of one level's covariance 
+        Sigma, with A=Sigma^{-1}dSigma Sigma^{-1}, is
+        
+            -sum_g u_g'Au_g + n_g tr(Sigma^{-1}dSigma) - sum_g tr(Q^{-1}_gg A)
+            + sum_i w'_i h_i deta_i
+        
+        where the first term is all that remains of the penalized deviance
+        at its minimum, h is the diagonal of ZQ^{-1}Z', read from the 
+        selected inverse of Q, and deta is the change in the linear 
+        predictor through the modes, given by the implicit function theorem
+        with the observed information Z'W~Z+G^{-1} of the modes.  No 
+        further PIRLS solves are needed.
+        """
+        X, Z = self.X, self.Zs
+        s, ds, dw = self._obs_derivs(X.dot(beta) + Z.dot(u))
+        Qinv = sparse_selected_inversion(fac).tocsr()
+        h = np.asarray(Z.dot(Qinv).multiply(Z).sum(axis=1)).reshape(-1)
+        dwh = dw * h
+        ZtWo = self.Zt.dot(sps.diags(-ds))
+        Qo = sparse_pattern_fill(self.Q, ZtWo.dot(Z))
+        Qo.data[self.q_g_ix] += Ginv.data
+        fac_o = self.q_chol.cholesky(Qo)
+        grad, B, start = np.zeros(self.n_theta), np.zeros((Z.shape[1], self.n_theta)), 0
+        for key in self.g_slices:
+            ng, nv = self.dims[key]['n_groups'], self.dims[key]['n_vars']
+            ix = self.indices['theta'][key]
+            L = invech_chol(theta_chol_re[ix])
+            Sigma_inv = np.linalg.inv(L.dot(L.T))
+            u_ix = start + np.arange(ng * nv).reshape(ng, nv)
+            U = u[u_ix]
+            r, c = np.broadcast_arrays(u_ix[:, :, None], u_ix[:, None, :])
+            C = np.asarray(Qinv[r.reshape(-1), c.reshape(-1)]).reshape(ng, nv, nv).sum(axis=0)
+            for m in range(len(ix)):
+                E = invech_chol(np.eye(len(ix))[m])
+                dSigma = E.dot(L.T) + L.dot(E.T)
+                A = Sigma_inv.dot(dSigma).dot(Sigma_inv)
+                grad[ix[m]] = -np.sum(U.dot(A) * U) + ng * np.trace(Sigma_inv.dot(dSigma)) \
+                              - np.sum(C * A)
+                B[u_ix, ix[m]] = U.dot(A)
+            start += ng * nv
+        ZtWoX = ZtWo.dot(X)
+        MZX = fac_o.solve_A(ZtWoX)
+        if profile_beta:
+            MB = fac_o.solve_A(B)
+            S = X.T.dot(X * -ds[:, None]) - ZtWoX.T.dot(MZX)
+            dbeta = -np.linalg.solve(S, ZtWoX.T.dot(MB))
+            deta = X.dot(dbeta) + Z.dot(MB - MZX.dot(dbeta))
+            return grad + dwh.dot(deta)
+        grad = grad + dwh.dot(Z.dot(fac_o.solve_A(B)))
+        grad_beta = -2.0 * X.T.dot(s) + dwh.dot(X - Z.dot(MZX))
+        return np.concatenate([grad, grad_beta])
+    
+    def _theta_from_chol(self, theta_chol_re):
+        theta_chol = np.append(theta_chol_re, 0.0)
+        return inverse_transform_theta(theta_chol, self.dims, self.indices)
+    
+    def deviance(self, theta_chol_re, return_grad=False):
+        """
+        Parameters
+        ----------
+        theta_chol_re : ndarray
+            Random effect covariance parameters on the cholesky 
+            parameterization.
+        return_grad : bool, optional
+            Whether the gradient with respect to theta_chol_re is returned
+            as well. The default is False.
+
+        Returns
+        -------
+        deviance : float
+            Laplace deviance with the fixed effects updated by PIRLS along 
+            with the random effects, as in the first stage of glmer.
+        grad : ndarray
+            Gradient of the deviance, only returned if return_grad is true.
+
+        """
+        dev, beta, u, _, Ginv, fac = self._pirls(self._theta_from_chol(theta_chol_re))
+        if not return_grad:
+            return dev
+        return dev, self._laplace_gradient(theta_chol_re, beta, u, Ginv, fac, True)
+    
+    def deviance_joint(self, params_chol, return_grad=False):
+        """
+        Parameters
+        ----------
+        params_chol : ndarray
+            Random effect covariance parameters on the cholesky 
+            parameterization followed by the fixed effects.
+        return_grad : bool, optional
+            Whether the gradient with respect to params_chol is returned as
+            well. The default is False.
+
+        Returns
+        -------
+        deviance : float
+            Laplace deviance at the given fixed effects.
+        grad : ndarray
+            Gradient of the deviance, only returned if return_grad is true.
+
+        """
+        theta_chol_re = params_chol[:self.n_theta]
+        dev, beta, u, _, Ginv, fac = self._pirls(self._theta_from_chol(theta_chol_re),
+                                                 params_chol[self.n_theta:])
+        if not return_grad:
+            return dev
+        return dev, self._laplace_gradient(theta_chol_re, beta, u, Ginv, fac, False)
+    
+    def _deviance_theta(self, theta_re, beta):
+        return self.pirls(np.append(theta_re, 1.0), beta)[0]
+    
+    def fit(self, joint=True, opt_kws={}, se_eps=1e-4):
+        """
+        Parameters
+        ----------
+        joint : bool, optional
+            If true, the deviance profiled over theta is followed by a second
+            optimization over theta and beta together, which gives the Laplace
+            estimates of beta. If false only the first stage is run. The 
+            default is True.
+        opt_kws : dict, optional
+            Options passed to scipy.optimize.minimize. The default is {}.
+        se_eps : float, optional
+            Step used for the finite difference hessian of the deviance with
+            respect to theta. The default is 1e-4.
+
+        Returns
+        -------
+        None.
+
+        """
+        theta_chol_re = self.theta_chol[:-1].copy()
+        self.optimizer = sp.optimize.minimize(self.deviance, theta_chol_re, args=(True,),
+                                              method='L-BFGS-B', jac=True,
+                                              bounds=self.bounds, options=opt_kws)
+        theta_chol_re = self.optimizer.x
+        self.deviance(theta_chol_re)
+        if joint:
+            params_chol = np.concatenate([theta_chol_re, self.beta])
+            bounds = self.bounds + [(None, None)] * self.X.shape[1]
+            self.optimizer = sp.optimize.minimize(self.deviance_joint, params_chol, 
+                                                  args=(True,), method='L-BFGS-B', 
+                                                  jac=True, bounds=bounds, options=opt_kws)
+            theta_chol_re = self.optimizer.x[:self.n_theta]
+            beta = self.optimizer.x[self.n_theta:]
+        else:
+            beta = self.beta.copy()
+        theta = self._theta_from_chol(theta_chol_re)
+        dev, beta, u, XtVinvX = self.pirls(theta, beta)
+        Htheta = so_fc_cd(self._deviance_theta, theta[:-1], eps=se_eps, args=(beta,))
+        self.theta, self.theta_chol = theta, np.append(theta_chol_re, 0.0)
+        self.beta, self.u = beta, u
+        self.Hinv_beta = np.linalg.inv(XtVinvX)
+        self.Hinv_theta = np.linalg.pinv(Htheta / 2.0)
+        self.se_beta = np.sqrt(np.diag(self.Hinv_beta))
+        self.se_theta = np.sqrt(np.diag(self.Hinv_theta))
+        self.params = np.concatenate([beta, theta[:-1]])
+        self.se_params = np.concatenate([self.se_beta, self.se_theta])
+        self.ll = dev
+        self.llf = dev / -2.0
+        d = len(self.params)
+        n = self.X.shape[0]
+        self.AIC = self.ll + 2.0 * d
+        self.BIC = self.ll + d * np.log(n)
+        param_names = list(self.fe_vars)
+        for level in self.levels:
+            for i, j in list(zip(*np.triu_indices(self.dims[level]['n_vars']))):
+                param_names.append(f"{level}:G[{i}][{j}]")
+        self.param_names = param_names
+        res = np.vstack((self.params, self.se_params)).T
+        res = pd.DataFrame(res, index=param_names, columns=['estimate', 'SE'])
+        res['z'] = res['estimate'] / res['SE']
+        res['p'] = sp.stats.norm(0, 1).sf(np.abs(res['z'])) * 2.0
+        self.res = res
+        
+    def predict(self, X=None, Z=None):
+        """
+        Parameters
+        ----------
+        X : ndarray, optional
+            Model matrix for fixed effects. The default is None.
+        Z : ndarray, optional
+            Model matrix from random effects. The default is None.
+
+        Returns
+        -------
+        mu : ndarray
+            Conditional mean of the response given the random effect modes.
+
+        """
+        X = self.X if X is None else X
+        Z = self.Zs if Z is None else Z
+        return self.f.inv_link(X.dot(self.beta) + Z.dot(self.u))
  
 """       
 from pystats.utilities.random_corr import vine_corr
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 16:48:12 2026
+"""
+import os
+import json
+import numpy as np
+import arviz as az
+
+
+class SampleStore:
+
+    def __init__(self, shapes, n_chains, n_samples, thin=1, path=None,
+                 chunk_size=256, dtype=np.float64):
+        """
+        Parameters
+        ----------
+        shapes : dict
+            Shape of a single draw of each stored variable.
+        n_chains : int
+            Number of chains.
+        n_samples : int
+            Number of draws per chain, before thinning.
+        thin : int, optional
+            Every thin-th draw is kept, starting with the first. The default
+            is 1.
+        path : str, optional
+            Directory in which each variable is kept as a memory-mapped
+            `<key>.npy` file of shape (n_chains, n_kept, *shape). The default
+            is None, which keeps the draws in memory.
+        chunk_size : int, optional
+            Number of kept draws buffered in memory by each chain before they
+            are written out. The default is 256.
+        dtype : dtype, optional
+            Data type of the stored draws. The default is np.float64.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.shapes = dict([(key, tuple(shape)) for key, shape in shapes.items()])
+        self.n_chains, self.n_samples, self.thin = n_chains, n_samples, thin
+        self.n_kept = -(-n_samples // thin)
+        self.path, self.chunk_size = path, chunk_size
+        self.dtype = np.dtype(dtype)
+        self.arrays = {}
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            meta = dict(shapes=self.shapes, n_chains=n_chains, n_samples=n_samples,
+                        thin=thin, chunk_size=chunk_size, dtype=self.dtype.str)
+            with open(os.path.join(path, "store.json"), 'w') as f:
+                json.dump(meta, f)
+        for key, shape in self.shapes.items():
+            full_shape = (n_chains, self.n_kept) + shape
+            if path is None:
+                self.arrays[key] = np.zeros(full_shape, dtype=self.dtype)
+            else:
+                self.arrays[key] = np.lib.format.open_memmap(self.filename(key), mode='w+',
+                                                             dtype=self.dtype,
+                                                             shape=full_shape)
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        """
+        Parameters
+        ----------
+        path : str
+            Directory of a store previously written to disk.
+        mode : str, optional
+            Mode in which the files are memory-mapped. The default is 'r'.
+
+        Returns
+        -------
+        store : SampleStore
+            Store whose arrays are mapped from the files in path.
+
+        """
+        with open(os.path.join(path, "store.json")) as f:
+            meta = json.load(f)
+        store = cls.__new__(cls)
+        store.shapes = dict([(key, tuple(shape)) for key, shape in meta['shapes'].items()])
+        store.n_chains, store.n_samples = meta['n_chains'], meta['n_samples']
+        store.thin, store.chunk_size = meta['thin'], meta['chunk_size']
+        store.n_kept = -(-store.n_samples // store.thin)
+        store.path, store.dtype = path, np.dtype(meta['dtype'])
+        store._open_arrays(mode)
+        return store
+
+    def filename(self, key):
+        return os.path.join(self.path, f"{key}.npy")
+
+    def _open_arrays(self, mode):
+        self.arrays = dict([(key, np.load(self.filename(key), mmap_mode=mode)[:, :self.n_kept])
+                            for key in self.shapes])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # workers write to the files directly or return their own chain
+        state['arrays'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.arrays = {}
+
+    def writer(self, chain, start=0):
+        """
+        Parameters
+        ----------
+        chain : int
+            Chain whose draws are written.
+        start : int, optional
+            Index, before thinning, of the first draw written. The default
+            is 0.
+
+        Returns
+        -------
+        writer : ChainWriter
+            Buffered writer of the draws of chain.
+
+        """
+        return ChainWriter(self, chain, start)
+
+    def gather(self, chain, written):
+        """
+        Parameters
+        ----------
+        chain : int
+            Chain the draws were made in.
+        written : tuple or None
+            Position of the first kept draw and the kept draws of chain, as
+            returned by ChainWriter.close, which is None for stores on disk.
+
+        Returns
+        -------
+        None.
+
+        """
+        if written is None:
+            return
+        start, arrays = written
+        for key, val in arrays.items():
+            self.arrays[key][chain, start:start+len(val)] = val
+
+    def truncate(self, n_samples):
+        """
+        Parameters
+        ----------
+        n_samples : int
+            Number of draws per chain, before thinning, actually made when
+            sampling stopped early.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.n_samples, self.n_kept = n_samples, -(-n_samples // self.thin)
+        self.arrays = dict([(key, val[:, :self.n_kept]) for key, val in self.arrays.items()])
+        if self.path is not None:
+            with open(os.path.join(self.path, "store.json")) as f:
+                meta = json.load(f)
+            meta['n_samples'] = n_samples
+            with open(os.path.join(self.path, "store.json"), 'w') as f:
+                json.dump(meta, f)
+
+    def extend(self, n_samples, mode='r+'):
+        """
+        Parameters
+        ----------
+        n_samples : int
+            Number of draws per chain, before thinning, the store was
+            created with, which undoes an earlier truncate when a run is
+            resumed.
+        mode : str, optional
+            Mode in which the files are memory-mapped again for stores on
+            disk. The default is 'r+'.
+
+        Returns
+        -------
+        None.
+
+        """
+        n_kept = -(-n_samples // self.thin)
+        if self.path is None:
+            for key, val in self.arrays.items():
+                arr = np.zeros((self.n_chains, n_kept)+self.shapes[key], dtype=self.dtype)
+                arr[:, :self.n_kept] = val
+                self.arrays[key] = arr
+            self.n_samples, self.n_kept = n_samples, n_kept
+            return
+        self.n_samples, self.n_kept = n_samples, n_kept
+        self._open_arrays(mode)
+        with open(os.path.join(self.path, "store.json")) as f:
+            meta = json.load(f)
+        meta['n_samples'] = n_samples
+        with open(os.path.join(self.path, "store.json"), 'w') as f:
+            json.dump(meta, f)
+
+    def view(self, burnin=0):
+        """
+        Parameters
+        ----------
+        burnin : int, optional
+            Number of draws, before thinning, dropped from the start of each
+            chain. The default is 0.
+
+        Returns
+        -------
+        arrays : dict
+            Views of the kept draws, which are read from disk only when
+            accessed for stores on disk.
+
+        """
+        start = -(-burnin // self.thin)
+        return dict([(key, val[:, start:]) for key, val in self.arrays.items()])
+
+    def to_arviz(self, burnin=0, group='posterior'):
+        """
+        Parameters
+        ----------
+        burnin : int, optional
+            Passed to view. The default is 0.
+        group : str, optional
+            InferenceData group the variables are placed in. The default is
+            'posterior'.
+
+        Returns
+        -------
+        idata : InferenceData
+            ArviZ data sharing memory with the stored draws, so memory-mapped
+            draws are not loaded until they are used.
+
+        """
+        return az.from_dict(**{group: self.view(burnin)})
+
+
+class ChainWriter:
+
+    def __init__(self, store, chain, start=0):
+        """
+        Parameters
+        ----------
+        store : SampleStore
+            Store the draws are written to.
+        chain : int
+            Chain whose draws are written.
+        start : int, optional
+            Index, before thinning, of the first draw written. The default
+            is 0.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.store, self.chain = store, chain
+        self.thin, self.n_kept = store.thin, store.n_kept
+        self.chunk_size = min(store.chunk_size, store.n_kept)
+        self.start = -(-start // self.thin)
+        self.buffers, self.targets = {}, {}
+        for key, shape in store.shapes.items():
+            self.buffers[key] = np.zeros((self.chunk_size,)+shape, dtype=store.dtype)
+            if store.path is None:
+                self.targets[key] = []
+            else:
+                self.targets[key] = np.load(store.filename(key), mmap_mode='r+')[chain]
+        self.n_written, self.n_buffered = self.start, 0
+
+    def write(self, i, **values):
+        """
+        Parameters
+        ----------
+        i : int
+            Index of the draw, before thinning.
+        **values : array_like
+            Value of the draw for each variable, with variables that are not
+            in the store ignored.
+
+        Returns
+        -------
+        None.
+
+        """
+        if i % self.thin != 0 or not self.buffers:
+            return
+        for key, buffer in self.buffers.items():
+            buffer[self.n_buffered] = values[key]
+        self.n_buffered += 1
+        if self.n_buffered == self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        start, stop = self.n_written, self.n_written + self.n_buffered
+        for key, buffer in self.buffers.items():
+            if self.store.path is None:
+                self.targets[key].append(buffer[:self.n_buffered].copy())
+            else:
+                self.targets[key][start:stop] = buffer[:self.n_buffered]
+        self.n_written, self.n_buffered = stop, 0
+
+    def close(self):
+        """
+        Returns
+        -------
+        written : tuple or None
+            Position of the first kept draw and the kept draws of the chain
+            for stores in memory, None for stores on disk, whose files have
+            been flushed.
+
+        """
+        if self.n_buffered > 0:
+            self._flush()
+        if self.store.path is None:
+            arrays = dict([(key, np.concatenate(val) if val else self.buffers[key][:0])
+                           for key, val in self.targets.items()])
+            return self.start, arrays
+        for val in self.targets.values():
+            val.flush()
+        self.targets = {}
+        return None
@@ -12,11 +12,19 @@ import scipy as sp
 import scipy.sparse as sps
 import pandas as pd
 from pystats.utilities.linalg_operations import (dummy, vech, invech, _check_np, 
-                                                 _check_shape, vec)
+                                                 _check_shape, vec,
+                                                 sparse_pattern_union,
+                                                 sparse_border_pattern,
+                                                 sparse_pattern_positions,
+                                                 sparse_pattern_fill,
+                                                 sparse_group_design,
+                                                 sparse_selected_inversion)
 from pystats.utilities.special_mats import lmat, nmat
+from pystats.pylmm.model_matrices import update_gmat_blocks
 from pystats.utilities.numerical_derivs import so_gc_cd, so_fc_cd, fo_fc_cd
+from pystats.utilities.eval_cache import EvalCache
 
-from sksparse.cholmod import cholesky
+from sksparse.cholmod import analyze
 
 
 
@@ -36,15 +44,13 @@ def construct_random_effects(groups, data, n_yvars):
     re_vars, re_groupings = list(zip(*groups))
     re_vars, re_groupings = set(re_vars), set(re_groupings)
     Zdict = dict(zip(re_vars, [_check_np(patsy.dmatrix(x, data=data, return_type='dataframe')) for x in re_vars]))
-    Jdict = dict(zip(re_groupings, [dummy(data[x]) for x in re_groupings]))
     dim_dict = {}
     Z = []
     for x, y in groups:
-        Ji, Xi = Jdict[y], Zdict[x]
-        dim_dict[y] = {'n_groups':Ji.shape[1], 'n_vars':Xi.shape[1]*n_yvars}
-        Zi = sp.linalg.khatri_rao(Ji.T, Xi.T).T
+        Zi, n_groups = sparse_group_design(data[y], Zdict[x])
+        dim_dict[y] = {'n_groups':n_groups, 'n_vars':Zdict[x].shape[1]*n_yvars}
         Z.append(Zi)
-    Z = np.concatenate(Z, axis=1)
+    Z = sps.hstack(Z, format='csc')
     return Z, dim_dict
 
 def construct_model_matrices(formula, data):
@@ -102,16 +108,6 @@ def make_gcov(theta, indices, dims, inverse=False):
 
     
 
-def lndet_gmat(theta, dims, indices):
-    lnd = 0.0
-    for key, value in dims.items():
-        dims_i = dims[key]
-        ng = dims_i['n_groups']
-        Sigma_i = invech(theta[indices['theta'][key]])
-        lnd += ng*np.linalg.slogdet(Sigma_i)[1]
-    return lnd
-
-
 def invech_chol(lvec):
     p = int(0.5 * ((8*len(lvec) + 1)**0.5 - 1))
     L = np.zeros((p, p))
@@ -191,7 +187,7 @@ class MLMM:
         n_yvars = len(yvars)
         if n_yvars>1:
             X = np.kron(X, np.eye(n_yvars))
-            Z = np.kron(Z, np.eye(n_yvars))
+            Z = sps.kron(Z, sps.eye(n_yvars), format='csc')
             y = vec(y.T)
         
         indices = {}
@@ -210,15 +206,26 @@ class MLMM:
         self.n_yvars = n_yvars
         indices['resid'] = r_indices
         indices['rt'] = np.arange(len(theta)-n_yvars, len(theta))
-        XZ = np.hstack([X, Z])
-        XZy = sps.csc_matrix(np.hstack([XZ, y.reshape(-1, 1)]))
+        XZ = sps.hstack([X, Z], format='csc')
+        XZy = sps.hstack([XZ, y.reshape(-1, 1)], format='csc')
         self.X, self.Z, self.y, self.dims, self.levels = X, Z, y.reshape(-1, 1), dims, levels
         self.XZ, self.XZy = XZ, XZy
         self.theta, self.theta_chol = theta, transform_theta(theta, dims, indices)
         self.G = G
+        # each level occupies a contiguous run of G.data, one block per group
+        self.g_slices = dict([(key, slice(ix[0], ix[-1]+1)) for key, ix in g_indices.items()])
         self.indices = indices
         self.R = R.todia()
-        self.Zs = sps.csc_matrix(Z)
+        self.Zs = Z
+        self.M = sparse_pattern_union(XZy.T.dot(XZy), G, X.shape[1])
+        self.M = sparse_pattern_union(self.M, sparse_border_pattern(self.M.shape[0]))
+        self.Q = sparse_pattern_union(self.Zs.T.dot(self.Zs), G)
+        self.m_g_ix = sparse_pattern_positions(self.M, G, X.shape[1])
+        self.q_g_ix = sparse_pattern_positions(self.Q, G)
+        self.m_chol, self.q_chol = analyze(self.M), analyze(self.Q)
+        self.e_y = np.zeros(self.M.shape[0])
+        self.e_y[-1] = 1.0
+        self.cache = EvalCache()
         self.g_derivs, self.jac_inds = get_jacmats(self.Zs, self.dims, self.indices, self.theta)
         self.n_theta = len(self.theta)
         self.n_gpars = self.n_theta - self.n_yvars
@@ -239,22 +246,39 @@ class MLMM:
         
     def update_mme(self, Ginv, Rinv):
         RZXy = Rinv.dot(self.XZy)
-        M = self.XZy.T.dot(RZXy)
-        Omega = sp.sparse.block_diag([self.zero_mat, Ginv, self.zero_mat2])
-        M+=Omega
+        M = sparse_pattern_fill(self.M, self.XZy.T.dot(RZXy))
+        M.data[self.m_g_ix] += Ginv.data
         return M
     
+    def update_qmat(self, Ginv, Rinv):
+        ZtRZ = (Rinv.dot(self.Zs)).T.dot(self.Zs)
+        Q = sparse_pattern_fill(self.Q, ZtRZ)
+        Q.data[self.q_g_ix] += Ginv.data
+        return Q
+    
     def update_gmat(self, theta, inverse=False):
-        G = self.G
-        for key in self.levels:
-            ng = self.dims[key]['n_groups']
-            theta_i = theta[self.indices['theta'][key]]
-            if inverse:
-                theta_i = np.linalg.inv(invech(theta_i)).reshape(-1, order='F')
-            else:
-                theta_i = invech(theta_i).reshape(-1, order='F')
-            G.data[self.indices['g'][key]] = np.tile(theta_i, ng)
-        return G
+        if inverse:
+            return self.update_ginv(theta)[0]
+        return update_gmat_blocks(theta, self.G, self.dims, self.indices['theta'],
+                                  self.g_slices)[0]
+    
+    def update_ginv(self, theta):
+        """
+        Parameters
+        ----------
+        theta: ndarray
+             covariance parameters on the original scale
+        
+        Returns
+        -------
+        Ginv: sparse matrix
+            updated inverse of the random effects covariance
+        logdetG: float
+            log determinant of the random effects covariance
+            
+        """
+        return update_gmat_blocks(theta, self.G, self.dims, self.indices['theta'],
+                                  self.g_slices, inverse=True)
     
     def update_rmat(self, theta, inverse=False):
         R = self.R.copy()
@@ -267,54 +291,70 @@ class MLMM:
             R.data[0, self.indices['resid'][key]] = theta_i
         return R
         
-    def loglike(self, theta, use_sparse=True, reml=True):
-        Ginv = self.update_gmat(theta, inverse=True)
+    def _theta_state(self, theta):
+        state = self.cache(theta)
+        if 'chol_fac' in state:
+            return state
+        Ginv, logdetG = self.update_ginv(theta)
+        Ginv = Ginv.copy()
         Rinv = self.update_rmat(theta, inverse=True).copy()
+        RZ, RX, Ry = Rinv.dot(self.Zs), Rinv.dot(self.X), Rinv.dot(self.y)
+        XtRX, ZtRX = self.X.T.dot(RX), RZ.T.dot(self.X)
+        XtRy, ZtRy, ytRy = self.X.T.dot(Ry), RZ.T.dot(self.y), self.y.T.dot(Ry)
+        Q = self.update_qmat(Ginv, Rinv)
+        chol_fac = self.q_chol.cholesky(Q)
+        MZtRX, MZtRy = chol_fac.solve_A(ZtRX), chol_fac.solve_A(ZtRy)
+        XtWX = XtRX - ZtRX.T.dot(MZtRX)
+        XtWy = XtRy - ZtRX.T.dot(MZtRy)
+        XtWX_inv = np.linalg.inv(XtWX)
+        ytPy = ytRy - ZtRy.T.dot(MZtRy) - XtWy.T.dot(XtWX_inv.dot(XtWy))
+        state.update(Ginv=Ginv, Rinv=Rinv, chol_fac=chol_fac, RZ=RZ, RX=RX,
+                     Ry=Ry, MZtRX=MZtRX, MZtRy=MZtRy, XtWX=XtWX, XtWy=XtWy,
+                     XtWX_inv=XtWX_inv, ytPy=ytPy.item(), logdetG=logdetG)
+        return state
+        
+    def loglike(self, theta, use_sparse=True, reml=True):
         R = self.update_rmat(theta, inverse=False).copy()
-        M = self.update_mme(Ginv, Rinv)
-        if (M.nnz / np.product(M.shape) < 0.05) and use_sparse:
-            L = cholesky(M.tocsc()).L().A
+        if (self.M.nnz / np.product(self.M.shape) < 0.05) and use_sparse:
+            # logdet(C) = logdet(Q) + logdet(X'V^{-1}X)
+            state = self._theta_state(theta)
+            ytPy, logdetV = state['ytPy'], state['chol_fac'].logdet()
+            logdetC = logdetV + np.linalg.slogdet(state['XtWX'])[1]
+            logdetG = state['logdetG']
         else:
+            Ginv, logdetG = self.update_ginv(theta)
+            Rinv = self.update_rmat(theta, inverse=True).copy()
+            M = self.update_mme(Ginv, Rinv)
             L = np.linalg.cholesky(M.A)
-        ytPy = np.diag(L)[-1]**2
-        logdetG = lndet_gmat(theta, self.dims, self.indices)
+            ytPy = np.diag(L)[-1]**2
+            logdetC = np.sum(2*np.log(np.diag(L))[:-1])
+            if not reml:
+                Q = self.update_qmat(Ginv, Rinv)
+                self.q_chol.cholesky_inplace(Q)
+                _, logdetV = self.q_chol.slogdet()
         logdetR = np.log(R.data).sum()
         if reml:
-            logdetC = np.sum(2*np.log(np.diag(L))[:-1])
             ll = logdetR + logdetC + logdetG + ytPy
         else:
-            Rinv = self.R / theta[-1]
-            RZ = Rinv.dot(self.Zs)
-            Q = Ginv + self.Zs.T.dot(RZ)
-            _, logdetV = cholesky(Q).slogdet()
             ll = logdetR + logdetV + logdetG + ytPy
         return ll
     
     def gradient(self, theta, reml=True):
-        Ginv = self.update_gmat(theta, inverse=True).copy()
-        Rinv = self.update_rmat(theta, inverse=True).copy()
-        RZ = Rinv.dot(self.Zs)
-        RX = Rinv.dot(self.X)
-        Ry = Rinv.dot(self.y)
-        ZtRZ = RZ.T.dot(self.Zs)
-        XtRX = self.X.T.dot(RX) 
-        ZtRX = RZ.T.dot(self.X)
-        ZtRy = RZ.T.dot(self.y)
-            
-        Q = Ginv + ZtRZ
-        M = cholesky(Q).inv()
-        
-        ZtWZ = ZtRZ - ZtRZ.dot(M).dot(ZtRZ)
-        
-        MZtRX = M.dot(ZtRX)
-        
-        XtWX = XtRX - ZtRX.T.dot(MZtRX)
-        XtWX_inv = np.linalg.inv(XtWX)
-        ZtWX = ZtRX - ZtRZ.dot(MZtRX)
-        WX = RX - RZ.dot(MZtRX)
-        U = XtWX_inv.dot(WX.T)
-        Vy = Ry - RZ.dot(M.dot(ZtRy))
-        Py = Vy - WX.dot(U.dot(self.y))
+        state = self._theta_state(theta)
+        Ginv, Rinv, RZ = state['Ginv'], state['Rinv'], state['RZ']
+        MZtRX, XtWX_inv = state['MZtRX'], state['XtWX_inv']
+        if 'Py' not in state:
+            M = sparse_selected_inversion(state['chol_fac'])
+            WX = state['RX'] - RZ.dot(MZtRX)
+            Py = state['Ry'] - RZ.dot(state['MZtRy']) \
+                 - WX.dot(XtWX_inv.dot(state['XtWy']))
+            state.update(Qinv=M, WX=WX, Py=Py)
+        M, WX, Py = state['Qinv'], state['WX'], state['Py']
+        # Z'V^{-1}Z = G^{-1} - G^{-1}Q^{-1}G^{-1} and Z'V^{-1}X = G^{-1}Q^{-1}Z'R^{-1}X;
+        # only group diagonal blocks of the former are used, and those 
+        # need only the selected entries of Q^{-1}
+        ZtWZ = Ginv - Ginv.dot(M).dot(Ginv)
+        ZtWX = Ginv.dot(MZtRX)
         ZtPy = self.Zs.T.dot(Py)
         grad = []
         for key in self.levels:
@@ -333,7 +373,7 @@ class MLMM:
                 grad.append(gi)
 
         for dR in self.g_derivs['resid']:
-            g1 = sptrace(Rinv.dot(dR)) - sptrace(M.dot(RZ.T.dot(dR).dot(RZ)))
+            g1 = sptrace(Rinv.dot(dR)) - M.multiply(RZ.T.dot(dR).dot(RZ)).sum()
             g2 = (dR.dot(Py)).T.dot(Py)
             if reml:
                 g3 = np.trace(XtWX_inv.dot(WX.T.dot(dR.dot(WX))))
@@ -395,17 +435,18 @@ class MLMM:
         Ginv = self.update_gmat(theta, inverse=True)
         Rinv = self.update_rmat(theta, inverse=True).copy()
         M = self.update_mme(Ginv, Rinv)
-        RXZy = self.XZ.T.dot(Rinv.dot(self.y))
-        chol_fac = cholesky(M[:-1, :-1].tocsc())
-        betau = chol_fac.solve_A(RXZy)
+        self.m_chol.cholesky_inplace(M)
+        # last column of M^{-1} is [-C^{-1}[X Z]'R^{-1}y; 1] / y'Py
+        My = self.m_chol.solve_A(self.e_y)
+        betau = -My[:-1] / My[-1]
         u = betau[self.X.shape[1]:].reshape(-1)
         beta = betau[:self.X.shape[1]].reshape(-1)
         
-        RZ = Rinv.dot(self.Zs)
-        Q = Ginv + self.Zs.T.dot(RZ)
-        M = cholesky(Q).inv()
+        Q = self.update_qmat(Ginv, Rinv)
+        self.q_chol.cholesky_inplace(Q)
+        M = self.q_chol.inv()
         XtRinvX = self.X.T.dot(Rinv.dot(self.X)) 
-        XtRinvZ = self.X.T.dot(Rinv.dot(self.Z)) 
+        XtRinvZ = (Rinv.dot(self.Zs)).T.dot(self.X).T
         XtVinvX = XtRinvX - XtRinvZ.dot(M.dot(XtRinvZ.T))
         XtVinvX_inv = np.linalg.inv(XtVinvX)
         return beta, XtVinvX_inv, u
@@ -13,7 +13,7 @@ import scipy.stats # analysis:ignore
 import scipy.sparse as sps
 
 from ..utilities.linalg_operations import (_check_np, khatri_rao, invech, vech, dummy,
-                                           _check_shape)
+                                           _check_shape, sparse_group_design)
 from ..utilities.special_mats import (kronvec_mat, dmat)
 
 
@@ -34,15 +34,13 @@ def construct_random_effects(groups, data, n_vars):
     re_vars, re_groupings = list(zip(*groups))
     re_vars, re_groupings = set(re_vars), set(re_groupings)
     Zdict = dict(zip(re_vars, [_check_np(patsy.dmatrix(x, data=data, return_type='dataframe')) for x in re_vars]))
-    Jdict = dict(zip(re_groupings, [dummy(data[x]) for x in re_groupings]))
     dim_dict = {}
     Z = []
     for x, y in groups:
-        Ji, Xi = Jdict[y], Zdict[x]
-        dim_dict[y] = {'n_groups':Ji.shape[1], 'n_vars':Xi.shape[1]}
-        Zi = khatri_rao(Ji.T, Xi.T).T
+        Zi, n_groups = sparse_group_design(data[y], Zdict[x])
+        dim_dict[y] = {'n_groups':n_groups, 'n_vars':Zdict[x].shape[1]}
         Z.append(Zi)
-    Z = np.concatenate(Z, axis=1)
+    Z = sps.hstack(Z, format='csc')
     return Z, dim_dict
 
 def construct_model_matrices(formula, data):
@@ -108,6 +106,76 @@ def update_gmat(theta, G, dims, indices, g_indices, inverse=False):
         
   
         
+def cov_inverse_logdet(Sigma):
+    """
+    Parameters
+    ----------
+    Sigma : ndarray
+        Small symmetric covariance matrix.
+
+    Returns
+    -------
+    Sigma_inv : ndarray
+        Inverse of Sigma.
+    logdet : float
+        Log determinant of Sigma.
+        
+    Notes
+    -----
+    Both are taken from one Cholesky factor, falling back to a general 
+    inverse and slogdet when Sigma is not positive definite.
+    """
+    try:
+        L = np.linalg.cholesky(Sigma)
+    except np.linalg.LinAlgError:
+        return np.linalg.inv(Sigma), np.linalg.slogdet(Sigma)[1]
+    Linv = sp.linalg.solve_triangular(L, np.eye(L.shape[0]), lower=True)
+    return Linv.T.dot(Linv), 2.0 * np.sum(np.log(np.diag(L)))
+
+def update_gmat_blocks(theta, G, dims, theta_indices, g_slices, inverse=False):
+    """
+    Parameters
+    ----------
+    theta : ndarray
+        Covariance parameters on the original scale.
+    G : sparse matrix
+        Block diagonal random effects covariance, whose data is stored 
+        level by level and group by group in column major order.
+    dims : dict
+        Number of groups and variables of each level.
+    theta_indices : dict
+        Indices of each level's parameters in theta.
+    g_slices : dict
+        Slice of G.data holding each level's blocks.
+    inverse : bool, optional
+        Whether G is filled with the inverse covariance. The default is 
+        False.
+
+    Returns
+    -------
+    G : sparse matrix
+        G updated in place.
+    logdetG : float
+        Log determinant of the random effects covariance.
+        
+    Notes
+    -----
+    Each level's covariance is factored once for both its inverse and its
+    log determinant, which are broadcast in place into the buffer of G 
+    shared by every group of the level.
+    """
+    logdetG = 0.0
+    for key, g_slice in g_slices.items():
+        ng, nv = dims[key]['n_groups'], dims[key]['n_vars']
+        Sigma = invech(theta[theta_indices[key]])
+        if inverse:
+            Sigma, logdet = cov_inverse_logdet(Sigma)
+        else:
+            logdet = np.linalg.slogdet(Sigma)[1]
+        G.data[g_slice].reshape(ng, nv*nv)[:] = Sigma.reshape(-1, order='F')
+        logdetG += ng * logdet
+    return G, logdetG
+
 def sparse_woodbury_inversion(Umat, Vmat=None, C=None, Cinv=None, A=None, Ainv=None):
     if Ainv is None:
         Ainv = sps.linalg.inv(A)
@@ -5,11 +5,13 @@ Created on Mon Jul 19 17:53:00 2021
 
 @author: lukepinkel
 """
+import os
 import tqdm
 import numpy as np
 import scipy as sp
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from ..utilities.linalg_operations import vech, invech
 from ..utilities.numerical_derivs import so_gc_cd
 
@@ -106,9 +108,35 @@ class RestrictedModel:
         return ll, J.dot(g)[free_ix]
     
     
-def profile(n_points, model, tb=3):
+def _profile_param(rmodel, i, tau, tspace, llmax):
+    free_ix = np.ones_like(tau).astype(bool)
+    free_ix[i] = False
+    bounds = rmodel.get_bounds(free_ix)
+    n_points = len(tspace)
+    thetas, zetas = np.zeros((n_points, len(tau))), np.zeros(n_points)
+    # walk outward from the grid point nearest the estimate, starting each
+    # optimization at the solution of the previous point
+    j0 = np.argmin(np.abs(tspace - tau[i]))
+    for grid_walk in [range(j0, n_points), range(j0-1, -1, -1)]:
+        x = tau[free_ix]
+        for j in grid_walk:
+            t0 = tspace[j]
+            func = lambda x: rmodel.llgrad(x, free_ix, t0)
+            opt = sp.optimize.minimize(func, x, jac=True, bounds=bounds,
+                                       method='trust-constr',
+                                       options=dict(initial_tr_radius=0.5))
+            x = opt.x
+            tau_r = tau.copy()
+            tau_r[free_ix] = opt.x
+            tau_r[~free_ix] = t0
+            LR = (opt.fun - llmax)
+            zetas[j] = np.sqrt(LR) * np.sign(t0 - tau[~free_ix])
+            thetas[j] = rmodel.reparam.inverse_transform(tau_r)
+    return thetas, zetas
+    
+
+def profile(n_points, model, tb=3, n_jobs=1):
     theta = model.theta.copy()
-    free_ix = np.ones_like(theta).astype(bool)
     reparam = VarCorrReparam(model.dims, model.indices) 
     rmodel = RestrictedModel(model, reparam)
     tau = reparam.transform(theta)
@@ -118,37 +146,34 @@ def profile(n_points, model, tb=3):
     
     H = so_gc_cd(vcrepara_grad, tau, args=(model, reparam,))
     se = np.diag(np.linalg.inv(H/2.0))**0.5
-    thetas, zetas = np.zeros((n_theta*n_points, n_theta)), np.zeros(n_theta*n_points)
-    k = 0
-    pbar = tqdm.tqdm(total=n_theta*n_points, smoothing=0.001)
+    tspaces = []
     for i in range(n_theta):
-        free_ix[i] = False
         t_mle = tau[i]
-        tau_r = tau.copy()
         if model.bounds[i][0]==0:
             lb = np.maximum(0.01, t_mle-tb*se[i])
         else:
             lb = t_mle - tb * se[i]
         ub = t_mle + tb * se[i]
-        tspace = np.linspace(lb, ub, n_points)
-        for t0 in tspace:
-            x = tau[free_ix]
-            func = lambda x: rmodel.llgrad(x, free_ix, t0)
-            bounds = rmodel.get_bounds(free_ix)
-            opt = sp.optimize.minimize(func, x, jac=True, bounds=bounds,
-                                       method='trust-constr',
-                                       options=dict(initial_tr_radius=0.5))
-    
-            tau_r[free_ix] = opt.x
-            tau_r[~free_ix] = t0
-            LR = (opt.fun - llmax)
-            zeta = np.sqrt(LR) * np.sign(t0 - tau[~free_ix])
-            zetas[k] = zeta
-            thetas[k] = reparam.inverse_transform(tau_r)
-            k+=1
+        tspaces.append(np.linspace(lb, ub, n_points))
+    n_jobs = os.cpu_count() if n_jobs==-1 else n_jobs
+    pbar = tqdm.tqdm(total=n_theta, smoothing=0.001)
+    if n_jobs==1:
+        res = []
+        for i in range(n_theta):
+            res.append(_profile_param(rmodel, i, tau, tspaces[i], llmax))
             pbar.update(1)
-        free_ix[i] = True
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_profile_param, rmodel, i, tau, 
+                                       tspaces[i], llmax)
+                       for i in range(n_theta)]
+            res = []
+            for f in futures:
+                res.append(f.result())
+                pbar.update(1)
     pbar.close()
+    thetas = np.concatenate([r[0] for r in res], axis=0)
+    zetas = np.concatenate([r[1] for r in res])
     ix = np.repeat(np.arange(n_theta), n_points)
     return thetas, zetas, ix 
     
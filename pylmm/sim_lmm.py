@@ -95,9 +95,38 @@ class MixedModelSim:
         self.X, self.Z, self.dims = X, Z, dims
         self.eta_fe, self.n_obs = X.dot(model_dict['beta']),  n_obs
     
+    @classmethod
+    def from_model(cls, model, rng=None):
+        """
+        Parameters
+        ----------
+        model : LMM
+            Fitted model whose design and estimates are simulated from.
+        rng : Generator, optional
+            Random number generator. The default is None.
+
+        Returns
+        -------
+        sim : MixedModelSim
+            Simulator reusing the X and Z of model, with the estimated fixed
+            effects and random effect covariances as the true values.
+
+        """
+        sim = cls.__new__(cls)
+        ginfo = dict([(key, dict(n_grp=model.dims[key]['n_groups'])) 
+                      for key in model.levels])
+        model_dict = dict(beta=model.beta, gcov=model.re_covs, ginfo=ginfo, 
+                          n_obs=model.X.shape[0])
+        sim.rng = np.random.default_rng() if rng is None else rng
+        sim.formula, sim.model_dict, sim.ginfo = None, model_dict, ginfo
+        sim.df, sim.re_groupings, sim.cont_vars = None, list(model.levels), None
+        sim.X, sim.Z, sim.dims = model.X, model.Zs, model.dims
+        sim.eta_fe, sim.n_obs = model.X.dot(model.beta), model.X.shape[0]
+        return sim
+    
     def simulate_ranefs(self, exact_ranefs=True):
         U = []
-        for x in self.re_groupings:
+        for x in self.dims.keys():
             Gi, n_grp = self.model_dict['gcov'][x], self.model_dict['ginfo'][x]['n_grp']
             u_mean = np.zeros(len(Gi))
             if exact_ranefs:
@@ -131,10 +160,7 @@ class MixedModelSim:
         return y
     
     def update_model(self, model, y):
-        model.y = y
-        model.Xty, model.Zty, model.yty = model.X.T.dot(y), model.Z.T.dot(y), y.T.dot(y)
-        model.m = sp.sparse.csc_matrix(np.vstack([model.Xty, model.Zty]))
-        model.M = sp.sparse.bmat([[model.C, model.m], [model.m.T, model.yty]])
+        model._set_response(y)
         return model
     
     def sim_fit(self, model, theta_init, method='l-bfgs-b', bounds=None,
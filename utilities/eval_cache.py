@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 09:12:41 2026
+"""
+from collections import OrderedDict
+import numpy as np
+
+
+class EvalCache:
+
+    def __init__(self, maxsize=4):
+        """
+        Parameters
+        ----------
+        maxsize : int, optional
+            Number of parameter vectors whose entries are kept, the least
+            recently used being evicted first. The default is 4.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def _key(self, x):
+        return np.asarray(x, dtype=np.double).tobytes()
+
+    def __call__(self, x):
+        """
+        Parameters
+        ----------
+        x : array_like
+            Parameter vector.
+
+        Returns
+        -------
+        entry : dict
+            Dictionary of quantities stored for x, empty the first time x is
+            seen, which callers fill in place.
+
+        """
+        key = self._key(x)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        else:
+            self.misses += 1
+            self.entries[key] = {}
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return self.entries[key]
+
+    def nearest(self, x, field=None):
+        """
+        Parameters
+        ----------
+        x : array_like
+            Parameter vector.
+        field : str, optional
+            Quantity the entry must hold. The default is None, which accepts
+            any entry.
+
+        Returns
+        -------
+        entry : dict or None
+            Entry of the stored parameter vector closest to x in Euclidean
+            distance, or None if there is none. The lookup is not counted as
+            a hit or miss and does not change the eviction order.
+
+        """
+        x = np.asarray(x, dtype=np.double)
+        entry, dmin = None, np.inf
+        for key, val in self.entries.items():
+            y = np.frombuffer(key, dtype=np.double)
+            if (field is not None and field not in val) or y.shape!=x.shape:
+                continue
+            d = np.sum((y - x)**2)
+            if d < dmin:
+                entry, dmin = val, d
+        return entry
+
+    def __contains__(self, x):
+        return self._key(x) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self.entries),
+                    maxsize=self.maxsize)
+
@@ -86,6 +86,159 @@ def sparse_woodbury_inversion(Umat, Vmat=None, C=None, Cinv=None, A=None, Ainv=N
     return W
 
 
+@numba.jit(nopython=True)
+def _takahashi_inversion(indptr, indices, data):
+    n = len(indptr) - 1
+    Zdata = np.zeros_like(data)
+    for j in range(n-1, -1, -1):
+        start, end = indptr[j], indptr[j+1]
+        d = data[start]
+        for a in range(start+1, end):
+            i = indices[a]
+            s = 0.0
+            for b in range(start+1, end):
+                k = indices[b]
+                c, r = (i, k) if i < k else (k, i)
+                pos = indptr[c] + np.searchsorted(indices[indptr[c]:indptr[c+1]], r)
+                s += Zdata[pos] * data[b]
+            Zdata[a] = -s / d
+        s = 0.0
+        for b in range(start+1, end):
+            s += Zdata[b] * data[b]
+        Zdata[start] = 1.0 / d**2 - s / d
+    return Zdata
+
+
+def sparse_selected_inversion(chol_fac):
+    """
+    Parameters
+    ----------
+    chol_fac : Factor
+        CHOLMOD factor of a symmetric positive definite matrix A.
+
+    Returns
+    -------
+    Ainv : csc_matrix
+        Entries of the inverse of A on the symmetrized sparsity pattern of
+        the Cholesky factor, computed with the Takahashi equations. This
+        includes every entry in the pattern of A, but entries of the inverse
+        outside the pattern are absent rather than zero.
+
+    """
+    L = chol_fac.L().tocsc()
+    L.sort_indices()
+    Zdata = _takahashi_inversion(L.indptr, L.indices, L.data)
+    p = chol_fac.P()
+    row = L.indices
+    col = np.repeat(np.arange(L.shape[1]), np.diff(L.indptr))
+    off = row!=col
+    r = np.concatenate([p[row], p[col[off]]])
+    c = np.concatenate([p[col], p[row[off]]])
+    Ainv = sps.csc_matrix((np.concatenate([Zdata, Zdata[off]]), (r, c)),
+                          shape=L.shape)
+    return Ainv
+
+
+def sparse_pattern_union(A, B, offset=0):
+    """
+    Parameters
+    ----------
+    A : sparse matrix
+        Matrix whose values are kept.
+    B : sparse matrix
+        Matrix whose sparsity pattern is added to that of A, placed in the
+        diagonal block of A starting at row and column `offset`.
+    offset : int, optional
+        Position of B along the diagonal of A. The default is 0.
+
+    Returns
+    -------
+    C : csc_matrix
+        Matrix with the values of A, explicit zeros where only B has entries,
+        and sorted indices.
+
+    """
+    A, B = A.tocoo(), B.tocoo()
+    row = np.concatenate([A.row, B.row+offset])
+    col = np.concatenate([A.col, B.col+offset])
+    data = np.concatenate([A.data, np.zeros(B.nnz)])
+    C = sps.csc_matrix((data, (row, col)), shape=A.shape)
+    return C
+
+
+def sparse_border_pattern(n):
+    """
+    Parameters
+    ----------
+    n : int
+        Order of the matrix.
+
+    Returns
+    -------
+    B : csc_matrix
+        n by n matrix of ones in the last row and column, used to keep the
+        response row of a mixed model matrix structurally dense.
+
+    """
+    ix = np.arange(n)
+    last = np.repeat(n-1, n)
+    B = sps.csc_matrix((np.ones(2*n-1), (np.concatenate([ix, last[:-1]]),
+                                       np.concatenate([last, ix[:-1]]))),
+                       shape=(n, n))
+    return B
+
+
+def sparse_pattern_positions(A, B, offset=0):
+    """
+    Parameters
+    ----------
+    A : csc_matrix
+        Matrix with sorted indices whose pattern contains that of B.
+    B : csc_matrix
+        Matrix whose entries are located in A, taken to be the diagonal block
+        of A starting at row and column `offset`.
+    offset : int, optional
+        Position of B along the diagonal of A. The default is 0.
+
+    Returns
+    -------
+    ix : ndarray
+        Position in A.data of each stored entry of B, in the order of B.data.
+
+    """
+    A, B = sps.csc_matrix(A), sps.csc_matrix(B)
+    n = A.shape[0]
+    akeys = np.repeat(np.arange(A.shape[1]), np.diff(A.indptr)) * n + A.indices
+    bkeys = (np.repeat(np.arange(B.shape[1]), np.diff(B.indptr)) + offset) * n\
+            + B.indices + offset
+    ix = np.minimum(np.searchsorted(akeys, bkeys), len(akeys)-1)
+    if np.any(akeys[ix]!=bkeys):
+        raise ValueError("Sparsity pattern of B is not contained in that of A")
+    return ix
+
+
+def sparse_pattern_fill(A, B):
+    """
+    Parameters
+    ----------
+    A : csc_matrix
+        Matrix with sorted indices whose pattern contains that of B.
+    B : sparse matrix
+        Matrix whose values are copied.
+
+    Returns
+    -------
+    C : csc_matrix
+        Matrix with the sparsity pattern of A and the values of B.
+
+    """
+    B = sps.csc_matrix(B)
+    C = A.copy()
+    C.data[:] = 0.0
+    C.data[sparse_pattern_positions(A, B)] = B.data
+    return C
+
+
 def add_chol_row(xnew, xold, L=None):
     xtx = xnew
     norm_xnew = np.sqrt(xtx)
@@ -184,6 +337,37 @@ def dummy(x, fullrank=True, categories=None):
     x = _check_shape(_check_np(x))
     return _dummy(x, fullrank, categories)
 
+
+def sparse_group_design(x, X):
+    """
+    Parameters
+    ----------
+    x : array_like
+        Grouping variable of length n.
+    X : ndarray
+        n by m matrix of variables whose effects vary over the groups of x.
+
+    Returns
+    -------
+    Z : csc_matrix
+        n by (n_groups * m) matrix equal to the transposed Khatri-Rao product
+        of dummy(x) and X, built from the group codes of x without forming
+        either dense matrix. Columns are ordered by group and then by
+        variable, and groups follow the sorted unique values of x.
+    n_groups : int
+        Number of unique values of x.
+
+    """
+    x, X = _check_shape(_check_np(x)), _check_np(X)
+    categories, codes = np.unique(x, return_inverse=True)
+    n, m = X.shape
+    row = np.repeat(np.arange(n), m)
+    col = (codes[:, None] * m + np.arange(m)).reshape(-1)
+    Z = sps.csc_matrix((X.reshape(-1), (row, col)),
+                       shape=(n, len(categories) * m))
+    Z.eliminate_zeros()
+    return Z, len(categories)
+
 def inv_sqrt(X):
     u, V = np.linalg.eig(X)
     U = np.diag(1.0 / np.sqrt(np.maximum(u, 1e-12)))
@@ -10,9 +10,14 @@ import numba # analysis:ignore
 import numpy as np # analysis:ignore
 import scipy as sp # analysis:ignore
 import scipy.stats # analysis:ignore
+import scipy.special # analysis:ignore
 from math import erf
 
 SQRT2 = np.sqrt(2.0)
+#Smallest acceptance probability of normal rejection and smallest standardized
+#lower bound at which the exponential proposal is used
+NORMAL_REJECTION_MASS = 0.3
+EXPONENTIAL_REJECTION_LB = 0.5
 
 @numba.jit(nopython=True)
 def norm_cdf(x):
@@ -82,10 +87,92 @@ def trnorm(mu, sd, lb, ub):
         z[i] = scalar_truncnorm(mu[i], sd[i], lb[i], ub[i])
     return z
 
-    
-    
-       
-        
-            
-    
-    
\ No newline at end of file
+
+def _normal_rejection(a, b, rng):
+    z = np.zeros_like(a)
+    pending = np.arange(len(a))
+    while len(pending)>0:
+        x = rng.standard_normal(len(pending))
+        accept = (x>a[pending]) & (x<b[pending])
+        z[pending[accept]] = x[accept]
+        pending = pending[~accept]
+    return z
+
+
+def _exponential_rejection(a, b, rng):
+    alpha = (a + np.sqrt(a * a + 4.0)) / 2.0
+    width = -np.expm1(-alpha * (b - a))
+    z = np.zeros_like(a)
+    pending = np.arange(len(a))
+    while len(pending)>0:
+        ap, wp = alpha[pending], width[pending]
+        x = a[pending] - np.log1p(-rng.uniform(size=len(pending)) * wp) / ap
+        accept = -rng.standard_exponential(len(pending)) <= -(x - ap)**2 / 2.0
+        z[pending[accept]] = x[accept]
+        pending = pending[~accept]
+    return z
+
+
+def _inverse_cdf(a, b, rng):
+    pa, pb = sp.special.ndtr(-a), sp.special.ndtr(-b)
+    z = -sp.special.ndtri(pa - rng.uniform(size=len(a)) * (pa - pb))
+    return np.clip(z, a, b)
+
+
+def rtruncnorm(mu, sd, lb, ub, rng=None, out=None):
+    """
+    Parameters
+    ----------
+    mu : array_like
+        Means.
+    sd : array_like
+        Standard deviations.
+    lb : array_like
+        Lower bounds, which may be -np.inf.
+    ub : array_like
+        Upper bounds, which may be np.inf.
+    rng : Generator or BitGenerator, optional
+        Source of the draws, for example a Generator wrapping a Philox
+        stream. The default is None, which uses np.random.default_rng().
+    out : ndarray, optional
+        Array the draws are written to. The default is None.
+
+    Returns
+    -------
+    out : ndarray
+        A draw from each truncated normal distribution.
+
+    Notes
+    -----
+    Each interval is standardized and reflected so that |a| <= |b|, and
+    then drawn by rejection from the normal distribution if it contains
+    zero and has probability at least NORMAL_REJECTION_MASS, by rejection
+    from an exponential proposal truncated to the interval if its lower
+    bound is at least EXPONENTIAL_REJECTION_LB, and by inverting the cdf
+    otherwise.  No global state is used, so concurrent calls with their 
+    own rng and out do not interact.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    elif not isinstance(rng, np.random.Generator):
+        rng = np.random.Generator(rng)
+    mu, sd, lb, ub = np.broadcast_arrays(*[np.asarray(x, dtype=np.double) 
+                                           for x in (mu, sd, lb, ub)])
+    out = np.empty(mu.shape) if out is None else out
+    a, b = (lb - mu) / sd, (ub - mu) / sd
+    flip = np.abs(b) < np.abs(a)
+    a, b = np.where(flip, -b, a), np.where(flip, -a, b)
+    a, b = a.ravel(), b.ravel()
+    mass = sp.special.ndtr(-a) - sp.special.ndtr(-b)
+    normal = (a < 0) & (mass >= NORMAL_REJECTION_MASS)
+    expon = ~normal & (a >= EXPONENTIAL_REJECTION_LB)
+    icdf = ~(normal | expon)
+    z = np.zeros_like(a)
+    for ix, func in [(normal, _normal_rejection), (expon, _exponential_rejection),
+                     (icdf, _inverse_cdf)]:
+        if np.any(ix):
+            z[ix] = func(a[ix], b[ix], rng)
+    z = z.reshape(mu.shape)
+    np.multiply(np.where(flip, -z, z), sd, out=out)
+    out += mu
+    return out
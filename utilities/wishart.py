@@ -35,10 +35,18 @@ def invwishart(df, V):
     IW = np.linalg.inv(W)
     return IW
 
-def r_invwishart(df, V):
+def r_invwishart(df, V, rng=None):
     Vinv = np.linalg.inv(V)
-    return invwishart(df, Vinv)
+    if rng is None:
+        return invwishart(df, Vinv)
+    n = V.shape[0]
+    T = np.zeros((n, n))
+    T[np.diag_indices(n)] = np.sqrt(rng.chisquare(df - np.arange(n)))
+    T[np.tril_indices(n, -1)] = rng.normal(0.0, 1.0, size=n*(n-1)//2)
+    A = np.linalg.cholesky(Vinv).dot(T)
+    return np.linalg.inv(A.dot(A.T))
 
-def r_invgamma(df, scale):
-    return 1.0/np.random.gamma(df, scale=1/scale)
+def r_invgamma(df, scale, rng=None):
+    gamma = np.random.gamma if rng is None else rng.gamma
+    return 1.0/gamma(df, scale=1/scale)
     
\ No newline at end of file